@@ -1,5 +1,5 @@
 from fastapi import APIRouter
-from app.api.api_v1.endpoints import test, auth, mails, users
+from app.api.api_v1.endpoints import test, auth, mails, users, stats, scheduler, jobs
 
 router = APIRouter()
 
@@ -7,5 +7,9 @@ router.include_router(router=auth.router, prefix="/auth", tags=["auth"])
 
 router.include_router(router=users.router, prefix="", tags=["users"])
 router.include_router(router=mails.router, prefix="", tags=["mails"])
+router.include_router(router=jobs.router, prefix="/jobs", tags=["jobs"])
+
+router.include_router(router=stats.router, prefix="/stats", tags=["stats"])
+router.include_router(router=scheduler.router, prefix="/scheduler", tags=["scheduler"])
 
 router.include_router(router=test.router, prefix="/test", tags=["test"])
@@ -1,16 +1,13 @@
 from fastapi import APIRouter
 
-from app.core.auth import get_confidential_client_application, get_access_token
-from app.core.config import configuration
+from app.core.auth import msal_client_registry
 
 router = APIRouter()
 
 
 @router.get("/token")
-def get_token(tenant: str):
-    config = configuration.get_ms_auth_config(tenant)
-    client_app = get_confidential_client_application(config)
-    token = get_access_token(config, client_app)
+async def get_token(tenant: str):
+    token = await msal_client_registry.get_token(tenant)
     return token
 
 
@@ -0,0 +1,55 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+
+from app.api import deps
+from app.controllers.sync_job import sync_job_manager
+from app.schemas.schema_sync import SyncJob, SyncJobParams
+
+router = APIRouter()
+
+
+@router.post("/messagesAndAttachments/save", response_model=SyncJob, status_code=202)
+async def submit_save_tenant_messages_and_attachments(
+        tenant: str,
+        top: int = 5,
+        filter="",
+        delta: bool = False,
+        two_phase: bool = False,
+        concurrency: Optional[int] = None,
+        use_checkpoint: bool = False,
+        _=Depends(deps.assert_tenant)
+) -> SyncJob:
+    params = SyncJobParams(
+        top=top, filter=filter, delta=delta, two_phase=two_phase, concurrency=concurrency,
+        use_checkpoint=use_checkpoint
+    )
+    return sync_job_manager.submit(tenant, params)
+
+
+@router.post("/users/{id}/messagesAndAttachments/save", response_model=SyncJob, status_code=202)
+async def submit_save_user_messages_and_attachments(
+        tenant: str,
+        id: str,
+        top: int = 5,
+        filter="",
+        delta: bool = False,
+        two_phase: bool = False,
+        use_checkpoint: bool = False,
+        _=Depends(deps.assert_tenant)
+) -> SyncJob:
+    params = SyncJobParams(top=top, filter=filter, delta=delta, two_phase=two_phase, use_checkpoint=use_checkpoint)
+    return sync_job_manager.submit(tenant, params, user_id=id)
+
+
+@router.get("", response_model=List[SyncJob])
+async def get_jobs(tenant: str, _=Depends(deps.assert_tenant)) -> List[SyncJob]:
+    return sync_job_manager.get_multi(tenant)
+
+
+@router.get("/{job_id}", response_model=SyncJob)
+async def get_job(tenant: str, job_id: str, _=Depends(deps.assert_tenant)) -> SyncJob:
+    job = sync_job_manager.get(job_id)
+    if job is None or job.tenant != tenant:
+        raise HTTPException(status_code=404)
+    return job
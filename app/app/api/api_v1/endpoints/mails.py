@@ -1,16 +1,18 @@
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
 from loguru import logger
 from sqlalchemy.orm import Session
 
 from app.api import deps
-from app.controllers.mail import MailController
+from app.controllers.mail import MailController, MessagesPageException, UserNotFoundException
 from app.core.auth import get_auth_config_and_confidential_client_application_and_access_token
+from app.core.cursor import InvalidCursorException, decode_seq_no_cursor, encode_seq_no_cursor
 from app.models.se_correspondence import SECorrespondence
 from app.schemas.schema_db import SECorrespondenceUpdate
 from app.schemas.schema_ms_graph import MessagesSchema, MessageResponseSchema, AttachmentsSchema, \
     SendMessageRequestSchema, UserSchema, MessageSchema
+from app.schemas.schema_sync import UserSyncResult
 
 router = APIRouter()
 
@@ -19,9 +21,13 @@ router = APIRouter()
 async def get_messages(
         tenant: str, id: str, top: int = 5, filter: str = "", _=Depends(deps.assert_tenant)
 ) -> MessagesSchema:
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
-        messages: List[MessageSchema] = await MailController.get_messages_while_nextlink(token, tenant, id, top, filter)
+        try:
+            messages: List[MessageSchema] = \
+                await MailController.get_messages_while_nextlink(token, tenant, id, top, filter)
+        except MessagesPageException as e:
+            raise HTTPException(status_code=400 if e.status == 400 else 502, detail=str(e))
         if messages is None:
             raise HTTPException(status_code=404)
         return messages
@@ -38,9 +44,9 @@ async def get_messages(
 async def get_message(
         tenant: str, id: str, message_id: str, _=Depends(deps.assert_tenant)
 ) -> MessageResponseSchema:
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
-        message: Optional[MessageResponseSchema] = await MailController.get_message(token, id, message_id)
+        message: Optional[MessageResponseSchema] = await MailController.get_message(token, tenant, id, message_id)
         if message is None:
             raise HTTPException(status_code=404)
         return message
@@ -57,9 +63,10 @@ async def get_message(
 async def list_message_attachments(
         tenant: str, id: str, message_id: str, _=Depends(deps.assert_tenant)
 ) -> AttachmentsSchema:
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
-        attachments: Optional[AttachmentsSchema] = await MailController.get_message_attachments(token, id, message_id)
+        attachments: Optional[AttachmentsSchema] = \
+            await MailController.get_message_attachments(token, tenant, id, message_id)
         return attachments
     else:
         logger.bind(
@@ -79,7 +86,7 @@ async def save_message_attachments(
         _=Depends(deps.assert_tenant),
         db: Session = Depends(deps.get_tenant_mailstore_db)
 ) -> List[str]:
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
         links = await MailController.save_message_attachments(tenant, db, token, id, message_id, internet_message_id)
         if links is None:
@@ -105,7 +112,7 @@ async def save_message_and_attachments(
         db_fit: Session = Depends(deps.get_tenant_fit_db),
         db_mailstore: Session = Depends(deps.get_tenant_mailstore_db),
 ):
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
         se_correspondence_rows, links = await MailController.save_message_and_attachments(token, tenant, id, message_id,
                                                                                           db_fit, db_mailstore)
@@ -125,15 +132,23 @@ async def save_user_messages_and_attachments(
         id: str,
         top: int = 5,
         filter="",
+        delta: bool = False,
+        two_phase: bool = False,
+        use_checkpoint: bool = False,
         _=Depends(deps.assert_tenant),
         db_fit: Session = Depends(deps.get_tenant_fit_db),
         db_mailstore: Session = Depends(deps.get_tenant_mailstore_db)
 ) -> (List[SECorrespondence], List[str]):
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
-        se_correspondence_rows, links = \
-            await MailController.save_user_messages_and_attachments(token, tenant, id, db_fit, db_mailstore, top,
-                                                                    filter)
+        try:
+            se_correspondence_rows, links = \
+                await MailController.save_user_messages_and_attachments(token, tenant, id, db_fit, db_mailstore, top,
+                                                                        filter, delta, two_phase, use_checkpoint)
+        except UserNotFoundException as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except MessagesPageException as e:
+            raise HTTPException(status_code=400 if e.status == 400 else 502, detail=str(e))
         return se_correspondence_rows, links
     else:
         logger.bind(
@@ -149,17 +164,19 @@ async def save_tenant_messages_and_attachments(
         tenant: str,
         top: int = 5,
         filter="",
+        delta: bool = False,
+        two_phase: bool = False,
+        concurrency: Optional[int] = None,
+        use_checkpoint: bool = False,
         _=Depends(deps.assert_tenant),
-        db_sales97: Session = Depends(deps.get_tenant_sales97_db),
-        db_fit: Session = Depends(deps.get_tenant_fit_db),
-        db_mailstore: Session = Depends(deps.get_tenant_mailstore_db)
-) -> (List[UserSchema], List[SECorrespondence], List[str]):
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+        db_sales97: Session = Depends(deps.get_tenant_sales97_db)
+) -> (List[UserSchema], List[SECorrespondence], List[str], List[UserSyncResult]):
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
-        users, all_rows, all_links = \
-            await MailController.save_tenant_messages_and_attachments(token, tenant, db_sales97, db_fit, db_mailstore,
-                                                                      top, filter)
-        return users, all_rows, all_links
+        users, all_rows, all_links, results = \
+            await MailController.save_tenant_messages_and_attachments(token, tenant, db_sales97, top, filter, delta,
+                                                                      two_phase, concurrency, use_checkpoint)
+        return users, all_rows, all_links, results
     else:
         logger.bind(
             error=token.get("error"),
@@ -172,16 +189,30 @@ async def save_tenant_messages_and_attachments(
 @router.get("/messages1/update")
 async def update_tenant_messages(
         tenant: str,
+        response: Response,
         skip: int = 0,
         limit: int = 100,
+        cursor: Optional[str] = None,
         _=Depends(deps.assert_tenant),
         # db_mailstore: Session = Depends(deps.get_mailstore_db)
         db_mailstore: Session = Depends(deps.get_tenant_mailstore_db)
 ) -> List[SECorrespondenceUpdate]:
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    """
+    Updates a page of rows. The next page is requested with the cursor returned in the X-Next-Cursor header
+    (absent on the last page), skip is only used without cursor.
+    """
+    try:
+        before_seq_no = decode_seq_no_cursor(cursor)
+    except InvalidCursorException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
-        se_correspondence_update: List[SECorrespondenceUpdate] = \
-            await MailController.update_tenant_messages(token, tenant, db_mailstore, skip, limit)
+        se_correspondence_update, next_before_seq_no = await MailController.update_tenant_messages(
+            token, tenant, db_mailstore, skip, limit, before_seq_no
+        )
+        next_cursor = encode_seq_no_cursor(next_before_seq_no)
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = next_cursor
         return se_correspondence_update
     else:
         logger.bind(
@@ -194,9 +225,9 @@ async def update_tenant_messages(
 
 @router.post("/users/{id}/sendMail", status_code=202)
 async def send_mail(tenant: str, id: str, message: SendMessageRequestSchema, _=Depends(deps.assert_tenant)):
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
-        result = await MailController.send_mail(token, id, message)
+        result = await MailController.send_mail(token, tenant, id, message)
         return result
     else:
         logger.bind(
@@ -0,0 +1,32 @@
+from typing import List
+
+from fastapi import APIRouter, Depends, HTTPException
+
+from app.api import deps
+from app.scheduler import job_scheduler
+from app.schemas.schema_sync import JobRun, ScheduledJobInfo
+
+router = APIRouter()
+
+
+@router.get("/jobs", response_model=List[ScheduledJobInfo])
+async def get_jobs() -> List[ScheduledJobInfo]:
+    return job_scheduler.get_jobs_info()
+
+
+@router.get("/jobs/{tenant}/runs", response_model=List[JobRun])
+async def get_job_runs(tenant: str, _=Depends(deps.assert_tenant)) -> List[JobRun]:
+    scheduled_job = job_scheduler.get_job(tenant)
+    if scheduled_job is None:
+        raise HTTPException(status_code=404)
+    return list(reversed(scheduled_job.history))
+
+
+@router.post("/jobs/{tenant}/run", response_model=JobRun, status_code=202)
+async def run_job(tenant: str, _=Depends(deps.assert_tenant)) -> JobRun:
+    if job_scheduler.get_job(tenant) is None:
+        raise HTTPException(status_code=404)
+    job_run = job_scheduler.trigger(tenant)
+    if job_run is None:
+        raise HTTPException(status_code=409, detail="Job is already running")
+    return job_run
@@ -0,0 +1,54 @@
+from typing import Any, Dict
+
+from fastapi import APIRouter
+
+from app.apiclients.rate_limiter import graph_rate_limiter
+from app.apiclients.retry_policy import retry_stats
+from app.controllers.directory import tenant_directory
+from app.controllers.mail_index import mail_unique_id_index
+from app.controllers.user import user_resolution_cache
+from app.crud.stored_procedures import stored_procedure_stats
+from app.db.db_executor import db_executor
+from app.db.db_session import tenant_engine_registry
+
+router = APIRouter()
+
+
+@router.get("/retries")
+async def get_retry_stats() -> Dict[str, Dict[str, int]]:
+    return retry_stats.snapshot()
+
+
+@router.get("/rateLimits")
+async def get_rate_limit_stats() -> Dict[str, Dict[str, float]]:
+    return graph_rate_limiter.snapshot()
+
+
+@router.get("/userCache")
+async def get_user_cache_stats() -> Dict[str, Dict[str, Any]]:
+    return user_resolution_cache.snapshot()
+
+
+@router.get("/directory")
+async def get_directory_stats() -> Dict[str, Dict[str, Any]]:
+    return tenant_directory.snapshot()
+
+
+@router.get("/dbPools")
+async def get_db_pool_stats() -> Dict[str, str]:
+    return tenant_engine_registry.snapshot()
+
+
+@router.get("/dbExecutor")
+async def get_db_executor_stats() -> Dict[str, Dict[str, int]]:
+    return db_executor.snapshot()
+
+
+@router.get("/storedProcedures")
+async def get_stored_procedure_stats() -> Dict[str, Dict[str, float]]:
+    return stored_procedure_stats.snapshot()
+
+
+@router.get("/mailIndex")
+async def get_mail_index_stats() -> Dict[str, Any]:
+    return mail_unique_id_index.snapshot()
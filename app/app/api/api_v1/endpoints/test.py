@@ -28,7 +28,7 @@ async def wait_late():
 
 @router.get("/x")
 async def run(tenant: str):
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     response, data = await ApiClient('get', config.endpoint, headers=ApiClient.get_headers(token)).retryable_call()
     return data
 
@@ -16,9 +16,9 @@ router = APIRouter()
 async def get_users(
         tenant: str, top: int = 5, select: str = "", filter: str = "", _=Depends(deps.assert_tenant)
 ) -> UsersSchema:
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
-        users_schema = await UserController.get_users(token, top, select, filter)
+        users_schema = await UserController.get_users(token, tenant, top, select, filter)
         return users_schema
     else:
         raise_http_exception(token, 401, "Unauthorized")
@@ -26,9 +26,9 @@ async def get_users(
 
 @router.get("/users/{user_id}", response_model=UserResponseSchema)
 async def get_user(tenant: str, user_id: str, _=Depends(deps.assert_tenant)) -> UserResponseSchema:
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
-        user_schema = await UserController.get_user(token, user_id)
+        user_schema = await UserController.get_user(token, tenant, user_id)
         return user_schema
     else:
         raise_http_exception(token, 401, "Unauthorized")
@@ -36,9 +36,9 @@ async def get_user(tenant: str, user_id: str, _=Depends(deps.assert_tenant)) ->
 
 @router.get("/users/emails/{user_email}", response_model=UserSchema)
 async def get_user_by_email(tenant: str, user_email: str, _=Depends(deps.assert_tenant)) -> Optional[UserSchema]:
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
-        user: Optional[UserSchema] = await UserController.get_user_by_email(token, user_email, "")
+        user: Optional[UserSchema] = await UserController.get_user_by_email(token, tenant, user_email, "")
         if user is None:
             raise HTTPException(status_code=404)
         return user
@@ -52,9 +52,9 @@ async def get_users_to_track(
         _=Depends(deps.assert_tenant),
         db_sales97: Session = Depends(deps.get_tenant_sales97_db)
 ) -> List[UserSchema]:
-    config, client_app, token = get_auth_config_and_confidential_client_application_and_access_token(tenant)
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
     if "access_token" in token:
-        users: List[UserSchema] = await UserController.get_users_to_track(token, db_sales97)
+        users: List[UserSchema] = await UserController.get_users_to_track(token, tenant, db_sales97)
         if users is None:
             raise HTTPException(status_code=404)
         return users
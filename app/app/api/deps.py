@@ -4,8 +4,7 @@ from typing import Generator
 from fastapi import HTTPException
 from fastapi.responses import Response
 
-from app.core.auth import get_confidential_client_application, get_access_token
-from app.core.config import configuration, AzureAuth
+from app.core.config import configuration
 from app.db.db_session import get_tenant_db_engine, get_db_session
 
 
@@ -15,17 +14,6 @@ def assert_tenant(tenant: str) -> bool:
         raise HTTPException(status_code=401)
     return True
 
-def get_token(tenant: str):
-    # config_dict = json.load(open('../configuration/ms_auth_configs.json'))[tenant]
-    # config = MsAuthConfig(**config_dict)
-    # client_app = get_confidential_client_application(config)
-
-    tenant_azure_auth: AzureAuth = configuration.tenant_configurations.get(tenant).azure_auth
-    client_app = get_confidential_client_application(tenant_azure_auth)
-    token = get_access_token(tenant_azure_auth, client_app)
-    return token
-
-
 def get_tenant_fit_db(tenant: str) -> Generator:
     try:
         session_local = get_db_session(
@@ -1,59 +1,132 @@
 import asyncio
-from typing import Union, Tuple, Any
+import time
+from typing import Union, Tuple, Any, Optional
+from urllib.parse import urlparse
 
 import aiohttp
 from aiohttp import ClientResponse
 from async_timeout import timeout
 from loguru import logger
 
+from app.apiclients.http_session import http_session_manager
+from app.apiclients.rate_limiter import graph_rate_limiter
+from app.apiclients.retry_policy import IDEMPOTENT_METHODS, RetryPolicy, default_retry_policy, retry_stats
+
 
 class ApiClient:
-    def __init__(self, method: str, url: str, headers=None, data=None, *, timeout_sec: int = 5, retries: int = 2):
+    def __init__(
+            self,
+            method: str,
+            url: str,
+            headers=None,
+            data=None,
+            *,
+            timeout_sec: int = 5,
+            retries: Optional[int] = None,
+            tenant: Optional[str] = None,
+            mailbox: Optional[str] = None,
+            rate_limit_cost: int = 1,
+            endpoint_name: Optional[str] = None,
+            retry_policy: RetryPolicy = default_retry_policy,
+            idempotent: Optional[bool] = None
+    ):
         self.method = method
         self.url = url
         self.headers = headers
         self.data = data
         self.timeout_sec = timeout_sec
-        self.retries = retries
+        self.retry_policy = retry_policy
+        self.retries = retries if retries is not None else retry_policy.max_attempts
+        # non idempotent calls (e.g. sendMail) are only retried when the server surely did not act on them
+        self.idempotent = idempotent if idempotent is not None else method.upper() in IDEMPOTENT_METHODS
+        # calls with a tenant go through the tenant (and mailbox) rate limiter
+        self.tenant = tenant
+        self.mailbox = mailbox
+        self.rate_limit_cost = rate_limit_cost
+        # key for retry stats, e.g. "message:list"
+        self.endpoint_name = endpoint_name or f"{method.upper()} {urlparse(url).netloc}"
 
     async def call(self) -> Union[Tuple[ClientResponse, str], Tuple[ClientResponse, bytes], Tuple[ClientResponse, dict], Tuple[ClientResponse, Any]]:
         """Returns data in response body
 
         raise: asyncio.exceptions.TimeoutError (raised implicitly by async_timeout library)
         """
+        # pooled session, must not be closed here (see HttpSessionManager)
+        session = await http_session_manager.get_session(self.tenant)
         async with timeout(self.timeout_sec) as cm:
-            async with aiohttp.ClientSession() as session:
-                async with session.request(
-                        method=self.method,
-                        url=self.url,
-                        headers=self.headers,
-                        data=self.data
-                ) as response:
-                    # logger.bind(response=response).info("ApiClient call")
-                    if response.content_type == "text/html":
-                        return response, await response.text()
-                    elif response.content_type == "text/plain":
-                        return response, await response.content.read()
-                    elif response.content_type == "application/json":
-                        return response, await response.json()
+            async with session.request(
+                    method=self.method,
+                    url=self.url,
+                    headers=self.headers,
+                    data=self.data
+            ) as response:
+                # logger.bind(response=response).info("ApiClient call")
+                if response.content_type == "text/html":
                     return response, await response.text()
+                elif response.content_type == "text/plain":
+                    return response, await response.content.read()
+                elif response.content_type == "application/json":
+                    return response, await response.json()
+                return response, await response.text()
 
     async def retryable_call(self) -> Union[Tuple[ClientResponse, str], Tuple[ClientResponse, bytes], Tuple[ClientResponse, dict], Tuple[ClientResponse, Any]]:
-        """Retries http_call on timeout error
+        """Retries http_call on timeout, connection error and retryable status (429, 503, 504..)
+
+        Waits Retry-After when the server sends it, else jittered exponential backoff.
+        Non idempotent calls are only retried on 429 and on failing to connect.
+        No retry starts after retry_policy.max_total_sec (attempts and waits included).
+        When retries run out on a retryable status, the last response is returned.
 
-        raise: asyncio.exceptions.TimeoutError
+        raise: asyncio.exceptions.TimeoutError, aiohttp.ClientConnectionError
         """
         retries = 1 if self.retries <= 0 else self.retries
         last_error = None
+        last_response: Optional[Tuple[ClientResponse, Any]] = None
 
-        for i in range(retries):
-            logger.bind(method=self.method, url=self.url).info("http call")
+        retry_stats.record_call(self.endpoint_name)
+        started_at = time.monotonic()
+        for attempt in range(1, retries + 1):
+            logger.bind(method=self.method, url=self.url, attempt=attempt).info("http call")
+            retry_after: Optional[float] = None
+            if self.tenant:
+                await graph_rate_limiter.acquire(self.tenant, self.mailbox, self.rate_limit_cost)
             try:
-                return await self.call()
-            except asyncio.exceptions.TimeoutError as e:
+                response, data = await self.call()
+            except (asyncio.exceptions.TimeoutError, aiohttp.ClientConnectionError) as e:
+                if not self.idempotent and not isinstance(e, aiohttp.ClientConnectorError):
+                    # the request may have reached the server
+                    raise
                 last_error = e
-                logger.bind(error=e).error(f"TimeoutError.. retrying.. {i+1}/{retries}")
-                continue
+                last_response = None
+                reason = type(e).__name__
+            else:
+                if not self.retry_policy.is_retryable_status(response.status, self.idempotent):
+                    if self.tenant:
+                        graph_rate_limiter.on_success(self.tenant, self.mailbox)
+                    return response, data
+                last_error = None
+                last_response = (response, data)
+                reason = str(response.status)
+                retry_after = RetryPolicy.parse_retry_after(response.headers.get("Retry-After"))
+                if self.tenant and response.status == 429:
+                    graph_rate_limiter.on_throttle(self.tenant, self.mailbox, retry_after)
+            if attempt == retries:
+                break
+            delay = self.retry_policy.get_delay(attempt, retry_after)
+            if time.monotonic() - started_at + delay > self.retry_policy.max_total_sec:
+                logger.bind(endpoint=self.endpoint_name, attempt=attempt, delay_sec=delay)\
+                    .warning("Retry would exceed max_total_sec")
+                break
+            retry_stats.record_retry(self.endpoint_name, reason)
+            logger.bind(endpoint=self.endpoint_name, reason=reason, delay_sec=delay).warning(
+                f"Retryable error.. retrying.. {attempt}/{retries}"
+            )
+            await asyncio.sleep(delay)
+        retry_stats.record_exhausted(self.endpoint_name)
+        logger.bind(endpoint=self.endpoint_name, url=self.url, error=last_error, reason=reason).error("Retries exhausted")
+        if last_response is not None:
+            # callers handle error statuses themselves
+            return last_response
         raise last_error
 
     @staticmethod
@@ -0,0 +1,109 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from app.apiclients.api_client import ApiClient
+from app.apiclients.endpoint_ms import MsEndpointHelper, MsEndpointsHelper, endpoints_ms
+from app.apiclients.rate_limiter import graph_rate_limiter
+from app.apiclients.retry_policy import IDEMPOTENT_METHODS, RetryPolicy, default_retry_policy, retry_stats
+from app.schemas.schema_endpoint_ms import MsEndpoint
+from app.schemas.schema_ms_graph import BatchRequestSchema, BatchRequestsSchema, BatchResponseSchema, \
+    BatchResponsesSchema
+
+# msgraph limit - https://docs.microsoft.com/en-us/graph/json-batching
+MAX_BATCH_SIZE = 20
+
+
+class MsBatchHelper:
+
+    @staticmethod
+    def to_batch_request(request_id: str, endpoint: MsEndpoint) -> BatchRequestSchema:
+        return BatchRequestSchema(
+            id=request_id,
+            method=endpoint.request_method.upper(),
+            url=MsEndpointHelper.form_relative_url(endpoint),
+        )
+
+    @staticmethod
+    async def call(
+            token: Any,
+            requests: List[BatchRequestSchema],
+            *,
+            tenant: Optional[str] = None,
+            mailbox: Optional[str] = None,
+            retry_policy: RetryPolicy = default_retry_policy
+    ) -> Dict[str, BatchResponseSchema]:
+        """
+        Sends requests as msgraph $batch calls of up to 20 requests each.
+        Sub-requests that fail with a retryable status are retried on their own in the next round.
+
+        :param token: Any
+        :param requests: List[BatchRequestSchema], ids must be unique
+        :param tenant: Optional[str]
+        :param mailbox: Optional[str], set when all requests target the same mailbox
+        :param retry_policy: RetryPolicy
+        :return: Dict[str, BatchResponseSchema], keyed by request id
+        """
+        pending: Dict[str, BatchRequestSchema] = {request.id: request for request in requests}
+        results: Dict[str, BatchResponseSchema] = {}
+        for attempt in range(1, retry_policy.max_attempts + 1):
+            retry_after: Optional[float] = None
+            pending_requests = list(pending.values())
+            for i in range(0, len(pending_requests), MAX_BATCH_SIZE):
+                chunk = pending_requests[i:i + MAX_BATCH_SIZE]
+                responses = await MsBatchHelper._call_chunk(token, chunk, tenant, mailbox)
+                for response in responses:
+                    if retry_policy.is_retryable_status(response.status) and attempt < retry_policy.max_attempts:
+                        retry_stats.record_retry("batch:sub_request", str(response.status))
+                        headers = response.headers or {}
+                        sub_retry_after = RetryPolicy.parse_retry_after(
+                            headers.get("Retry-After") or headers.get("retry-after")
+                        )
+                        if sub_retry_after is not None:
+                            retry_after = max(retry_after or 0.0, sub_retry_after)
+                        if tenant and response.status == 429:
+                            graph_rate_limiter.on_throttle(tenant, mailbox, sub_retry_after)
+                        continue
+                    results[response.id] = response
+                    pending.pop(response.id, None)
+            if len(pending) == 0:
+                break
+            if attempt < retry_policy.max_attempts:
+                delay = retry_policy.get_delay(attempt, retry_after)
+                logger.bind(pending=len(pending), delay_sec=delay).warning(
+                    f"Retrying batch sub-requests.. {attempt}/{retry_policy.max_attempts}"
+                )
+                await asyncio.sleep(delay)
+        if len(pending) > 0:
+            retry_stats.record_exhausted("batch:sub_request")
+            logger.bind(request_ids=list(pending.keys())).error("Batch sub-requests retries exhausted")
+        return results
+
+    @staticmethod
+    async def _call_chunk(
+            token: Any, chunk: List[BatchRequestSchema], tenant: Optional[str], mailbox: Optional[str]
+    ) -> List[BatchResponseSchema]:
+        endpoint = MsEndpointsHelper.get_endpoint("batch", endpoints_ms)
+        url = MsEndpointHelper.form_url(endpoint)
+        api_client = ApiClient(
+            endpoint.request_method,
+            url,
+            headers=ApiClient.get_headers(token),
+            data=BatchRequestsSchema(requests=chunk).json(exclude_none=True),
+            timeout_sec=120,
+            tenant=tenant,
+            mailbox=mailbox,
+            # msgraph counts every sub-request against the limits
+            rate_limit_cost=len(chunk),
+            endpoint_name="batch",
+            # $batch is a POST, but sending it again only repeats its sub-requests
+            idempotent=all(request.method.upper() in IDEMPOTENT_METHODS for request in chunk)
+        )
+        api_client.headers['content-type'] = "application/json"
+        response, data = await api_client.retryable_call()
+        try:
+            return BatchResponsesSchema(**data).responses
+        except Exception as e:
+            logger.bind(status=response.status, data=data).error(f"Error in converting dict to BatchResponsesSchema: {e}")
+            return []
@@ -1,15 +1,25 @@
 import json
+from urllib.parse import quote
 
 from loguru import logger
 
 from app.core.settings import settings
 from app.schemas.schema_endpoint_ms import MsEndpoint, MsEndpoints
+from app.schemas.schema_ms_graph import MessageProjection, MESSAGE_PROJECTION_SCHEMAS
+
+# kept as is in query values, odata syntax reads better and graph accepts it unencoded
+QUERY_VALUE_SAFE_CHARS = "',()/:$=@*!;"
 
 
 class MsEndpointHelper:
     @staticmethod
     def form_url(endpoint: MsEndpoint):
-        result_url = "" + endpoints_ms.base_url + endpoint.request_path_template
+        return endpoints_ms.base_url + MsEndpointHelper.form_relative_url(endpoint)
+
+    @staticmethod
+    def form_relative_url(endpoint: MsEndpoint):
+        """Url relative to base_url, as used by sub-requests of a $batch request"""
+        result_url = "" + endpoint.request_path_template
         # request params
         if endpoint.request_params:
             for param_name, param_value in endpoint.request_params.items():
@@ -19,6 +29,8 @@ class MsEndpointHelper:
             is_first_param_added: bool = False
             for param_name, param_value in endpoint.optional_query_params.dict().items():
                 if param_value and param_value != '':
+                    # e.g. internetMessageIds in $filter contain + & # < >
+                    param_value = quote(str(param_value), safe=QUERY_VALUE_SAFE_CHARS)
                     if is_first_param_added is False:
                         result_url = f"{result_url}?${param_name}={param_value}"
                         is_first_param_added = True
@@ -26,6 +38,14 @@ class MsEndpointHelper:
                         result_url = f"{result_url}&${param_name}={param_value}"
         return result_url
 
+    @staticmethod
+    def get_message_select(projection: MessageProjection) -> str:
+        """$select of a message projection, built from the fields of its schema ("" for full)"""
+        if projection == MessageProjection.full:
+            return ""
+        schema = MESSAGE_PROJECTION_SCHEMAS[projection]
+        return ",".join(field.alias for field in schema.__fields__.values() if not field.alias.startswith("@"))
+
     @staticmethod
     def build_filter(filter: str = "", *, to_add) -> str:
         new_filter = filter
@@ -58,7 +78,8 @@ class MsEndpointsHelper:
 
     @staticmethod
     def get_endpoint(endpoint_name: str, ms_endpoints: MsEndpoints) -> MsEndpoint:
-        return ms_endpoints.endpoints.get(endpoint_name).copy()
+        # deep, callers set query params on the copy and must not change the loaded endpoint
+        return ms_endpoints.endpoints.get(endpoint_name).copy(deep=True)
 
 
 # endpoints_ms # TODO: move
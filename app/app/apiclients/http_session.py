@@ -0,0 +1,107 @@
+import asyncio
+from typing import Dict, Optional
+
+import aiohttp
+from loguru import logger
+
+from app.core.settings import settings
+
+
+class HttpSessionManager:
+    """
+    Registry of long-lived aiohttp.ClientSession objects.
+
+    Each session owns a keep-alive connection pool, so consecutive calls to the same host reuse
+    the already open TCP/TLS connection instead of doing DNS + TCP + TLS setup on every request.
+    Sessions are per process (key `default`) or per tenant when `HTTP_SESSION_PER_TENANT` is set.
+    """
+    DEFAULT_KEY = "default"
+
+    def __init__(
+            self,
+            *,
+            limit: int = settings.HTTP_POOL_LIMIT,
+            limit_per_host: int = settings.HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout: float = settings.HTTP_KEEPALIVE_TIMEOUT,
+            dns_cache_ttl: int = settings.HTTP_DNS_CACHE_TTL,
+            per_tenant: bool = settings.HTTP_SESSION_PER_TENANT
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.per_tenant = per_tenant
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._loops: Dict[str, asyncio.AbstractEventLoop] = {}
+
+    def get_key(self, tenant: Optional[str] = None) -> str:
+        if self.per_tenant and tenant:
+            return tenant
+        return HttpSessionManager.DEFAULT_KEY
+
+    async def get_session(self, tenant: Optional[str] = None) -> aiohttp.ClientSession:
+        """
+        Returns the pooled session for tenant, creating it on first use
+
+        :param tenant: Optional[str]
+        :return: aiohttp.ClientSession
+        """
+        key = self.get_key(tenant)
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(key)
+        # a session is bound to the loop it was created in (e.g. asyncio.run in scripts)
+        if session is None or session.closed or self._loops.get(key) is not loop:
+            if session is not None and not session.closed:
+                await self._close_replaced(key, session, self._loops.get(key))
+            session = self._build_session()
+            self._sessions[key] = session
+            self._loops[key] = loop
+            logger.bind(key=key, limit=self.limit, limit_per_host=self.limit_per_host).info("Created http session")
+        return session
+
+    @staticmethod
+    async def _close_replaced(
+            key: str, session: aiohttp.ClientSession, session_loop: Optional[asyncio.AbstractEventLoop]
+    ) -> None:
+        """Closes a session of another loop, so its connector and connections are not leaked"""
+        if session_loop is not None and session_loop.is_running():
+            # the loop still runs in another thread, the session has to be closed there
+            asyncio.run_coroutine_threadsafe(session.close(), session_loop)
+            return
+        try:
+            await session.close()
+        except Exception as e:
+            # connections of a closed loop can not be closed gracefully, they are dropped
+            logger.bind(key=key, error=e).warning(f"Could not close replaced http session: {e}")
+        logger.bind(key=key).info("Closed replaced http session")
+
+    def _build_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        return aiohttp.ClientSession(connector=connector)
+
+    async def startup(self) -> None:
+        await self.get_session()
+
+    async def close(self, tenant: Optional[str] = None) -> None:
+        key = self.get_key(tenant)
+        session = self._sessions.pop(key, None)
+        self._loops.pop(key, None)
+        if session is not None and not session.closed:
+            await session.close()
+            logger.bind(key=key).info("Closed http session")
+
+    async def close_all(self) -> None:
+        for key in list(self._sessions.keys()):
+            session = self._sessions.pop(key)
+            self._loops.pop(key, None)
+            if not session.closed:
+                await session.close()
+        logger.bind().info("Closed all http sessions")
+
+
+http_session_manager = HttpSessionManager()
@@ -0,0 +1,140 @@
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
+
+from app.core.config import configuration, RateLimit
+
+
+class TokenBucket:
+    """
+    Async token bucket with AIMD rate adjustment.
+
+    The rate is cut by decrease_factor on every throttle and grows back additively on every success,
+    so it settles just below the point where the server starts throttling.
+    """
+
+    def __init__(
+            self,
+            rate: float,
+            capacity: float,
+            *,
+            min_rate: float,
+            decrease_factor: float = 0.5,
+            increase_per_success: float = 0.05
+    ):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min(min_rate, rate)
+        self.decrease_factor = decrease_factor
+        self.increase_per_success = increase_per_success
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, tokens: float = 1) -> None:
+        """Waits until tokens are available (callers are served in FIFO order)"""
+        tokens = min(tokens, self.capacity)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> None:
+        now = time.monotonic()
+        self._refill(now)
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.tokens = 0
+        if retry_after is not None:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def on_success(self) -> None:
+        if self.rate < self.max_rate:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.increase_per_success)
+
+
+class GraphRateLimiter:
+    """Token buckets for msgraph calls, one per tenant and one per (tenant, mailbox)"""
+
+    def __init__(self):
+        self._tenant_buckets: Dict[str, TokenBucket] = {}
+        self._mailbox_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+    @staticmethod
+    def get_rate_limit(tenant: str) -> RateLimit:
+        tenant_configuration = configuration.tenant_configurations.get(tenant)
+        return tenant_configuration.rate_limit if tenant_configuration is not None else RateLimit()
+
+    def get_tenant_bucket(self, tenant: str) -> TokenBucket:
+        bucket = self._tenant_buckets.get(tenant)
+        if bucket is None:
+            rate_limit = GraphRateLimiter.get_rate_limit(tenant)
+            bucket = TokenBucket(
+                rate_limit.tenant_requests_per_sec,
+                rate_limit.tenant_burst,
+                min_rate=rate_limit.min_requests_per_sec,
+                decrease_factor=rate_limit.decrease_factor,
+                increase_per_success=rate_limit.increase_per_success
+            )
+            self._tenant_buckets[tenant] = bucket
+        return bucket
+
+    def get_mailbox_bucket(self, tenant: str, mailbox: str) -> TokenBucket:
+        bucket = self._mailbox_buckets.get((tenant, mailbox))
+        if bucket is None:
+            rate_limit = GraphRateLimiter.get_rate_limit(tenant)
+            bucket = TokenBucket(
+                rate_limit.mailbox_requests_per_sec,
+                rate_limit.mailbox_burst,
+                min_rate=rate_limit.min_requests_per_sec,
+                decrease_factor=rate_limit.decrease_factor,
+                increase_per_success=rate_limit.increase_per_success
+            )
+            self._mailbox_buckets[(tenant, mailbox)] = bucket
+        return bucket
+
+    async def acquire(self, tenant: str, mailbox: Optional[str] = None, tokens: float = 1) -> None:
+        # mailbox first, so waiting on a busy mailbox does not hold tenant tokens
+        if mailbox:
+            await self.get_mailbox_bucket(tenant, mailbox).acquire(tokens)
+        await self.get_tenant_bucket(tenant).acquire(tokens)
+
+    def on_throttle(self, tenant: str, mailbox: Optional[str] = None, retry_after: Optional[float] = None) -> None:
+        bucket = self.get_mailbox_bucket(tenant, mailbox) if mailbox else self.get_tenant_bucket(tenant)
+        bucket.on_throttle(retry_after)
+        logger.bind(tenant=tenant, mailbox=mailbox, rate=bucket.rate, retry_after=retry_after).warning(
+            "Throttled by msgraph, lowered request rate"
+        )
+
+    def on_success(self, tenant: str, mailbox: Optional[str] = None) -> None:
+        if mailbox:
+            self.get_mailbox_bucket(tenant, mailbox).on_success()
+        self.get_tenant_bucket(tenant).on_success()
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        snapshot: Dict[str, Dict[str, float]] = {}
+        for tenant, bucket in self._tenant_buckets.items():
+            snapshot[tenant] = {"rate": bucket.rate, "max_rate": bucket.max_rate}
+        for (tenant, mailbox), bucket in self._mailbox_buckets.items():
+            snapshot[f"{tenant}/{mailbox}"] = {"rate": bucket.rate, "max_rate": bucket.max_rate}
+        return snapshot
+
+
+graph_rate_limiter = GraphRateLimiter()
@@ -0,0 +1,100 @@
+import random
+from collections import defaultdict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional, Iterable, Dict
+
+from app.core.settings import settings
+
+# Graph returns these when throttling (429) or when a backend is briefly unavailable
+# https://docs.microsoft.com/en-us/graph/throttling
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+# sending these twice has the same effect as sending them once
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class RetryPolicy:
+    def __init__(
+            self,
+            *,
+            max_attempts: int = settings.HTTP_RETRY_MAX_ATTEMPTS,
+            base_delay_sec: float = settings.HTTP_RETRY_BASE_DELAY_SEC,
+            max_delay_sec: float = settings.HTTP_RETRY_MAX_DELAY_SEC,
+            max_total_sec: float = settings.HTTP_RETRY_MAX_TOTAL_SEC,
+            retryable_statuses: Iterable[int] = RETRYABLE_STATUSES
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay_sec = base_delay_sec
+        self.max_delay_sec = max_delay_sec
+        self.max_total_sec = max_total_sec
+        self.retryable_statuses = set(retryable_statuses)
+
+    def is_retryable_status(self, status: int, idempotent: bool = True) -> bool:
+        if not idempotent:
+            # a throttled request was not processed, any other error may come after the server acted on it
+            return status == 429
+        return status in self.retryable_statuses
+
+    def get_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Seconds to wait before the next attempt
+
+        Retry-After sent by the server wins, else exponential backoff with full jitter.
+
+        :param attempt: int, 1 for the first attempt
+        :param retry_after: Optional[float]
+        :return: float
+        """
+        if retry_after is not None:
+            return min(max(retry_after, 0.0), self.max_delay_sec)
+        backoff = min(self.max_delay_sec, self.base_delay_sec * (2 ** (attempt - 1)))
+        return random.uniform(0, backoff)
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """
+        Retry-After is either delay-seconds or an HTTP-date
+
+        :param value: Optional[str]
+        :return: Optional[float]
+        """
+        if value is None or value == "":
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+
+class RetryStats:
+    """Per endpoint retry counters"""
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def record_call(self, endpoint: str) -> None:
+        self._stats[endpoint]["calls"] += 1
+
+    def record_retry(self, endpoint: str, reason: str) -> None:
+        self._stats[endpoint]["retries"] += 1
+        self._stats[endpoint][f"retries_{reason}"] += 1
+
+    def record_exhausted(self, endpoint: str) -> None:
+        self._stats[endpoint]["exhausted"] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {endpoint: dict(counters) for endpoint, counters in self._stats.items()}
+
+    def reset(self) -> None:
+        self._stats.clear()
+
+
+default_retry_policy = RetryPolicy()
+retry_stats = RetryStats()
@@ -0,0 +1,178 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from app.apiclients.api_client import ApiClient
+from app.apiclients.endpoint_ms import MsEndpointsHelper, endpoints_ms, MsEndpointHelper
+from app.core.auth import get_auth_config_and_confidential_client_application_and_access_token
+from app.core.settings import settings
+from app.schemas.schema_ms_graph import UsersSchema, UserSchema
+
+# only what address resolution needs
+DIRECTORY_SELECT = "id,mail,userPrincipalName,proxyAddresses"
+DIRECTORY_PAGE_SIZE = 999
+# after a failed build lookups fall back to msgraph for this long, instead of every lookup trying to build again
+BUILD_RETRY_SEC = 60
+
+
+class DirectorySnapshot:
+    """The users of a tenant, indexed by every address they receive mail at (lowercase)"""
+
+    def __init__(self, users: List[UserSchema]):
+        self.built_at = datetime.utcnow()
+        self._built_at_monotonic = time.monotonic()
+        self.users_by_id: Dict[str, UserSchema] = {}
+        self.users_by_address: Dict[str, UserSchema] = {}
+        for user in users:
+            if not user.id:
+                continue
+            self.users_by_id[user.id] = user
+            for address in DirectorySnapshot.get_addresses(user):
+                self.users_by_address[address] = user
+
+    @staticmethod
+    def get_addresses(user: UserSchema) -> List[str]:
+        addresses: List[str] = [user.mail.lower()] if user.mail else []
+        for proxy_address in user.proxyAddresses or []:
+            # "SMTP:" is the primary address, "smtp:" the aliases, other types (x500:, sip:, ..) are not mail
+            if proxy_address.lower().startswith("smtp:"):
+                addresses.append(proxy_address[5:].lower())
+        return addresses
+
+    def get_age_sec(self) -> float:
+        return time.monotonic() - self._built_at_monotonic
+
+    def get_user(self, address: str) -> Optional[UserSchema]:
+        return self.users_by_address.get(address.strip().lower())
+
+    def get_info(self) -> Dict[str, Any]:
+        return {
+            "built_at": self.built_at.isoformat(),
+            "users": len(self.users_by_id),
+            "addresses": len(self.users_by_address),
+        }
+
+
+class TenantDirectory:
+    """
+    Directory snapshot of every tenant, built by paging user:list once and refreshed in the background,
+    so users can be resolved and addresses classified internal / external without msgraph calls.
+    A snapshot older than settings.DIRECTORY_MAX_AGE_SEC is not used, callers fall back to msgraph lookups.
+    """
+
+    def __init__(self):
+        self._snapshots: Dict[str, DirectorySnapshot] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._failed_at: Dict[str, float] = {}
+        self._tenants: List[str] = []  # tenants refreshed in the background
+        self._task: Optional[asyncio.Task] = None
+
+    def get_snapshot(self, tenant: str) -> Optional[DirectorySnapshot]:
+        """The snapshot of tenant if there is a usable one, never calls msgraph"""
+        if not settings.DIRECTORY_SNAPSHOT_ENABLED:
+            return None
+        snapshot = self._snapshots.get(tenant)
+        if snapshot is None or snapshot.get_age_sec() > settings.DIRECTORY_MAX_AGE_SEC:
+            return None
+        return snapshot
+
+    async def get_or_build_snapshot(self, token: Any, tenant: str) -> Optional[DirectorySnapshot]:
+        """The snapshot of tenant, built now if there is no usable one. None if it cannot be built."""
+        if not settings.DIRECTORY_SNAPSHOT_ENABLED:
+            return None
+        if tenant not in self._tenants:
+            self._tenants.append(tenant)
+            self.ensure_started()
+        snapshot = self.get_snapshot(tenant)
+        if snapshot is not None:
+            return snapshot
+        lock = self._locks.setdefault(tenant, asyncio.Lock())
+        async with lock:
+            # built by whoever held the lock before us
+            snapshot = self.get_snapshot(tenant)
+            if snapshot is not None:
+                return snapshot
+            if time.monotonic() - self._failed_at.get(tenant, -BUILD_RETRY_SEC) < BUILD_RETRY_SEC:
+                return None
+            try:
+                return await self.refresh(token, tenant)
+            except Exception as e:
+                self._failed_at[tenant] = time.monotonic()
+                logger.bind(tenant=tenant, error=e).error(f"Could not build directory snapshot: {e}")
+                return None
+
+    async def refresh(self, token: Any, tenant: str) -> DirectorySnapshot:
+        users = await TenantDirectory.get_all_users(token, tenant)
+        snapshot = DirectorySnapshot(users)
+        self._snapshots[tenant] = snapshot
+        logger.bind(tenant=tenant, **snapshot.get_info()).info("Built directory snapshot")
+        return snapshot
+
+    @staticmethod
+    async def get_all_users(token: Any, tenant: str) -> List[UserSchema]:
+        endpoint = MsEndpointsHelper.get_endpoint("user:list", endpoints_ms)
+        endpoint.optional_query_params.top = DIRECTORY_PAGE_SIZE
+        endpoint.optional_query_params.select = DIRECTORY_SELECT
+        # every user, whatever other lookups set on the endpoint
+        endpoint.optional_query_params.filter = None
+        endpoint.optional_query_params.orderby = None
+        url: Optional[str] = MsEndpointHelper.form_url(endpoint)
+        users: List[UserSchema] = []
+        while url:
+            response, data = await ApiClient(
+                'get', url, headers=ApiClient.get_headers(token), timeout_sec=60, tenant=tenant,
+                endpoint_name="user:list"
+            ).retryable_call()
+            if not isinstance(data, dict) or "value" not in data:
+                # a partial directory would turn real users into external addresses
+                raise RuntimeError(f"Cannot list users, status {response.status if response else None}")
+            users_schema = UsersSchema(**data)
+            users.extend(users_schema.value or [])
+            url = users_schema.odata_nextLink
+        return users
+
+    def start(self, tenants: List[str]) -> None:
+        for tenant in tenants:
+            if tenant not in self._tenants:
+                self._tenants.append(tenant)
+        self.ensure_started()
+
+    def ensure_started(self) -> None:
+        if not settings.DIRECTORY_SNAPSHOT_ENABLED:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._refresh_loop())
+
+    async def _refresh_loop(self) -> None:
+        # first snapshots are built by the first lookups, the loop only keeps them fresh
+        while True:
+            await asyncio.sleep(min(60, settings.DIRECTORY_REFRESH_SEC))
+            for tenant in list(self._tenants):
+                snapshot = self._snapshots.get(tenant)
+                if snapshot is not None and snapshot.get_age_sec() < settings.DIRECTORY_REFRESH_SEC:
+                    continue
+                try:
+                    config, client_app, token = \
+                        await get_auth_config_and_confidential_client_application_and_access_token(tenant)
+                    if token is None or "access_token" not in token:
+                        raise RuntimeError(f"Unauthorized: {token.get('error_description') if token else None}")
+                    await self.refresh(token, tenant)
+                except Exception as e:
+                    # the old snapshot stays in use until it is older than DIRECTORY_MAX_AGE_SEC
+                    logger.bind(tenant=tenant, error=e).error(f"Could not refresh directory snapshot: {e}")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {tenant: snapshot.get_info() for tenant, snapshot in self._snapshots.items()}
+
+
+tenant_directory = TenantDirectory()
@@ -1,9 +1,10 @@
+import asyncio
 import base64
 import re
 import time
 from datetime import datetime
 from io import BytesIO
-from typing import Any, Optional, List, Tuple
+from typing import Any, Optional, List, Tuple, Dict, AsyncGenerator
 
 from aiohttp import ClientResponse
 from loguru import logger
@@ -11,24 +12,81 @@ from sqlalchemy.orm import Session
 from fastapi.responses import JSONResponse
 
 from app.apiclients.api_client import ApiClient
+from app.apiclients.batch_ms import MsBatchHelper
 from app.apiclients.endpoint_ms import MsEndpointHelper, MsEndpointsHelper, endpoints_ms
 from app.apiclients.file_client import FileHelper
+from app.controllers.directory import tenant_directory
+from app.controllers.mail_index import mail_unique_id_index
+from app.controllers.shard import mailbox_shard_coordinator
 from app.controllers.user import UserController
 # from app.core.auth import get_ms_auth_config, MsAuthConfig
-from app.core.config import configuration, MailIntegrateJobDependency, AzureAuth
+from app.core.config import configuration, MailIntegrateJobDependency, AzureAuth, \
+    DEFAULT_DELTA_FOLDERS
+from app.core.auth import msal_client_registry
+from app.core.pipeline import PipelineStage, run_pipeline
+from app.core.settings import settings
+from app.crud.crud_mailbox_checkpoint import CRUDMailboxCheckpoint
+from app.crud.crud_mailbox_delta_token import CRUDMailboxDeltaToken
 from app.crud.crud_se_correspondence import CRUDSECorrespondence
 from app.crud.stored_procedures import StoredProcedures
+from app.db.db_executor import db_executor
+from app.db.db_session import tenant_db_session
+from app.models.mailbox_checkpoint import MailboxCheckpoint
+from app.models.mailbox_delta_token import MailboxDeltaToken
 from app.models.se_correspondence import SECorrespondence
 from app.schemas.schema_db import SECorrespondenceCreate, SECorrespondenceUpdate
+from app.schemas.schema_endpoint_ms import MsEndpoint
 from app.schemas.schema_ms_graph import MessageResponseSchema, MessageSchema, MessagesSchema, AttachmentsSchema, \
-    AttachmentSchema, UserResponseSchema, SendMessageRequestSchema, UserSchema
+    AttachmentSchema, UserResponseSchema, SendMessageRequestSchema, UserSchema, BatchRequestSchema, MessagesDeltaSchema, \
+    MessageProjection, MessageHeaderSchema, MessagePersistSchema, MessageBodySchema, MESSAGE_PROJECTION_PAGE_SCHEMAS
 from app.schemas.schema_sp import EmailTrackerGetEmailLinkInfo, EmailTrackerGetEmailLinkInfoParams
+from app.schemas.schema_sync import UserSyncResult, SyncProgress
+
+
+# internetMessageIds or'd in the $filter of one conversation id backfill request
+BACKFILL_IDS_PER_REQUEST = 10
+
+# tenant -> lock around saving SECorrespondence rows, see MailController.save_rows
+_save_locks: Dict[str, asyncio.Lock] = {}
+
+
+class DeltaTokenExpiredException(Exception):
+    pass
+
+
+class UserNotFoundException(Exception):
+    pass
+
+
+class MessagesPageException(Exception):
+    """msgraph answered a page of messages with an error, the listing can not go on"""
+
+    def __init__(self, status: int, data: Any):
+        super().__init__(f"Could not get messages page, status {status}: {data}")
+        self.status = status
+        self.data = data
+
+
+class MessagesPage:
+    """A page of listed messages and what the sync pipeline stages made of it"""
+
+    def __init__(self, messages_schema: MessagesDeltaSchema, folder_id: Optional[str] = None):
+        self.messages_schema = messages_schema
+        self.folder_id = folder_id  # delta mode only
+        self.messages: List[MessageHeaderSchema] = messages_schema.value or []
+        self.obj_ins: List[SECorrespondenceCreate] = []
+        self.rows: List[SECorrespondence] = []
+        self.links: List[str] = []
+        self.is_complete = True  # False if some message bodies could not be fetched
 
 
 class MailController:
 
     @staticmethod
-    async def get_messages(token: Any, tenant: str, user_id: str, top: int, filter: str) -> Optional[MessagesSchema]:
+    async def get_messages(
+            token: Any, tenant: str, user_id: str, top: int, filter: str,
+            projection: MessageProjection = MessageProjection.full
+    ) -> Optional[MessagesSchema]:
         """
         Queries msgraph to get messages
 
@@ -37,24 +95,40 @@ class MailController:
         :param user_id: str
         :param top: int
         :param filter: str
+        :param projection: MessageProjection, fields to $select
         :return: Optional[MessagesSchema]
         """
+        endpoint = MailController._get_messages_endpoint(user_id, top, filter, projection)
+        url = MsEndpointHelper.form_url(endpoint)
+        api_client = ApiClient(
+            endpoint.request_method, url, headers=ApiClient.get_headers(token), timeout_sec=30, tenant=tenant,
+            mailbox=user_id, endpoint_name="message:list"
+        )
+        response, data = await api_client.retryable_call()
+        try:
+            return MESSAGE_PROJECTION_PAGE_SCHEMAS[projection](**data)
+        except Exception as e:
+            logger.bind(data=data).error("Error in converting dict to MessagesSchema")
+
+    @staticmethod
+    def _get_messages_endpoint(
+            user_id: str, top: int, filter: str, projection: MessageProjection = MessageProjection.full, orderby: str = ""
+    ) -> MsEndpoint:
         endpoint = MsEndpointsHelper.get_endpoint("message:list", endpoints_ms)
         endpoint.request_params['id'] = user_id
         endpoint.optional_query_params.top = str(top) if 0 < top <= 1000 else str(10)
+        endpoint.optional_query_params.select = MsEndpointHelper.get_message_select(projection)
+        endpoint.optional_query_params.orderby = orderby
         new_filter = filter  # add_filter_to_leave_out_internal_domain_messages(tenant, filter)
         if new_filter != "":
             endpoint.optional_query_params.filter = new_filter
-        url = MsEndpointHelper.form_url(endpoint)
-        api_client = ApiClient(endpoint.request_method, url, headers=ApiClient.get_headers(token), timeout_sec=30)
-        response, data = await api_client.retryable_call()
-        try:
-            return MessagesSchema(**data)
-        except Exception as e:
-            logger.bind(data=data).error("Error in converting dict to MessagesSchema")
+        return endpoint
 
     @staticmethod
-    async def get_messages_while_nextlink(token: Any, tenant: str, user_id: str, top: int, filter: str) -> List[MessageSchema]:
+    async def get_messages_while_nextlink(
+            token: Any, tenant: str, user_id: str, top: int, filter: str,
+            projection: MessageProjection = MessageProjection.full
+    ) -> List[MessageSchema]:
         """
         Continuously queries in msgraph for messages
 
@@ -63,37 +137,232 @@ class MailController:
         :param user_id: str
         :param top: int
         :param filter: str
-        :return: List[MessageSchema]
-        """
-        # messages: List[MessageSchema] = []
-        messages_schema: Optional[MessagesSchema] = await MailController.get_messages(token, tenant, user_id, top, filter)
-        messages = messages_schema.value
-        while messages is not None and messages_schema.odata_nextLink:
-            api_client = ApiClient('get', messages_schema.odata_nextLink, headers=ApiClient.get_headers(token), timeout_sec=30)
-            response, data = await api_client.retryable_call()
-            messages_schema = MessagesSchema(**data)
+        :param projection: MessageProjection, fields to $select
+        :return: List[MessageSchema], or the lighter schema of projection
+        """
+        messages: List[MessageSchema] = []
+        async for messages_schema in MailController.iter_messages_pages(
+                token, tenant, user_id, top, filter, projection
+        ):
             messages.extend(messages_schema.value)
-
         return messages
 
     @staticmethod
-    async def get_message(token: Any, user_id: str, message_id: str) -> Optional[MessageResponseSchema]:
+    async def iter_messages_pages(
+            token: Any, tenant: str, user_id: str, top: int, filter: str,
+            projection: MessageProjection = MessageProjection.full,
+            orderby: str = "",
+            next_link: Optional[str] = None
+    ) -> AsyncGenerator[MessagesSchema, None]:
+        """
+        Yields msgraph messages page by page, following nextLink
+
+        :param token: Any
+        :param tenant: str
+        :param user_id: str
+        :param top: int
+        :param filter: str
+        :param projection: MessageProjection, fields to $select
+        :param orderby: str
+        :param next_link: Optional[str], resume a listing from this page instead of the first one
+        :return: AsyncGenerator[MessagesSchema, None]
+        """
+        if next_link:
+            url = next_link
+        else:
+            endpoint = MailController._get_messages_endpoint(user_id, top, filter, projection, orderby)
+            url = MsEndpointHelper.form_url(endpoint)
+        first_page = await MailController._get_messages_page(
+            token, tenant, user_id, url, endpoint_name="message:list", projection=projection
+        )
+        async for messages_schema in MailController._iter_pages(
+                token, tenant, user_id, first_page, endpoint_name="message:list", projection=projection
+        ):
+            yield messages_schema
+
+    @staticmethod
+    async def iter_messages_pages_from_checkpoint(
+            token: Any, tenant: str, user_id: str, db_mailstore: Session, top: int, filter: str,
+            projection: MessageProjection = MessageProjection.full,
+            orderby: str = "",
+            next_link: Optional[str] = None
+    ) -> AsyncGenerator[MessagesSchema, None]:
+        """
+        iter_messages_pages resuming from the next_link of the MailboxCheckpoint. A next_link msgraph rejects
+        (e.g. an expired skip token) is removed from the checkpoint and the listing starts over from filter,
+        else every later run would resume from it and fail.
+
+        :param token: Any
+        :param tenant: str
+        :param user_id: str
+        :param db_mailstore: Session
+        :param top: int
+        :param filter: str
+        :param projection: MessageProjection, fields to $select
+        :param orderby: str
+        :param next_link: Optional[str], NextLink of the MailboxCheckpoint
+        :return: AsyncGenerator[MessagesSchema, None]
+        """
+        if next_link:
+            pages = MailController.iter_messages_pages(
+                token, tenant, user_id, top, filter, projection, orderby, next_link
+            )
+            try:
+                first_page = await pages.__anext__()
+            except StopAsyncIteration:
+                return
+            except MessagesPageException as e:
+                logger.bind(tenant=tenant, user_id=user_id, status=e.status)\
+                    .warning("Checkpoint next link rejected, listing from the start")
+                await db_executor.run(db_mailstore, MailController.remove_checkpoint_next_link, user_id)
+            else:
+                try:
+                    yield first_page
+                    async for messages_schema in pages:
+                        yield messages_schema
+                finally:
+                    await pages.aclose()
+                return
+        pages = MailController.iter_messages_pages(token, tenant, user_id, top, filter, projection, orderby, None)
+        try:
+            async for messages_schema in pages:
+                yield messages_schema
+        finally:
+            await pages.aclose()
+
+    @staticmethod
+    async def _get_messages_page(
+            token: Any,
+            tenant: str,
+            user_id: str,
+            url: str,
+            *,
+            endpoint_name: str,
+            page_size: Optional[int] = None,
+            projection: MessageProjection = MessageProjection.full
+    ) -> MessagesDeltaSchema:
+        """
+        Gets one page of messages (list or delta), parsed with the page schema of projection
+
+        raise: DeltaTokenExpiredException, MessagesPageException
+        """
+        api_client = ApiClient(
+            'get', url, headers=ApiClient.get_headers(token), timeout_sec=30, tenant=tenant, mailbox=user_id,
+            endpoint_name=endpoint_name
+        )
+        if page_size is not None:
+            api_client.headers['Prefer'] = f"odata.maxpagesize={page_size}"
+        response, data = await api_client.retryable_call()
+        if is_delta_token_expired(response.status, data):
+            raise DeltaTokenExpiredException(f"Delta token expired for user {user_id}")
+        # an error is not an empty page, it would end the listing as if it completed
+        if response.status != 200 or not isinstance(data, dict) or "value" not in data:
+            raise MessagesPageException(response.status, data)
+        # deleted messages come back in delta as {"id": .., "@removed": {..}}
+        data["value"] = [value for value in data["value"] if "@removed" not in value]
+        return MESSAGE_PROJECTION_PAGE_SCHEMAS[projection](**data)
+
+    @staticmethod
+    async def _iter_pages(
+            token: Any,
+            tenant: str,
+            user_id: str,
+            first_page: MessagesDeltaSchema,
+            *,
+            endpoint_name: str,
+            page_size: Optional[int] = None,
+            projection: MessageProjection = MessageProjection.full
+    ) -> AsyncGenerator[MessagesDeltaSchema, None]:
+        """
+        Yields first_page and the pages after it.
+        The next page is downloaded while the caller processes the current one, so at most 2 pages are in memory.
+        """
+        messages_schema = first_page
+        while True:
+            next_page_task: Optional[asyncio.Future] = None
+            if messages_schema.odata_nextLink:
+                next_page_task = asyncio.ensure_future(MailController._get_messages_page(
+                    token, tenant, user_id, messages_schema.odata_nextLink, endpoint_name=endpoint_name,
+                    page_size=page_size, projection=projection
+                ))
+            try:
+                yield messages_schema
+            except BaseException:
+                # caller stopped iterating early (generator closed) or failed
+                if next_page_task is not None and not next_page_task.done():
+                    next_page_task.cancel()
+                raise
+            if next_page_task is None:
+                return
+            messages_schema = await next_page_task
+
+    @staticmethod
+    async def get_message(token: Any, tenant: str, user_id: str, message_id: str) -> Optional[MessageResponseSchema]:
         """
         Query msgraph to get message for a messageId
 
         :param token: Any
+        :param tenant: str
         :param user_id: str
         :param message_id: str
         :return: Optional[MessageResponseSchema]
         """
-        endpoint = MsEndpointsHelper.get_endpoint("message:get", endpoints_ms)
-        endpoint.request_params["id"] = user_id
-        endpoint.request_params["message_id"] = message_id
+        endpoint = MailController._get_message_endpoint(user_id, message_id)
         url = MsEndpointHelper.form_url(endpoint)
-        api_client = ApiClient(endpoint.request_method, url, headers=ApiClient.get_headers(token), timeout_sec=30)
+        api_client = ApiClient(
+            endpoint.request_method, url, headers=ApiClient.get_headers(token), timeout_sec=30, tenant=tenant,
+            mailbox=user_id, endpoint_name="message:get"
+        )
         response, data = await api_client.retryable_call()
         return MessageResponseSchema(**data) if type(data) == dict else data
 
+    @staticmethod
+    def _get_message_endpoint(user_id: str, message_id: str, select: str = "") -> MsEndpoint:
+        endpoint = MsEndpointsHelper.get_endpoint("message:get", endpoints_ms)
+        endpoint.request_params["id"] = user_id
+        endpoint.request_params["message_id"] = message_id
+        endpoint.optional_query_params.select = select
+        return endpoint
+
+    @staticmethod
+    async def fetch_message_bodies(
+            token: Any,
+            tenant: str,
+            user_id: str,
+            messages: List[MessageHeaderSchema],
+            obj_ins: List[SECorrespondenceCreate]
+    ) -> (List[SECorrespondenceCreate], bool):
+        """
+        Second phase of a two-phase fetch: downloads the body of the messages that survived classification,
+        as $batch calls, and fills MailBody1
+
+        :param token: Any
+        :param tenant: str
+        :param user_id: str
+        :param messages: List[MessageHeaderSchema], the listed messages obj_ins were made from
+        :param obj_ins: List[SECorrespondenceCreate]
+        :return: (List[SECorrespondenceCreate], bool), the obj_ins with a body and whether none was left out
+        """
+        message_ids: Dict[str, str] = {message.internetMessageId: message.id for message in messages}
+        requests: List[BatchRequestSchema] = []
+        for i, obj_in in enumerate(obj_ins):
+            endpoint = MailController._get_message_endpoint(user_id, message_ids[obj_in.MailUniqueId], select="body")
+            requests.append(MsBatchHelper.to_batch_request(str(i), endpoint))
+        responses = await MsBatchHelper.call(token, requests, tenant=tenant, mailbox=user_id)
+        obj_ins_with_body: List[SECorrespondenceCreate] = []
+        for i, obj_in in enumerate(obj_ins):
+            response = responses.get(str(i))
+            try:
+                if response is None or response.status != 200:
+                    raise ValueError(f"status {response.status if response else None}")
+                obj_in.MailBody1 = MessageBodySchema(**response.body["body"]).content
+                obj_ins_with_body.append(obj_in)
+            except Exception as e:
+                logger.bind(tenant=tenant, user_id=user_id, message=obj_in.MailUniqueId).error(
+                    f"Could not fetch message body: {e}"
+                )
+        return obj_ins_with_body, len(obj_ins_with_body) == len(obj_ins)
+
     # @staticmethod # use save_messages: use a list
     # async def save_message(message: MessageSchema):
     #     pass
@@ -102,7 +371,7 @@ class MailController:
     async def process_and_save_user_messages(
             tenant: str,
             user: UserResponseSchema,
-            messages: List[MessageSchema],
+            messages: List[MessagePersistSchema],
             db_fit: Session,
             db_mailstore: Session,
             process_ind: str
@@ -112,7 +381,7 @@ class MailController:
 
         :param tenant: str
         :param user: UserResponseSchema
-        :param messages: List[MessageSchema]
+        :param messages: List[MessagePersistSchema]
         :param db_fit: Session
         :param db_mailstore: Session
         :param process_ind: str
@@ -121,9 +390,31 @@ class MailController:
         processed_messages: List[SECorrespondenceCreate] = await MailProcessor.process_messages(
             tenant, user, messages, db_fit, db_mailstore, process_ind
         )
-        se_correspondence_rows = CRUDSECorrespondence(SECorrespondence)\
-            .get_by_mail_unique_id_or_create_get_if_not_exist_multi(db_mailstore, obj_ins=processed_messages)
-        return se_correspondence_rows
+        return await MailController.save_rows(tenant, db_mailstore, processed_messages)
+
+    @staticmethod
+    async def save_rows(
+            tenant: str, db_mailstore: Session, obj_ins: List[SECorrespondenceCreate]
+    ) -> List[SECorrespondence]:
+        """
+        Get or create the SECorrespondence rows of obj_ins, one tenant mailbox at a time.
+        A message is in the mailboxes of its sender and recipients, synced concurrently, and MailUniqueId
+        has no unique index: two mailboxes checking for the row at the same time would both insert it.
+
+        :param tenant: str
+        :param db_mailstore: Session
+        :param obj_ins: List[SECorrespondenceCreate]
+        :return: List[SECorrespondence]
+        """
+        lock = _save_locks.setdefault(tenant, asyncio.Lock())
+        async with lock:
+            rows = await db_executor.run(
+                db_mailstore,
+                CRUDSECorrespondence(SECorrespondence).get_by_mail_unique_id_or_create_get_if_not_exist_multi,
+                obj_ins=obj_ins
+            )
+        mail_unique_id_index.add(tenant, [row.MailUniqueId for row in rows])
+        return rows
 
     @staticmethod
     async def save_user_messages_and_attachments(
@@ -134,6 +425,10 @@ class MailController:
             db_mailstore: Session,
             top: int = 5,
             filter: str = "",
+            delta: bool = False,
+            two_phase: bool = False,
+            use_checkpoint: bool = False,
+            progress: Optional[SyncProgress] = None,
     ) -> (List[SECorrespondence], List[str]):
         """
         Save user messages and attachments
@@ -144,51 +439,347 @@ class MailController:
         :param db_fit: Session
         :param db_mailstore: Session
         :param top: int
-        :param filter: str
+        :param filter: str, in delta mode only used for a full (re)sync
+        :param delta: bool, fetch only changes since the last run using msgraph delta queries
+        :param two_phase: bool, list messages without body and fetch the body only for processed messages
+        :param use_checkpoint: bool, list oldest first and continue from the MailboxCheckpoint of the mailbox,
+            which is advanced after every saved page (not used in delta mode, delta links are the checkpoints).
+            A filter on receivedDateTime is kept as is, else the listing starts at the checkpoint
+        :param progress: Optional[SyncProgress], message and attachment counters are added to it page by page
         :return: (List[SECorrespondence], List[str])
         """
         req_epoch: str = str(int(time.time()))
-        messages: List[MessageSchema] = await MailController.get_messages_while_nextlink(token, tenant, id, top, filter)
-        if messages is None or len(messages) == 0:
-            logger.bind().error("no messages")
-            return None, None
         # get user
-        user: Optional[UserResponseSchema] = await UserController.get_user(token, id)
+        user: Optional[UserResponseSchema] = await UserController.get_user(token, tenant, id)
         if user is None:
-            logger.bind().error("no user")
+            logger.bind(tenant=tenant, user_id=id).error("no user")
+            raise UserNotFoundException(f"User {id} not found")
+        # internal / external addresses of the messages are told apart with the directory snapshot
+        await tenant_directory.get_or_build_snapshot(token, tenant)
+        projection = MessageProjection.classify if two_phase else MessageProjection.persist
+        if delta:
+            page_items = MailController._iter_delta_page_items(MailController.iter_messages_delta_all_folders(
+                token, tenant, id, db_mailstore, top, filter, projection
+            ))
+        else:
+            list_filter, orderby, next_link = filter, "", None
+            if use_checkpoint:
+                checkpoint = await db_executor.run(
+                    db_mailstore, CRUDMailboxCheckpoint(MailboxCheckpoint).get_by_mailbox, mailbox=id
+                )
+                high_water_mark = checkpoint.ReceivedDateTime if checkpoint is not None else None
+                if checkpoint is not None and checkpoint.NextLink and checkpoint.Filter == filter:
+                    # the previous run with this filter stopped halfway
+                    next_link = checkpoint.NextLink
+                    logger.bind(tenant=tenant, user_id=id).info("Resuming listing from checkpoint")
+                if not has_received_date_time_filter(filter):
+                    # an explicit time filter (e.g. a scheduled run's, with its overlap) is not narrowed
+                    list_filter = add_received_date_time_filter(filter, high_water_mark)
+                if list_filter.lower().startswith("receiveddatetime"):
+                    # msgraph only orders by a property that comes first in the filter
+                    orderby = "receivedDateTime asc"
+            page_items = MailController._iter_messages_page_items(MailController.iter_messages_pages_from_checkpoint(
+                token, tenant, id, db_mailstore, top, list_filter, projection, orderby, next_link
+            ))
+        # pages go through list -> classify -> save -> attachments stages connected by bounded queues,
+        # so listing, db and disk work overlap and a slow stage holds back listing
+        se_correspondence_rows: List[SECorrespondence] = []
+        links: List[str] = []
+        messages_count = 0
+        is_complete = True
+
+        async def classify(page: MessagesPage) -> None:
+            if len(page.messages) == 0:
+                return
+            logger.bind(tenant=tenant, user_id=id, messages=len(page.messages)).info("Processing messages page")
+            page.obj_ins = await MailProcessor.process_messages(
+                tenant, user, page.messages, db_fit, db_mailstore, req_epoch
+            )
+            if two_phase and len(page.obj_ins) > 0:
+                # stored messages keep their row and body, get_or_create would drop a fetched body
+                stored: Dict[str, int] = await db_executor.run(
+                    db_mailstore, lambda db: mail_unique_id_index.get_seq_nos(
+                        tenant, db, [obj_in.MailUniqueId for obj_in in page.obj_ins]
+                    )
+                )
+                to_fetch = [obj_in for obj_in in page.obj_ins if obj_in.MailUniqueId not in stored]
+                if len(to_fetch) == 0:
+                    return
+                logger.bind(tenant=tenant, user_id=id, processed=len(page.obj_ins), to_fetch=len(to_fetch))\
+                    .info("Fetching bodies of processed messages")
+                fetched, page.is_complete = await MailController.fetch_message_bodies(
+                    token, tenant, id, page.messages, to_fetch
+                )
+                fetched_ids = {obj_in.MailUniqueId for obj_in in fetched}
+                page.obj_ins = [
+                    obj_in for obj_in in page.obj_ins
+                    if obj_in.MailUniqueId in stored or obj_in.MailUniqueId in fetched_ids
+                ]
+
+        async def save(page: MessagesPage) -> None:
+            if len(page.obj_ins) > 0:
+                page.rows = await MailController.save_rows(tenant, db_mailstore, page.obj_ins)
+
+        async def save_attachments(page: MessagesPage) -> None:
+            if len(page.messages) > 0:
+                page.links = await MailController.process_and_save_user_messages_attachments_to_disk(
+                    token, tenant, id, page.messages, db_mailstore
+                )
+
+        async def on_page_done(index: int, page: MessagesPage) -> None:
+            nonlocal messages_count, is_complete
+            messages_count += len(page.messages)
+            se_correspondence_rows.extend(page.rows)
+            links.extend(page.links)
+            if progress is not None:
+                progress.messages_listed += len(page.messages)
+                progress.messages_processed += len(page.rows)
+                progress.messages_discarded += len(page.messages) - len(page.rows)
+                progress.messages_with_attachments_saved += len(page.links)
+            # a failed page keeps the checkpoints where they are for the rest of the run
+            is_complete = is_complete and page.is_complete
+            if is_complete and use_checkpoint and not delta:
+                # the high water mark only moves past messages listed oldest first
+                await db_executor.run(
+                    db_mailstore, MailController.save_checkpoint, id, filter, page.messages_schema.odata_nextLink,
+                    page.messages if orderby else []
+                )
+            # the last page of a folder carries its delta link, pages are done in listing order.
+            # only advance delta links once the changes they cover are saved
+            if is_complete and page.messages_schema.odata_deltaLink:
+                await db_executor.run(
+                    db_mailstore, MailController.save_delta_links, id,
+                    {page.folder_id: page.messages_schema.odata_deltaLink}
+                )
+
+        await run_pipeline(
+            page_items,
+            [
+                PipelineStage("classify", classify, settings.MAIL_PIPELINE_CLASSIFY_WORKERS),
+                PipelineStage("save", save, settings.MAIL_PIPELINE_SAVE_WORKERS),
+                PipelineStage("attachments", save_attachments, settings.MAIL_PIPELINE_ATTACHMENT_WORKERS),
+            ],
+            queue_size=settings.MAIL_PIPELINE_QUEUE_SIZE,
+            on_item_done=on_page_done
+        )
+        if not is_complete:
+            logger.bind(tenant=tenant, user_id=id).warning("Some message bodies are missing, keeping old checkpoints")
+        if messages_count == 0:
+            logger.bind().error("no messages")
             return None, None
-        # save messages
-        logger.bind().info("Saving messages")
-        se_correspondence_rows: List[SECorrespondence] = await MailController.process_and_save_user_messages(
-            tenant, user, messages, db_fit, db_mailstore, req_epoch
+        return se_correspondence_rows, links
+
+    @staticmethod
+    async def iter_messages_delta_pages(
+            token: Any,
+            tenant: str,
+            user_id: str,
+            folder_id: str,
+            top: int,
+            filter: str,
+            delta_link: Optional[str],
+            projection: MessageProjection = MessageProjection.full
+    ) -> AsyncGenerator[MessagesDeltaSchema, None]:
+        """
+        Queries msgraph delta for messages in a folder, created or updated since delta_link was issued.
+        Without delta_link it is a full sync of the folder (narrowed by filter on receivedDateTime).
+        The last page has odata_deltaLink for the next round.
+
+        :param token: Any
+        :param tenant: str
+        :param user_id: str
+        :param folder_id: str
+        :param top: int, page size
+        :param filter: str
+        :param delta_link: Optional[str]
+        :param projection: MessageProjection, fields to $select (a delta link keeps the $select it was issued for)
+        :return: AsyncGenerator[MessagesDeltaSchema, None]
+        raise: DeltaTokenExpiredException, before the first page
+        """
+        if delta_link:
+            url = delta_link
+        else:
+            endpoint = MsEndpointsHelper.get_endpoint("message:delta", endpoints_ms)
+            endpoint.request_params["user_id"] = user_id
+            endpoint.request_params["mailfolder_id"] = folder_id
+            if filter != "":
+                endpoint.optional_query_params.filter = filter
+            endpoint.optional_query_params.select = MsEndpointHelper.get_message_select(projection)
+            url = MsEndpointHelper.form_url(endpoint)
+        # delta does not support $top
+        page_size = top if 0 < top <= 1000 else 10
+        first_page = await MailController._get_messages_page(
+            token, tenant, user_id, url, endpoint_name="message:delta", page_size=page_size, projection=projection
         )
-        # save attachments
-        links: List[str] = await MailController.process_and_save_user_messages_attachments_to_disk(
-            token, tenant, id, messages, db_mailstore
+        async for messages_schema in MailController._iter_pages(
+                token, tenant, user_id, first_page, endpoint_name="message:delta", page_size=page_size,
+                projection=projection
+        ):
+            yield messages_schema
+
+    @staticmethod
+    async def iter_messages_delta_all_folders(
+            token: Any,
+            tenant: str,
+            user_id: str,
+            db_mailstore: Session,
+            top: int,
+            filter: str,
+            projection: MessageProjection = MessageProjection.full
+    ) -> AsyncGenerator[Tuple[str, MessagesDeltaSchema], None]:
+        """
+        Delta query every tracked folder of a user page by page, starting from the stored delta links.
+        A folder with an expired delta link is fully re-synced.
+
+        :param token: Any
+        :param tenant: str
+        :param user_id: str
+        :param db_mailstore: Session
+        :param top: int
+        :param filter: str
+        :param projection: MessageProjection
+        :return: AsyncGenerator[Tuple[str, MessagesDeltaSchema], None], folder id and page,
+            the last page of a folder has its new delta link
+        """
+        crud = CRUDMailboxDeltaToken(MailboxDeltaToken)
+        mail_integrate_job = configuration.tenant_configurations.get(tenant).mail_integrate_job
+        folder_ids = mail_integrate_job.delta_folders if mail_integrate_job else DEFAULT_DELTA_FOLDERS
+        for folder_id in folder_ids:
+            stored = await db_executor.run(
+                db_mailstore, crud.get_by_mailbox_and_folder, mailbox=user_id, folder_id=folder_id
+            )
+            pages = MailController.iter_messages_delta_pages(
+                token, tenant, user_id, folder_id, top, filter, stored.DeltaLink if stored else None, projection
+            )
+            try:
+                # an expired delta link fails on the first page, before anything is yielded
+                async for messages_schema in pages:
+                    yield folder_id, messages_schema
+            except DeltaTokenExpiredException as e:
+                logger.bind(tenant=tenant, user_id=user_id, folder_id=folder_id).warning(f"{e}, full resync")
+                await db_executor.run(
+                    db_mailstore, crud.remove_by_mailbox_and_folder, mailbox=user_id, folder_id=folder_id
+                )
+                async for messages_schema in MailController.iter_messages_delta_pages(
+                        token, tenant, user_id, folder_id, top, filter, None, projection
+                ):
+                    yield folder_id, messages_schema
+
+    @staticmethod
+    async def _iter_messages_page_items(
+            pages: AsyncGenerator[MessagesDeltaSchema, None]
+    ) -> AsyncGenerator[MessagesPage, None]:
+        try:
+            async for messages_schema in pages:
+                yield MessagesPage(messages_schema)
+        finally:
+            await pages.aclose()
+
+    @staticmethod
+    async def _iter_delta_page_items(
+            pages: AsyncGenerator[Tuple[str, MessagesDeltaSchema], None]
+    ) -> AsyncGenerator[MessagesPage, None]:
+        try:
+            async for folder_id, messages_schema in pages:
+                yield MessagesPage(messages_schema, folder_id)
+        finally:
+            await pages.aclose()
+
+    @staticmethod
+    def save_checkpoint(
+            db_mailstore: Session, user_id: str, filter: str, next_link: Optional[str], messages: List[MessageHeaderSchema]
+    ) -> None:
+        """Moves the MailboxCheckpoint past a saved page, messages come oldest first"""
+        crud = CRUDMailboxCheckpoint(MailboxCheckpoint)
+        checkpoint = crud.get_by_mailbox(db_mailstore, mailbox=user_id)
+        high_water_mark: Optional[datetime] = checkpoint.ReceivedDateTime if checkpoint is not None else None
+        for message in messages:
+            received_date_time = datetime.strptime(message.receivedDateTime, "%Y-%m-%dT%H:%M:%SZ")
+            if high_water_mark is None or received_date_time > high_water_mark:
+                high_water_mark = received_date_time
+        crud.upsert_checkpoint(
+            db_mailstore, mailbox=user_id, received_date_time=high_water_mark, filter=filter, next_link=next_link
         )
-        return se_correspondence_rows, links
 
     @staticmethod
-    async def get_message_attachments(token: Any, user_id: str, message_id: str) -> AttachmentsSchema:
+    def remove_checkpoint_next_link(db_mailstore: Session, user_id: str) -> None:
+        crud = CRUDMailboxCheckpoint(MailboxCheckpoint)
+        checkpoint = crud.get_by_mailbox(db_mailstore, mailbox=user_id)
+        if checkpoint is not None:
+            crud.upsert_checkpoint(
+                db_mailstore, mailbox=user_id, received_date_time=checkpoint.ReceivedDateTime, filter=checkpoint.Filter,
+                next_link=None
+            )
+
+    @staticmethod
+    def save_delta_links(db_mailstore: Session, user_id: str, delta_links: Dict[str, str]) -> None:
+        crud = CRUDMailboxDeltaToken(MailboxDeltaToken)
+        for folder_id, delta_link in delta_links.items():
+            crud.upsert_delta_link(db_mailstore, mailbox=user_id, folder_id=folder_id, delta_link=delta_link)
+
+    @staticmethod
+    async def get_message_attachments(token: Any, tenant: str, user_id: str, message_id: str) -> AttachmentsSchema:
         """
         Get message attachments from msgraph
 
         :param token: Any
+        :param tenant: str
         :param user_id: str
         :param message_id: str
         :return: AttachmentsSchema
         """
-        endpoint = MsEndpointsHelper.get_endpoint("message:list:attachment", endpoints_ms)
-        endpoint.request_params["id"] = user_id
-        endpoint.request_params["message_id"] = message_id
+        endpoint = MailController._get_message_attachments_endpoint(user_id, message_id)
         url = MsEndpointHelper.form_url(endpoint)
-        api_client = ApiClient(endpoint.request_method, url, headers=ApiClient.get_headers(token), timeout_sec=30)
+        api_client = ApiClient(
+            endpoint.request_method, url, headers=ApiClient.get_headers(token), timeout_sec=30, tenant=tenant,
+            mailbox=user_id, endpoint_name="message:list:attachment"
+        )
         response, data = await api_client.retryable_call()
         try:
             return AttachmentsSchema(**data)
         except Exception as e:
             logger.bind().error(e)
 
+    @staticmethod
+    async def get_messages_attachments(
+            token: Any, tenant: str, user_id: str, message_ids: List[str]
+    ) -> Dict[str, Optional[AttachmentsSchema]]:
+        """
+        Get attachments of many messages from msgraph, sent as $batch requests
+
+        :param token: Any
+        :param tenant: str
+        :param user_id: str
+        :param message_ids: List[str]
+        :return: Dict[str, Optional[AttachmentsSchema]], keyed by message_id
+        """
+        requests: List[BatchRequestSchema] = [
+            MsBatchHelper.to_batch_request(str(i), MailController._get_message_attachments_endpoint(user_id, message_id))
+            for i, message_id in enumerate(message_ids)
+        ]
+        responses = await MsBatchHelper.call(token, requests, tenant=tenant, mailbox=user_id)
+        attachments: Dict[str, Optional[AttachmentsSchema]] = {}
+        for i, message_id in enumerate(message_ids):
+            response = responses.get(str(i))
+            attachments[message_id] = None
+            if response is None or response.status != 200:
+                logger.bind(message_id=message_id, status=response.status if response else None).error(
+                    "Cannot get message attachments from msgraph batch"
+                )
+                continue
+            try:
+                attachments[message_id] = AttachmentsSchema(**response.body)
+            except Exception as e:
+                logger.bind(message_id=message_id).error(e)
+        return attachments
+
+    @staticmethod
+    def _get_message_attachments_endpoint(user_id: str, message_id: str) -> MsEndpoint:
+        endpoint = MsEndpointsHelper.get_endpoint("message:list:attachment", endpoints_ms)
+        endpoint.request_params["id"] = user_id
+        endpoint.request_params["message_id"] = message_id
+        return endpoint
+
     @staticmethod
     async def save_message_attachments(
             tenant: str, db_mailstore: Session, token: Any, user_id: str, message_id: str, internet_message_id: str
@@ -204,7 +795,9 @@ class MailController:
         :param internet_message_id: str
         :return: Optional[List[str]]
         """
-        attachments_schema: AttachmentsSchema = await MailController.get_message_attachments(token, user_id, message_id)
+        attachments_schema: AttachmentsSchema = await MailController.get_message_attachments(
+            token, tenant, user_id, message_id
+        )
         if attachments_schema is None or attachments_schema.value is None:
             return None
         attachments = attachments_schema.value
@@ -220,7 +813,13 @@ class MailController:
         return links
 
     @staticmethod
-    async def save_attachments_to_disk_if_message_in_db(tenant: str, db_mailstore: Session, internet_message_id: str, attachments: List[AttachmentSchema]) -> Optional[List[str]]:
+    async def save_attachments_to_disk_if_message_in_db(
+            tenant: str,
+            db_mailstore: Session,
+            internet_message_id: str,
+            attachments: List[AttachmentSchema],
+            seq_no: Optional[int] = None
+    ) -> Optional[List[str]]:
         """
         Save message attachments to disk if message is present in db
 
@@ -228,11 +827,14 @@ class MailController:
         :param db_mailstore:
         :param internet_message_id:
         :param attachments:
+        :param seq_no: Optional[int], SeqNo of the message when the caller already looked it up
         :return:
         """
-        correspondence: Optional[SECorrespondence] = await MailController.get_mail_from_db(internet_message_id, db_mailstore)
-        if correspondence is None:
-            return None
+        if seq_no is None:
+            correspondence: Optional[SECorrespondence] = await MailController.get_mail_from_db(internet_message_id, db_mailstore)
+            if correspondence is None:
+                return None
+            seq_no = correspondence.SeqNo
         links = []
         for attachment in attachments:
             if attachment.contentBytes is None:
@@ -242,7 +844,7 @@ class MailController:
             # contentBytes is base64 encoded str
             content = base64.b64decode(content_b64)
             filename = attachment.name
-            file_relative_path = get_attachments_path_from_id(correspondence.SeqNo)
+            file_relative_path = get_attachments_path_from_id(seq_no)
             saved_to = await FileHelper.get_or_save_get_in_disk(
                 BytesIO(content),
                 configuration.tenant_configurations.get(tenant).disk.disk_base_path,
@@ -254,31 +856,48 @@ class MailController:
         return links
 
     @staticmethod
-    async def process_and_save_user_messages_attachments_to_disk(token:Any, tenant: str, id: str, messages: List[MessageSchema], db_mailstore: Session) -> List[str]:
+    async def process_and_save_user_messages_attachments_to_disk(token:Any, tenant: str, id: str, messages: List[MessageHeaderSchema], db_mailstore: Session) -> List[str]:
         """
         Process and save user messages-attachments to disk
 
         :param token: Any
         :param tenant: str
         :param id: str
-        :param messages: List[MessageSchema]
+        :param messages: List[MessageHeaderSchema]
         :param db_mailstore: Session
         :return: List[str]
         """
         links: List[str] = []
-        for message in messages:
-            if not message.hasAttachments:
-                logger.bind(message_unique_id=message.internetMessageId).debug("Mail has no attachment(s)")
-                continue
-            if await MailController.get_mail_from_db(message.internetMessageId, db_mailstore) is None:
-                logger.bind(internet_message_id=message.internetMessageId).debug("Mail Not found in db")
+        messages_with_attachments: List[MessageHeaderSchema] = [message for message in messages if message.hasAttachments]
+        # one query for the page, and none for the messages the index knows are not stored
+        seq_nos: Dict[str, int] = await db_executor.run(
+            db_mailstore, lambda db: mail_unique_id_index.get_seq_nos(
+                tenant, db, [message.internetMessageId for message in messages_with_attachments]
+            )
+        )
+        messages_with_attachments = [
+            message for message in messages_with_attachments if message.internetMessageId in seq_nos
+        ]
+        if len(messages_with_attachments) == 0:
+            return links
+        # one $batch round-trip for every 20 messages
+        attachments_by_message_id: Dict[str, Optional[AttachmentsSchema]] = await MailController.get_messages_attachments(
+            token, tenant, id, [message.id for message in messages_with_attachments]
+        )
+        for message in messages_with_attachments:
+            attachments_schema = attachments_by_message_id.get(message.id)
+            if attachments_schema is None or attachments_schema.value is None:
+                logger.bind(internet_message_id=message.internetMessageId).debug("No attachment saved")
                 continue
-            message_links = await MailController.save_message_attachments(tenant, db_mailstore, token, id, message.id, message.internetMessageId)
+            message_links = await MailController.save_attachments_to_disk_if_message_in_db(
+                tenant, db_mailstore, message.internetMessageId, attachments_schema.value,
+                seq_no=seq_nos[message.internetMessageId]
+            )
             if message_links is None:
                 logger.bind().debug("No attachment saved")
                 continue
             links.append(",".join(message_links))
-            return links
+        return links
 
     @staticmethod
     async def get_mail_from_db(internet_message_id: str, db_mailstore: Session) -> Optional[SECorrespondence]:
@@ -288,8 +907,9 @@ class MailController:
         :param db_mailstore: Session
         :return: Optional[SECorrespondence]
         """
-        correspondence: Optional[SECorrespondence] = \
-            CRUDSECorrespondence(SECorrespondence).get_by_mail_unique_id(db_mailstore, mail_unique_id=internet_message_id)
+        correspondence: Optional[SECorrespondence] = await db_executor.run(
+            db_mailstore, CRUDSECorrespondence(SECorrespondence).get_by_mail_unique_id, mail_unique_id=internet_message_id
+        )
         if correspondence is None:
             return None  # no row in db
         return correspondence
@@ -305,7 +925,9 @@ class MailController:
     ):
         req_epoch: str = str(int(time.time()))
         # get messages
-        message_response_schema: Optional[MessageResponseSchema] = await MailController.get_message(token, id, message_id)
+        message_response_schema: Optional[MessageResponseSchema] = await MailController.get_message(
+            token, tenant, id, message_id
+        )
         if message_response_schema is None:
             logger.bind().error("Could not find message")
             return None
@@ -313,7 +935,7 @@ class MailController:
         message_response_schema_dict['from'] = message_response_schema.from_email
         message = MessageSchema(**message_response_schema_dict)
         # get user
-        user_dict:  Optional[UserResponseSchema] = await UserController.get_user(token, id)  # TODO: Write UserController.get_user
+        user_dict:  Optional[UserResponseSchema] = await UserController.get_user(token, tenant, id)
         if user_dict is None:
             logger.bind().error("Could not find user")
             return None
@@ -332,85 +954,247 @@ class MailController:
             token: Any,
             tenant: str,
             db_sales97: Session,
-            db_fit: Session,
-            db_mailstore: Session,
             top: int = 5,
-            filter: str = ""
-    ) -> (List[UserSchema], List[SECorrespondence], List[str]):
+            filter: str = "",
+            delta: bool = False,
+            two_phase: bool = False,
+            concurrency: Optional[int] = None,
+            use_checkpoint: bool = False,
+            progress: Optional[SyncProgress] = None
+    ) -> (List[UserSchema], List[SECorrespondence], List[str], List[UserSyncResult]):
+        """
+        Save messages and attachments of every tracked user, up to concurrency users at a time.
+        Every user gets its own db sessions, a failing user does not stop the others.
+        With settings.SHARDING_ENABLED only the users whose mailbox lease this worker holds are synced.
+
+        :param token: Any
+        :param tenant: str
+        :param db_sales97: Session
+        :param top: int
+        :param filter: str
+        :param delta: bool
+        :param two_phase: bool
+        :param concurrency: Optional[int], defaults to settings.MAIL_SYNC_MAILBOX_CONCURRENCY
+        :param use_checkpoint: bool
+        :param progress: Optional[SyncProgress], updated as users and their pages are done
+        :return: (List[UserSchema], List[SECorrespondence], List[str], List[UserSyncResult])
+        """
         # get list of trackable users
-        users: List[UserSchema] = await UserController.get_users_to_track(token, db_sales97)
+        users: List[UserSchema] = await UserController.get_users_to_track(token, tenant, db_sales97)
+        if settings.SHARDING_ENABLED:
+            users = await mailbox_shard_coordinator.claim_users(tenant, users)
+        if progress is not None:
+            progress.mailboxes_total = len(users)
+        semaphore = asyncio.Semaphore(max(1, concurrency or settings.MAIL_SYNC_MAILBOX_CONCURRENCY))
         # call save_user_messages for each user id
+        user_results = await asyncio.gather(*[
+            MailController._save_tracked_user_messages_and_attachments(
+                semaphore, tenant, user, top, filter, delta, two_phase, use_checkpoint, progress
+            )
+            for user in users
+        ])
         all_rows = []
         all_links = []
-        for user in users:
+        results: List[UserSyncResult] = []
+        for result, rows, links in user_results:
+            if len(rows) > 0: all_rows.append(rows)
+            if len(links) > 0: all_links.append(",".join(links))
+            results.append(result)
+        logger.bind(
+            tenant=tenant, users=len(results), failed=len([result for result in results if not result.success])
+        ).info("Saved tenant messages")
+        return users, all_rows, all_links, results
+
+    @staticmethod
+    async def _save_tracked_user_messages_and_attachments(
+            semaphore: asyncio.Semaphore,
+            tenant: str,
+            user: UserSchema,
+            top: int,
+            filter: str,
+            delta: bool,
+            two_phase: bool,
+            use_checkpoint: bool,
+            progress: Optional[SyncProgress]
+    ) -> (UserSyncResult, List[SECorrespondence], List[str]):
+        async with semaphore:
+            start = time.monotonic()
+            tenant_db = configuration.tenant_configurations.get(tenant).db
             try:
-                rows, links = \
-                    await MailController.save_user_messages_and_attachments(token, tenant, user.id, db_fit, db_mailstore, top, filter)
+                # a tenant sync can outlive the token it started with, the registry has the current one
+                mailbox_token = await msal_client_registry.get_token(tenant)
+                if mailbox_token is None or "access_token" not in mailbox_token:
+                    raise RuntimeError(
+                        f"Unauthorized: {mailbox_token.get('error_description') if mailbox_token else None}"
+                    )
+                with tenant_db_session(tenant, tenant_db.db_fit_name) as db_fit, \
+                        tenant_db_session(tenant, tenant_db.db_mailstore_name) as db_mailstore:
+                    rows, links = \
+                        await MailController.save_user_messages_and_attachments(
+                            mailbox_token, tenant, user.id, db_fit, db_mailstore, top, filter, delta, two_phase,
+                            use_checkpoint, progress
+                        )
                 if rows is None: rows = []
                 if links is None: links = []
                 logger.bind(tenant=tenant, user=user, rows=len(rows), links=len(links)).info("Saved user messages")
-                if len(rows) > 0: all_rows.append(rows)
-                if len(links) > 0: all_links.append(",".join(links))
+                if progress is not None:
+                    progress.mailboxes_done += 1
+                return UserSyncResult(
+                    user_id=user.id, success=True, rows=len(rows), links=len(links),
+                    duration_sec=time.monotonic() - start
+                ), rows, links
             except Exception as e:
-                logger.bind(
-                    error=token.get("error"),
-                    error_description=token.get("error_description"),
-                    correlation_id=token.get("correlation_id")
-                ).error(f"investigate: {e}")
-                continue
-        return users, all_rows, all_links
+                logger.bind(tenant=tenant, user=user.id, error=e).error(f"Could not save user messages: {e}")
+                if progress is not None:
+                    progress.mailboxes_failed += 1
+                return UserSyncResult(
+                    user_id=user.id, success=False, duration_sec=time.monotonic() - start, error=str(e)
+                ), [], []
+            finally:
+                if settings.SHARDING_ENABLED:
+                    await mailbox_shard_coordinator.release(tenant, user.id)
 
     @staticmethod
     async def update_tenant_messages(
-            token: Any, tenant: str, db_mailstore: Session, skip: int = 0, limit: int = 100
-    ) -> List[SECorrespondenceUpdate]:
+            token: Any,
+            tenant: str,
+            db_mailstore: Session,
+            skip: int = 0,
+            limit: int = 100,
+            before_seq_no: Optional[int] = None
+    ) -> Tuple[List[SECorrespondenceUpdate], Optional[int]]:
+        """
+        Fills ConversationId of a page of rows that have none
+
+        :param token: Any
+        :param tenant: str
+        :param db_mailstore: Session
+        :param skip: int, ignored when before_seq_no is set
+        :param limit: int, rows in the page
+        :param before_seq_no: Optional[int], page of rows before this SeqNo (keyset pagination)
+        :return: Tuple[List[SECorrespondenceUpdate], Optional[int]], the updates and the before_seq_no of the next
+            page (None on the last page)
+        """
         # get some rows that have empty CorrespondenceId44
         se_correspondence_rows: List[SECorrespondence] = \
-            CRUDSECorrespondence(SECorrespondence).get_where_conversation_id_44_is_empty(db_mailstore, skip=skip, limit=limit)
-        # fetch CorrespondenceId for internetMessageId(MailUniqueId)
-        se_correspondence_updates: List[SECorrespondenceUpdate] = []
-        for se_correspondence_row in se_correspondence_rows:
-            emails = []
-            if se_correspondence_row.MailFrom: emails.append(se_correspondence_row.MailFrom)
-            if se_correspondence_row.MailTo: [emails.append(email) for email in se_correspondence_row.MailTo.split(',')]
-            if se_correspondence_row.MailCC: [emails.append(email) for email in se_correspondence_row.MailCC.split(',')]
-            if se_correspondence_row.MailBCC: [emails.append(email) for email in se_correspondence_row.MailBCC.split(',')]
-            user: Optional[UserSchema]
+            await db_executor.run(
+                db_mailstore, CRUDSECorrespondence(SECorrespondence).get_where_conversation_id_44_is_empty,
+                skip=skip, limit=limit, before_seq_no=before_seq_no
+            )
+        next_before_seq_no: Optional[int] = \
+            se_correspondence_rows[-1].SeqNo if len(se_correspondence_rows) == limit else None
+        # resolve all addresses of all rows in one go
+        emails_by_seq_no: Dict[int, List[str]] = {
+            se_correspondence_row.SeqNo: get_se_correspondence_emails(se_correspondence_row)
+            for se_correspondence_row in se_correspondence_rows
+        }
+        users_by_email: Dict[str, Optional[UserSchema]] = await UserController.resolve_users_by_email(
+            token, tenant, [email for emails in emails_by_seq_no.values() for email in emails]
+        )
+        candidate_users_by_seq_no: Dict[int, List[UserSchema]] = {}
+        for seq_no, emails in emails_by_seq_no.items():
+            candidate_users: Dict[str, UserSchema] = {}
             for email in emails:
-                # get user from email
-                user = await UserController.get_user_by_email(token, email, "")
-                if user is None or user.id == "":
-                    continue
-                # get message for a user and a given message_id
-                get_messages_filter = f"internetMessageId eq '{se_correspondence_row.MailUniqueId}'"
-                messages_schema: MessagesSchema = await MailController.get_messages(token, tenant, user.id, 5, get_messages_filter)
-                if messages_schema is None:
-                    logger.bind(
-                        tenant=tenant, user_email=email, mail_subject=se_correspondence_row.MailSubject
-                    ).error("messages_schema is None, skipping this record")
+                user: Optional[UserSchema] = users_by_email.get(email)
+                if user is None or user.id == "" or user.id in candidate_users:
                     continue
-                if len(messages_schema.value) == 0:
-                    continue
-                message = messages_schema.value[0]
-                # create obj for se_correspondence update
-                se_correspondence_update = SECorrespondenceUpdate(
-                    SeqNo=se_correspondence_row.SeqNo,
-                    ConversationId=message.conversationId,
-                    ConversationId44=message.conversationId[:44]
-                )
-                se_correspondence_updates.append(se_correspondence_update)
-                # update SECorrespondence # TODO: move out of loop to process whole list instead of 1 by 1
-                update = CRUDSECorrespondence(SECorrespondence).update_conversation_id(
-                    db_mailstore,
-                    se_correspondence_update=se_correspondence_update
-                )
-                se_correspondence_updates.append(update)
+                candidate_users[user.id] = user
+            candidate_users_by_seq_no[seq_no] = list(candidate_users.values())
+        # fetch ConversationId for internetMessageId(MailUniqueId)
+        # round n looks up every pending row in the mailbox of its n-th candidate user,
+        # the mailboxes concurrently, and saves what it found with one bulk update
+        semaphore = asyncio.Semaphore(settings.MAIL_SYNC_MAILBOX_CONCURRENCY)
+        se_correspondence_updates: List[SECorrespondenceUpdate] = []
+        pending_rows: List[SECorrespondence] = se_correspondence_rows
+        candidate_index = 0
+        while len(pending_rows) > 0:
+            rows_by_mailbox: Dict[str, List[SECorrespondence]] = {}
+            for se_correspondence_row in pending_rows:
+                candidate_users = candidate_users_by_seq_no[se_correspondence_row.SeqNo]
+                if candidate_index < len(candidate_users):
+                    rows_by_mailbox.setdefault(candidate_users[candidate_index].id, []).append(se_correspondence_row)
+            if len(rows_by_mailbox) == 0:
                 break
-            # return users_schema
-        return se_correspondence_updates
+            mailboxes = list(rows_by_mailbox.keys())
+            messages_by_mailbox: List[Dict[str, MessageHeaderSchema]] = await asyncio.gather(*[
+                MailController._find_messages_by_internet_message_ids(
+                    semaphore, token, tenant, mailbox, [row.MailUniqueId for row in rows_by_mailbox[mailbox]]
+                ) for mailbox in mailboxes
+            ])
+            round_updates: List[SECorrespondenceUpdate] = []
+            next_pending_rows: List[SECorrespondence] = []
+            for mailbox, messages_by_internet_message_id in zip(mailboxes, messages_by_mailbox):
+                for se_correspondence_row in rows_by_mailbox[mailbox]:
+                    message = messages_by_internet_message_id.get(se_correspondence_row.MailUniqueId)
+                    if message is None or not message.conversationId:
+                        next_pending_rows.append(se_correspondence_row)
+                        continue
+                    round_updates.append(SECorrespondenceUpdate(
+                        SeqNo=se_correspondence_row.SeqNo,
+                        ConversationId=message.conversationId,
+                        ConversationId44=message.conversationId[:44]
+                    ))
+            if len(round_updates) > 0:
+                await db_executor.run(
+                    db_mailstore, CRUDSECorrespondence(SECorrespondence).update_conversation_ids,
+                    se_correspondence_updates=round_updates
+                )
+                se_correspondence_updates.extend(round_updates)
+            logger.bind(
+                tenant=tenant, round=candidate_index, mailboxes=len(mailboxes), updated=len(round_updates),
+                pending=len(next_pending_rows)
+            ).info("Updated ConversationIds")
+            pending_rows = next_pending_rows
+            candidate_index += 1
+        return se_correspondence_updates, next_before_seq_no
+
+    @staticmethod
+    async def _find_messages_by_internet_message_ids(
+            semaphore: asyncio.Semaphore, token: Any, tenant: str, user_id: str, internet_message_ids: List[str]
+    ) -> Dict[str, MessageHeaderSchema]:
+        """
+        Messages of a mailbox by internetMessageId, looked up BACKFILL_IDS_PER_REQUEST ids per request
+        with an or'd $filter, the requests sent as $batch calls
+
+        :return: Dict[str, MessageHeaderSchema], keyed by internetMessageId, ids not found are left out
+        """
+        requests: List[BatchRequestSchema] = []
+        for i in range(0, len(internet_message_ids), BACKFILL_IDS_PER_REQUEST):
+            chunk = internet_message_ids[i:i + BACKFILL_IDS_PER_REQUEST]
+            get_messages_filter = " or ".join(
+                f"internetMessageId eq '{internet_message_id.replace(chr(39), chr(39) * 2)}'"
+                for internet_message_id in chunk
+            )
+            # a message can be in more than one folder
+            endpoint = MailController._get_messages_endpoint(
+                user_id, 5 * len(chunk), get_messages_filter, MessageProjection.classify
+            )
+            requests.append(MsBatchHelper.to_batch_request(str(len(requests)), endpoint))
+        messages_by_internet_message_id: Dict[str, MessageHeaderSchema] = {}
+        async with semaphore:
+            try:
+                responses = await MsBatchHelper.call(token, requests, tenant=tenant, mailbox=user_id)
+            except Exception as e:
+                logger.bind(tenant=tenant, user_id=user_id, error=e).error(f"Could not look up messages: {e}")
+                return messages_by_internet_message_id
+        for request in requests:
+            response = responses.get(request.id)
+            if response is None or response.status != 200:
+                logger.bind(
+                    tenant=tenant, user_id=user_id, status=response.status if response else None
+                ).error("Could not look up messages, skipping them")
+                continue
+            try:
+                messages_schema = MESSAGE_PROJECTION_PAGE_SCHEMAS[MessageProjection.classify](**response.body)
+            except Exception as e:
+                logger.bind(data=response.body).error("Error in converting dict to MessagesSchema")
+                continue
+            for message in messages_schema.value or []:
+                messages_by_internet_message_id.setdefault(message.internetMessageId, message)
+        return messages_by_internet_message_id
 
     @staticmethod
-    async def send_mail(token: Any, user_id: str, message: SendMessageRequestSchema):
+    async def send_mail(token: Any, tenant: str, user_id: str, message: SendMessageRequestSchema):
         message: SendMessageRequestSchema = \
             map_inplace_SendMessageRequestSchema_to_msgrapgh_SendMessageRequestSchema(message)
         endpoint = MsEndpointsHelper.get_endpoint("message:send", endpoints_ms)
@@ -421,7 +1205,11 @@ class MailController:
             url,
             headers=ApiClient.get_headers(token),
             data=message.json(),
-            timeout_sec=3000)
+            timeout_sec=3000,
+            retries=2,
+            tenant=tenant,
+            mailbox=user_id,
+            endpoint_name="message:send")
         api_client.headers['content-type'] = "application/json"
         response_and_data: Tuple[ClientResponse, str] = await api_client.retryable_call()
         response, data = response_and_data
@@ -433,7 +1221,7 @@ class MailProcessor:
     async def process_messages(
             tenant: str,
             user: UserResponseSchema,
-            messages: List[MessageSchema],
+            messages: List[MessageHeaderSchema],
             db_fit: Session,
             db_mailstore: Session,
             process_ind: str
@@ -442,17 +1230,19 @@ class MailProcessor:
 
         :param tenant: str
         :param user: UserResponseSchema
-        :param messages: List[MessageSchema]
+        :param messages: List[MessageHeaderSchema]
         :param db_fit: Session
         :param db_mailstore: Session
         :param process_ind: str
         :return: List[SECorrespondenceCreate]
         """
         se_correspondence_create_schemas: List[SECorrespondenceCreate] = []
+        # one round-trip per settings.STORED_PROCEDURE_BATCH_SIZE lookups instead of one per message
+        email_link_infos = await MailProcessor.get_email_links_from_dhruv(tenant, user, messages, db_fit)
         for message in messages:
             try:
                 obj_in: Optional[SECorrespondenceCreate] = await MailProcessor.process_message(
-                    tenant, user, message, db_fit, db_mailstore, process_ind
+                    tenant, user, message, db_fit, db_mailstore, process_ind, email_link_infos
                 )
                 if obj_in is not None:
                     se_correspondence_create_schemas.append(obj_in)
@@ -465,52 +1255,92 @@ class MailProcessor:
     async def process_message(
             tenant: str,
             user: UserResponseSchema,
-            message: MessageSchema,
+            message: MessageHeaderSchema,
             db_fit: Session,
             db_mailstore: Session,
-            process_time: str = str(int(time.time()))
+            process_time: str = str(int(time.time())),
+            email_link_infos: Optional[Dict[Tuple[str, str, str], Optional[EmailTrackerGetEmailLinkInfo]]] = None
     ) -> Optional[SECorrespondenceCreate]:
         obj_in: Optional[SECorrespondenceCreate] = None
+        for address in MailProcessor.get_client_addresses(tenant, user, message):
+            obj_in: Optional[SECorrespondenceCreate] = await MailProcessor.process_or_discard_message(
+                tenant, address, message, db_fit, db_mailstore, process_time, email_link_infos
+            )
+            if obj_in is not None:
+                break
+        return obj_in
+
+    @staticmethod
+    def get_client_addresses(tenant: str, user: UserResponseSchema, message: MessageHeaderSchema) -> List[str]:
+        """Addresses message is processed for: its external recipients if outgoing, else its external sender"""
         if message.from_email is None:
-            return None
-        if MailProcessor.is_outgoing(user, message):
+            return []
+        if MailProcessor.is_outgoing(user, message, tenant):
             to_addresses: List[str] = [recipient.emailAddress.address for recipient in message.toRecipients]
-            for to_address in to_addresses:
-                # process message only if it is related to a client
-                if not MailProcessor.is_internal_address(tenant, to_address):
-                    obj_in: Optional[SECorrespondenceCreate] = await MailProcessor.process_or_discard_message(
-                        tenant, to_address, message, db_fit, db_mailstore, process_time
-                    )
-                    if obj_in is not None:
-                        break
-        else:  # incoming email
-            from_address = message.from_email.emailAddress.address
             # process message only if it is related to a client
-            if not MailProcessor.is_internal_address(tenant, from_address):
-                obj_in: Optional[SECorrespondenceCreate] = \
-                    await MailProcessor.process_or_discard_message(
-                        tenant, from_address, message, db_fit, db_mailstore, process_time
-                    )
-        return obj_in
+            return [address for address in to_addresses if not MailProcessor.is_internal_address(tenant, address)]
+        # incoming email
+        from_address = message.from_email.emailAddress.address
+        return [from_address] if not MailProcessor.is_internal_address(tenant, from_address) else []
+
+    @staticmethod
+    async def get_email_links_from_dhruv(
+            tenant: str, user: UserResponseSchema, messages: List[MessageHeaderSchema], db_fit: Session
+    ) -> Dict[Tuple[str, str, str], Optional[EmailTrackerGetEmailLinkInfo]]:
+        """
+        Email link info of every (address, subject, sentDateTime) messages are processed for, looked up in batches.
+        Lookups missing from the result (failed batch, incomplete message) are done one by one when processing.
+
+        :param tenant: str
+        :param user: UserResponseSchema
+        :param messages: List[MessageHeaderSchema]
+        :param db_fit: Session
+        :return: Dict[Tuple[str, str, str], Optional[EmailTrackerGetEmailLinkInfo]]
+        """
+        keys: Dict[Tuple[str, str, str], None] = {}
+        for message in messages:
+            if message.subject is None or message.sentDateTime is None:
+                continue
+            for address in MailProcessor.get_client_addresses(tenant, user, message):
+                keys[(address, message.subject, message.sentDateTime)] = None
+        if len(keys) == 0:
+            return {}
+        try:
+            email_links_infos = await StoredProcedures.dhruv_EmailTrackerGetEmailLinkInfo_multi(db_fit, [
+                EmailTrackerGetEmailLinkInfoParams(email=email, subject=subject, date=date, conversation_id='')
+                for email, subject, date in keys
+            ])
+        except Exception as e:
+            logger.bind(tenant=tenant, user=user.id, lookups=len(keys)).error(f"Investigate: {e}")
+            return {}
+        return {
+            key: email_links_info[0] if len(email_links_info) > 0 else None
+            for key, email_links_info in zip(keys, email_links_infos)
+        }
 
     @staticmethod
     async def process_or_discard_message(
             tenant: str,
             email_address: str,
-            message: MessageSchema,
+            message: MessageHeaderSchema,
             db_fit: Session,
             db_mailstore: Session,
-            process_time: str = str(int(time.time()))
+            process_time: str = str(int(time.time())),
+            email_link_infos: Optional[Dict[Tuple[str, str, str], Optional[EmailTrackerGetEmailLinkInfo]]] = None
     ) -> Optional[SECorrespondenceCreate]:
         obj_in: Optional[SECorrespondenceCreate] = None
         try:
             if not MailProcessor.is_internal_address(tenant, email_address):
                 # logger.bind(email=email_address, message=message.id).debug("process_or_discard_message")
-                # get email_link_info
-                escaped_subject = message.subject.replace("'", "''")
-                email_link_info: Optional[EmailTrackerGetEmailLinkInfo] = await MailProcessor.get_email_link_from_dhruv(
-                    email_address, escaped_subject, message.sentDateTime, '', db_fit
-                )
+                # get email_link_info, the subject is a bound parameter and needs no escaping
+                key = (email_address, message.subject, message.sentDateTime)
+                if email_link_infos is not None and key in email_link_infos:
+                    email_link_info: Optional[EmailTrackerGetEmailLinkInfo] = email_link_infos[key]
+                else:
+                    email_link_info: Optional[EmailTrackerGetEmailLinkInfo] = \
+                        await MailProcessor.get_email_link_from_dhruv(
+                            email_address, message.subject, message.sentDateTime, '', db_fit
+                        )
                 if email_link_info is None:
                     return obj_in
                 # get is_email_chain_origin
@@ -574,9 +1404,14 @@ class MailProcessor:
 
 
     @staticmethod
-    def is_outgoing(user: UserResponseSchema, message: MessageSchema) -> bool:
+    def is_outgoing(user: UserResponseSchema, message: MessageHeaderSchema, tenant: Optional[str] = None) -> bool:
         try:
             if message.from_email is not None:
+                snapshot = tenant_directory.get_snapshot(tenant) if tenant else None
+                if snapshot is not None:
+                    # also outgoing when sent from one of the aliases of user
+                    from_user = snapshot.get_user(message.from_email.emailAddress.address)
+                    return from_user is not None and from_user.id == user.id
                 return user.mail == message.from_email.emailAddress.address
             else:
                 return False
@@ -585,6 +1420,9 @@ class MailProcessor:
 
     @staticmethod
     def is_internal_address(tenant: str, address: str) -> bool:
+        snapshot = tenant_directory.get_snapshot(tenant)
+        if snapshot is not None and snapshot.get_user(address) is not None:
+            return True
         tenant_config: AzureAuth = configuration.get_ms_auth_config(tenant)
         for domain in tenant_config.internal_domains:
             if domain.lower() in address.lower(): return True
@@ -596,12 +1434,23 @@ class MailProcessor:
 
     @staticmethod
     async def is_mail_chain_origin_in_dhruv(db: Session, from_address: str, subject: str) -> bool:
-        is_origin_dhruv = CRUDSECorrespondence(SECorrespondence).is_mail_chain_origin_in_dhruv(
-            db, from_address=from_address, subject=subject
+        is_origin_dhruv = await db_executor.run(
+            db, CRUDSECorrespondence(SECorrespondence).is_mail_chain_origin_in_dhruv,
+            from_address=from_address, subject=subject
         )
         return is_origin_dhruv is not None
 
 
+def is_delta_token_expired(status: int, data: Any) -> bool:
+    # https://docs.microsoft.com/en-us/graph/delta-query-overview#synchronization-reset
+    if status == 410:
+        return True
+    if status == 400 and type(data) == dict:
+        error_code = data.get("error", {}).get("code", "")
+        return error_code in ("SyncStateNotFound", "SyncStateInvalid", "resyncRequired")
+    return False
+
+
 def get_attachments_path_from_id(id: int, *, min_length=6) -> str:
     """
     converts int to str of min_length and then splits each digit with "/"
@@ -621,6 +1470,30 @@ def get_attachments_path_from_id(id: int, *, min_length=6) -> str:
     return path
 
 
+def get_se_correspondence_emails(se_correspondence_row: SECorrespondence) -> List[str]:
+    emails = []
+    if se_correspondence_row.MailFrom: emails.append(se_correspondence_row.MailFrom)
+    if se_correspondence_row.MailTo: [emails.append(email) for email in se_correspondence_row.MailTo.split(',')]
+    if se_correspondence_row.MailCC: [emails.append(email) for email in se_correspondence_row.MailCC.split(',')]
+    if se_correspondence_row.MailBCC: [emails.append(email) for email in se_correspondence_row.MailBCC.split(',')]
+    return emails
+
+
+def has_received_date_time_filter(filter: str) -> bool:
+    return "receiveddatetime" in filter.lower()
+
+
+def add_received_date_time_filter(filter: str, since: Optional[datetime]) -> str:
+    """
+    Puts receivedDateTime ge since first in filter, as msgraph requires for $orderby receivedDateTime.
+    ge and not gt, messages received in the same second may be split across pages (saving is idempotent).
+    """
+    since_filter = f"receivedDateTime ge {(since or datetime(1900, 1, 1)).strftime('%Y-%m-%dT%H:%M:%SZ')}"
+    if filter == "":
+        return since_filter
+    return MsEndpointHelper.build_filter(since_filter, to_add=filter)
+
+
 def add_filter_to_leave_out_internal_domain_messages(tenant_id: str, filter: str) -> str:
     # tenant_ms_auth_config = get_ms_auth_config(tenant_id)
     tenant_ms_auth_config = configuration.get_ms_auth_config(tenant_id)
@@ -634,7 +1507,7 @@ def add_filter_to_leave_out_internal_domain_messages(tenant_id: str, filter: str
 
 
 def map_MessageSchema_to_SECorrespondenceCreate(
-        message: MessageSchema,
+        message: MessageHeaderSchema,
         email_link_info: EmailTrackerGetEmailLinkInfo,
         loop_start_epoch: str
 ) -> SECorrespondenceCreate:
@@ -643,7 +1516,8 @@ def map_MessageSchema_to_SECorrespondenceCreate(
         DocSentDate=datetime.strptime(message.sentDateTime, "%Y-%m-%dT%H:%M:%SZ"),
         MailUniqueId=message.internetMessageId,
         MailSubject=message.subject,
-        MailBody1=message.body.content,
+        # no body yet in a two-phase fetch, see MailController.fetch_message_bodies
+        MailBody1=message.body.content if getattr(message, "body", None) is not None else "",
         MailTo=",".join([toRecipient.emailAddress.address for toRecipient in message.toRecipients]),
         MailCC="",
         MailFrom=message.from_email.emailAddress.address,
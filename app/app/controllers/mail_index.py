@@ -0,0 +1,104 @@
+import asyncio
+from typing import Any, Dict, List
+
+from loguru import logger
+from sqlalchemy.orm import Session
+
+from app.core.bloom import BloomFilter
+from app.core.config import configuration
+from app.core.settings import settings
+from app.crud.crud_se_correspondence import CRUDSECorrespondence
+from app.db.db_session import tenant_db_session
+from app.models.se_correspondence import SECorrespondence
+
+
+class MailUniqueIdIndex:
+    """
+    Bloom filter of the MailUniqueIds in the mailstore of every tenant, warmed at startup from the db and
+    updated by this process on every save. Ids it does not contain are certainly not stored,
+    so "is this message stored" only goes to the db for the ones that may be.
+    The filter is per process: rows saved by other processes after the warm up are not in it, and it answers
+    "not stored" for them. Such a false negative only costs an extra lookup or body fetch, rows are still
+    saved with a get-or-create on the db, so the filter is never what keeps a message from being saved twice.
+    """
+
+    def __init__(self):
+        self._filters: Dict[str, BloomFilter] = {}
+        self._ready: Dict[str, bool] = {}
+        self._tasks: Dict[str, asyncio.Future] = {}
+        self.checked = 0
+        self.skipped = 0  # ids that did not need a db query
+
+    def start(self, tenants: List[str]) -> None:
+        if not settings.MAIL_ID_BLOOM_ENABLED:
+            return
+        loop = asyncio.get_event_loop()
+        for tenant in tenants:
+            task = self._tasks.get(tenant)
+            if task is None or (task.done() and not self._ready.get(tenant, False)):
+                self._tasks[tenant] = loop.run_in_executor(None, self.warm_up, tenant)
+
+    def warm_up(self, tenant: str) -> None:
+        """Loads every MailUniqueId of tenant, blocking, runs in a thread"""
+        self._ready[tenant] = False
+        try:
+            db_mailstore_name = configuration.tenant_configurations.get(tenant).db.db_mailstore_name
+            with tenant_db_session(tenant, db_mailstore_name) as db_mailstore:
+                crud = CRUDSECorrespondence(SECorrespondence)
+                rows = crud.count(db_mailstore)
+                bloom_filter = BloomFilter(
+                    max(settings.MAIL_ID_BLOOM_CAPACITY, 2 * rows), settings.MAIL_ID_BLOOM_ERROR_RATE
+                )
+                # saves from now on go into the new filter while it is filled
+                self._filters[tenant] = bloom_filter
+                for mail_unique_id in crud.iter_mail_unique_ids(db_mailstore):
+                    bloom_filter.add(mail_unique_id)
+            self._ready[tenant] = True
+            logger.bind(tenant=tenant, ids=bloom_filter.count, capacity=bloom_filter.capacity)\
+                .info("Warmed up MailUniqueId index")
+        except Exception as e:
+            self._filters.pop(tenant, None)
+            logger.bind(tenant=tenant, error=e).error(f"Could not warm up MailUniqueId index: {e}")
+
+    def add(self, tenant: str, mail_unique_ids: List[str]) -> None:
+        bloom_filter = self._filters.get(tenant)
+        if bloom_filter is None:
+            return
+        for mail_unique_id in mail_unique_ids:
+            if mail_unique_id:
+                bloom_filter.add(mail_unique_id)
+
+    def might_exist(self, tenant: str, mail_unique_id: str) -> bool:
+        if not self._ready.get(tenant, False):
+            return True
+        return mail_unique_id in self._filters[tenant]
+
+    def get_seq_nos(self, tenant: str, db_mailstore: Session, mail_unique_ids: List[str]) -> Dict[str, int]:
+        """SeqNo of the mail_unique_ids that are stored, with one batched query for those that may be"""
+        to_query = [
+            mail_unique_id for mail_unique_id in dict.fromkeys(mail_unique_ids)
+            if mail_unique_id and self.might_exist(tenant, mail_unique_id)
+        ]
+        self.checked += len(mail_unique_ids)
+        self.skipped += len(mail_unique_ids) - len(to_query)
+        if len(to_query) == 0:
+            return {}
+        return CRUDSECorrespondence(SECorrespondence).get_seq_nos_by_mail_unique_ids(
+            db_mailstore, mail_unique_ids=to_query, chunk_size=settings.DB_BULK_CHUNK_SIZE
+        )
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "tenants": {
+                tenant: {
+                    "ready": self._ready.get(tenant, False),
+                    "ids": bloom_filter.count,
+                    "capacity": bloom_filter.capacity,
+                } for tenant, bloom_filter in self._filters.items()
+            },
+            "checked": self.checked,
+            "skipped": self.skipped,
+        }
+
+
+mail_unique_id_index = MailUniqueIdIndex()
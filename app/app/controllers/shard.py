@@ -0,0 +1,166 @@
+import asyncio
+import hashlib
+import os
+import socket
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set, TypeVar
+
+from loguru import logger
+from sqlalchemy.orm import Session
+
+from app.core.config import configuration
+from app.core.settings import settings
+from app.crud.crud_mailbox_lease import CRUDMailboxLease
+from app.crud.crud_sync_worker import CRUDSyncWorker
+from app.db.db_executor import db_executor
+from app.db.db_session import tenant_db_session
+from app.models.mailbox_lease import MailboxLease
+from app.models.sync_worker import SyncWorker
+from app.schemas.schema_ms_graph import UserSchema
+
+T = TypeVar("T")
+
+
+def get_worker_id() -> str:
+    return settings.WORKER_ID or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def rendezvous_owner(key: str, worker_ids: List[str]) -> Optional[str]:
+    """
+    Highest random weight hashing: every worker computes the same owner for key without talking to the others,
+    and when a worker joins or leaves only the keys it owned (or will own) move.
+    """
+    if len(worker_ids) == 0:
+        return None
+    return max(worker_ids, key=lambda worker_id: hashlib.md5(f"{worker_id}:{key}".encode()).hexdigest())
+
+
+class MailboxShardCoordinator:
+    """
+    Splits the tracked mailboxes of a tenant between the sync workers sharing its mailstore db.
+
+    Workers heartbeat into SyncWorker. A mailbox belongs to one live worker by rendezvous hashing, and that
+    worker syncs it only while holding its MailboxLease, which is renewed with every heartbeat.
+    When a worker dies its heartbeat and leases expire, and its mailboxes move to the remaining workers.
+    """
+
+    def __init__(self):
+        self.worker_id = get_worker_id()
+        self._held: Dict[str, Set[str]] = {}  # tenant -> mailboxes we hold the lease of
+        self._tenants: Set[str] = set()  # tenants we heartbeat in
+        self._task: Optional[asyncio.Task] = None
+        # _held and _tenants are used from the event loop and from the db threads
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _mailstore_session(tenant: str):
+        return tenant_db_session(tenant, configuration.tenant_configurations.get(tenant).db.db_mailstore_name)
+
+    @staticmethod
+    async def _run_in_db_thread(func: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_event_loop().run_in_executor(db_executor.get_executor(), func, *args)
+
+    def get_held_mailboxes(self, tenant: str) -> List[str]:
+        with self._lock:
+            return list(self._held.get(tenant, set()))
+
+    def heartbeat(self, tenant: str) -> None:
+        """Blocking, run in a db thread"""
+        with self._lock:
+            self._tenants.add(tenant)
+        with MailboxShardCoordinator._mailstore_session(tenant) as db_mailstore:
+            CRUDSyncWorker(SyncWorker).heartbeat(db_mailstore, worker_id=self.worker_id)
+            CRUDMailboxLease(MailboxLease).renew(
+                db_mailstore, mailboxes=self.get_held_mailboxes(tenant), worker_id=self.worker_id,
+                ttl_sec=settings.MAILBOX_LEASE_TTL_SEC
+            )
+
+    def get_owned_mailboxes(self, db_mailstore: Session, mailboxes: List[str]) -> List[str]:
+        worker_ids = CRUDSyncWorker(SyncWorker).get_live_worker_ids(db_mailstore, ttl_sec=settings.WORKER_TTL_SEC)
+        if self.worker_id not in worker_ids:
+            worker_ids.append(self.worker_id)
+        return [mailbox for mailbox in mailboxes if rendezvous_owner(mailbox, worker_ids) == self.worker_id]
+
+    async def claim_users(self, tenant: str, users: List[UserSchema]) -> List[UserSchema]:
+        """Users whose mailbox is ours and whose lease we got. Release each with release() when done."""
+        self.ensure_started()
+        return await MailboxShardCoordinator._run_in_db_thread(self._claim_users, tenant, users)
+
+    def _claim_users(self, tenant: str, users: List[UserSchema]) -> List[UserSchema]:
+        self.heartbeat(tenant)
+        claimed: List[UserSchema] = []
+        with MailboxShardCoordinator._mailstore_session(tenant) as db_mailstore:
+            owned = set(self.get_owned_mailboxes(db_mailstore, [user.id for user in users]))
+            crud = CRUDMailboxLease(MailboxLease)
+            for user in users:
+                if user.id not in owned:
+                    continue
+                if crud.try_acquire(
+                        db_mailstore, mailbox=user.id, worker_id=self.worker_id, ttl_sec=settings.MAILBOX_LEASE_TTL_SEC
+                ):
+                    with self._lock:
+                        self._held.setdefault(tenant, set()).add(user.id)
+                    claimed.append(user)
+        logger.bind(tenant=tenant, worker_id=self.worker_id, users=len(users), owned=len(owned), claimed=len(claimed))\
+            .info("Claimed mailboxes")
+        return claimed
+
+    async def release(self, tenant: str, mailbox: str) -> None:
+        with self._lock:
+            self._held.get(tenant, set()).discard(mailbox)
+        try:
+            await MailboxShardCoordinator._run_in_db_thread(self._release_lease, tenant, mailbox)
+        except Exception as e:
+            # the lease expires on its own
+            logger.bind(tenant=tenant, mailbox=mailbox, error=e).error(f"Could not release MailboxLease: {e}")
+
+    def _release_lease(self, tenant: str, mailbox: str) -> None:
+        with MailboxShardCoordinator._mailstore_session(tenant) as db_mailstore:
+            CRUDMailboxLease(MailboxLease).release(db_mailstore, mailbox=mailbox, worker_id=self.worker_id)
+
+    async def start(self, tenants: List[str]) -> None:
+        """Announces this worker right away, so the first claims of every worker already see the others"""
+        for tenant in tenants:
+            try:
+                await MailboxShardCoordinator._run_in_db_thread(self.heartbeat, tenant)
+            except Exception as e:
+                logger.bind(tenant=tenant, worker_id=self.worker_id, error=e).error(f"Heartbeat failed: {e}")
+        self.ensure_started()
+
+    def ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(settings.WORKER_HEARTBEAT_SEC)
+            with self._lock:
+                tenants = list(self._tenants)
+            for tenant in tenants:
+                try:
+                    await MailboxShardCoordinator._run_in_db_thread(self.heartbeat, tenant)
+                except Exception as e:
+                    logger.bind(tenant=tenant, worker_id=self.worker_id, error=e).error(f"Heartbeat failed: {e}")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        # leave right away instead of waiting for WORKER_TTL_SEC, so the others pick up our mailboxes
+        with self._lock:
+            tenants = list(self._tenants)
+        for tenant in tenants:
+            try:
+                await MailboxShardCoordinator._run_in_db_thread(self._remove_worker, tenant)
+            except Exception as e:
+                logger.bind(tenant=tenant, worker_id=self.worker_id, error=e).error(f"Could not remove SyncWorker: {e}")
+
+
+    def _remove_worker(self, tenant: str) -> None:
+        with MailboxShardCoordinator._mailstore_session(tenant) as db_mailstore:
+            CRUDSyncWorker(SyncWorker).remove_by_worker_id(db_mailstore, worker_id=self.worker_id)
+
+
+mailbox_shard_coordinator = MailboxShardCoordinator()
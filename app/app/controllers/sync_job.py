@@ -0,0 +1,109 @@
+import asyncio
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from app.controllers.mail import MailController
+from app.core.auth import get_auth_config_and_confidential_client_application_and_access_token
+from app.core.config import configuration
+from app.core.settings import settings
+from app.db.db_session import tenant_db_session
+from app.schemas.schema_sync import SyncJob, SyncJobParams, SyncJobStatus
+
+
+class SyncJobManager:
+    """
+    Runs tenant and user syncs in the background, so the api can answer right away with a job to poll.
+    At most settings.SYNC_JOB_MAX_RUNNING jobs run at once, the others wait queued.
+    """
+
+    def __init__(self):
+        self._jobs: "OrderedDict[str, SyncJob]" = OrderedDict()
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def submit(self, tenant: str, params: SyncJobParams, user_id: Optional[str] = None) -> SyncJob:
+        job = SyncJob(
+            id=uuid.uuid4().hex, tenant=tenant, user_id=user_id, params=params, submitted_at=datetime.utcnow()
+        )
+        self._jobs[job.id] = job
+        self._remove_old_jobs()
+        task = asyncio.ensure_future(self._run(job))
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job.id, None))
+        logger.bind(job_id=job.id, tenant=tenant, user_id=user_id).info("Submitted sync job")
+        return job
+
+    def get(self, job_id: str) -> Optional[SyncJob]:
+        return self._jobs.get(job_id)
+
+    def get_multi(self, tenant: Optional[str] = None) -> List[SyncJob]:
+        return [job for job in reversed(self._jobs.values()) if tenant is None or job.tenant == tenant]
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _remove_old_jobs(self) -> None:
+        finished = [
+            job_id for job_id, job in self._jobs.items()
+            if job.status in (SyncJobStatus.succeeded, SyncJobStatus.failed)
+        ]
+        for job_id in finished[:max(0, len(finished) - settings.SYNC_JOB_HISTORY_SIZE)]:
+            self._jobs.pop(job_id, None)
+
+    async def _run(self, job: SyncJob) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(settings.SYNC_JOB_MAX_RUNNING)
+        try:
+            async with self._semaphore:
+                job.status = SyncJobStatus.running
+                job.started_at = datetime.utcnow()
+                await SyncJobManager._sync(job)
+                job.status = SyncJobStatus.succeeded
+        except asyncio.CancelledError:
+            job.status = SyncJobStatus.failed
+            job.error = "cancelled"
+            raise
+        except Exception as e:
+            job.status = SyncJobStatus.failed
+            job.error = str(e)
+            logger.bind(job_id=job.id, tenant=job.tenant, error=e).error(f"Sync job failed: {e}")
+        finally:
+            job.finished_at = datetime.utcnow()
+            logger.bind(job_id=job.id, tenant=job.tenant, status=job.status, progress=job.progress.dict())\
+                .info("Sync job finished")
+
+    @staticmethod
+    async def _sync(job: SyncJob) -> None:
+        # token is taken when the job starts, a queued job may wait longer than a token lives.
+        # a tenant sync takes the current token again for every mailbox
+        config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(job.tenant)
+        if token is None or "access_token" not in token:
+            raise RuntimeError(f"Unauthorized: {token.get('error_description') if token else None}")
+        tenant_db = configuration.tenant_configurations.get(job.tenant).db
+        params = job.params
+        if job.user_id is None:
+            with tenant_db_session(job.tenant, tenant_db.db_sales97_name) as db_sales97:
+                users, all_rows, all_links, results = await MailController.save_tenant_messages_and_attachments(
+                    token, job.tenant, db_sales97, params.top, params.filter, params.delta, params.two_phase,
+                    params.concurrency, params.use_checkpoint, job.progress
+                )
+            job.results = results
+            return
+        job.progress.mailboxes_total = 1
+        with tenant_db_session(job.tenant, tenant_db.db_fit_name) as db_fit, \
+                tenant_db_session(job.tenant, tenant_db.db_mailstore_name) as db_mailstore:
+            await MailController.save_user_messages_and_attachments(
+                token, job.tenant, job.user_id, db_fit, db_mailstore, params.top, params.filter, params.delta,
+                params.two_phase, params.use_checkpoint, job.progress
+            )
+        job.progress.mailboxes_done = 1
+
+
+sync_job_manager = SyncJobManager()
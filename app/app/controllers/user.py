@@ -1,19 +1,66 @@
-from typing import Any, Optional, List
+from typing import Any, Optional, List, Dict, Tuple
 
 from loguru import logger
 from sqlalchemy.orm import Session
 
 from app.apiclients.api_client import ApiClient
+from app.apiclients.batch_ms import MsBatchHelper
 from app.apiclients.endpoint_ms import MsEndpointsHelper, endpoints_ms, MsEndpointHelper
+from app.controllers.directory import tenant_directory
+from app.core.cache import TTLCache
+from app.core.settings import settings
 from app.crud.stored_procedures import StoredProcedures
-from app.schemas.schema_ms_graph import UsersSchema, UserSchema, UserResponseSchema
+from app.schemas.schema_endpoint_ms import MsEndpoint
+from app.schemas.schema_ms_graph import UsersSchema, UserSchema, UserResponseSchema, BatchRequestSchema
 from app.schemas.schema_sp import EmailTrackerGetEmailIDSchema
 
 
+class UserResolutionCache:
+    """
+    Email -> azure user, per tenant. Shared by everything resolving addresses, so the same
+    addresses showing up run after run (mostly external ones, cached as None) are looked up in msgraph once per ttl.
+    """
+
+    def __init__(self):
+        self._caches: Dict[str, TTLCache[UserSchema]] = {}
+
+    def get_cache(self, tenant: str) -> TTLCache[UserSchema]:
+        cache = self._caches.get(tenant)
+        if cache is None:
+            cache = TTLCache(
+                settings.USER_CACHE_MAX_SIZE, settings.USER_CACHE_TTL_SEC,
+                negative_ttl_sec=settings.USER_CACHE_NEGATIVE_TTL_SEC
+            )
+            self._caches[tenant] = cache
+        return cache
+
+    @staticmethod
+    def get_key(user_email: str, select: str) -> Tuple[str, str]:
+        # addresses are case insensitive, and so is the msgraph filter
+        return user_email.strip().lower(), select
+
+    def get(self, tenant: str, user_email: str, select: str) -> Tuple[bool, Optional[UserSchema]]:
+        return self.get_cache(tenant).get(UserResolutionCache.get_key(user_email, select))
+
+    def set(self, tenant: str, user_email: str, select: str, user: Optional[UserSchema]) -> None:
+        self.get_cache(tenant).set(UserResolutionCache.get_key(user_email, select), user)
+
+    def clear(self, tenant: Optional[str] = None) -> None:
+        for cache_tenant, cache in self._caches.items():
+            if tenant is None or cache_tenant == tenant:
+                cache.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {tenant: cache.snapshot() for tenant, cache in self._caches.items()}
+
+
+user_resolution_cache = UserResolutionCache()
+
+
 class UserController:
 
     @staticmethod
-    async def get_users(token: Any, top: int, select: str, filter: str) -> Optional[UsersSchema]:
+    async def get_users(token: Any, tenant: str, top: int, select: str, filter: str) -> Optional[UsersSchema]:
         # ms graph api - https://docs.microsoft.com/en-us/graph/api/user-list?view=graph-rest-1.0&tabs=http
         endpoint = MsEndpointsHelper.get_endpoint("user:list", endpoints_ms)
         if top >= 0 or top <= 1000: endpoint.optional_query_params.top = top
@@ -21,30 +68,114 @@ class UserController:
         endpoint.optional_query_params.filter = filter
         # We can get url from endpoint as is. This is because this endpoint url is simple get
         url = MsEndpointHelper.form_url(endpoint)
-        response, data = await ApiClient('get', url, headers=ApiClient.get_headers(token)).retryable_call()
+        response, data = await ApiClient(
+            'get', url, headers=ApiClient.get_headers(token), tenant=tenant, endpoint_name="user:list"
+        ).retryable_call()
         if data is None: return None
         users = UsersSchema(**data)
         return users
 
     @staticmethod
-    async def get_user(token: Any, user_id: str) -> Optional[UserResponseSchema]:
+    async def get_user(token: Any, tenant: str, user_id: str) -> Optional[UserResponseSchema]:
         # ms graph api - https://docs.microsoft.com/en-us/graph/api/user-get?view=graph-rest-1.0&tabs=http
         endpoint = MsEndpointsHelper.get_endpoint("user:get", endpoints_ms)
         # update the endpoint request_params
         endpoint.request_params["user_id"] = user_id
         url = MsEndpointHelper.form_url(endpoint)
-        response, data = await ApiClient('get', url, headers=ApiClient.get_headers(token)).retryable_call()
+        response, data = await ApiClient(
+            'get', url, headers=ApiClient.get_headers(token), tenant=tenant, endpoint_name="user:get"
+        ).retryable_call()
         return UserResponseSchema(**data)# if type(data) == 'dict' else None
 
     @staticmethod
-    async def get_user_by_email(token: Any, user_email: str, select: str) -> Optional[UserSchema]:
+    async def get_user_by_email(token: Any, tenant: str, user_email: str, select: str) -> Optional[UserSchema]:
+        found, user = user_resolution_cache.get(tenant, user_email, select)
+        if found:
+            return user
+        endpoint = UserController._get_user_by_email_endpoint(user_email, select)
+        url = MsEndpointHelper.form_url(endpoint)
+        response, data = await ApiClient(
+            'get', url, headers=ApiClient.get_headers(token), tenant=tenant, endpoint_name="user:list"
+        ).retryable_call()
+        user = UserController._to_first_user(user_email, data)
+        # failed calls are not cached, only answers from msgraph
+        if UserController._is_user_list(data):
+            user_resolution_cache.set(tenant, user_email, select, user)
+        return user
+
+    @staticmethod
+    async def get_users_by_email(
+            token: Any, tenant: str, user_emails: List[str], select: str
+    ) -> Dict[str, Optional[UserSchema]]:
+        """
+        Same as get_user_by_email for many emails, sent as msgraph $batch requests.
+        Emails found in user_resolution_cache are not requested.
+
+        :param token: Any
+        :param tenant: str
+        :param user_emails: List[str]
+        :param select: str
+        :return: Dict[str, Optional[UserSchema]], keyed by email
+        """
+        users: Dict[str, Optional[UserSchema]] = {}
+        unique_emails: List[str] = []
+        for user_email in dict.fromkeys(user_emails):
+            found, user = user_resolution_cache.get(tenant, user_email, select)
+            if found:
+                users[user_email] = user
+            else:
+                unique_emails.append(user_email)
+        if len(unique_emails) == 0:
+            return users
+        requests: List[BatchRequestSchema] = [
+            MsBatchHelper.to_batch_request(str(i), UserController._get_user_by_email_endpoint(user_email, select))
+            for i, user_email in enumerate(unique_emails)
+        ]
+        responses = await MsBatchHelper.call(token, requests, tenant=tenant)
+        for i, user_email in enumerate(unique_emails):
+            response = responses.get(str(i))
+            if response is None or response.status != 200:
+                logger.bind(user_email=user_email, status=response.status if response else None).error(
+                    "Cannot get user by email from msgraph batch"
+                )
+                users[user_email] = None
+                continue
+            users[user_email] = UserController._to_first_user(user_email, response.body)
+            if UserController._is_user_list(response.body):
+                user_resolution_cache.set(tenant, user_email, select, users[user_email])
+        return users
+
+    @staticmethod
+    async def resolve_users_by_email(token: Any, tenant: str, user_emails: List[str]) -> Dict[str, Optional[UserSchema]]:
+        """
+        Users (id and addresses only) for many emails. Resolved from the tenant directory snapshot when there is one,
+        with get_users_by_email otherwise.
+
+        :param token: Any
+        :param tenant: str
+        :param user_emails: List[str]
+        :return: Dict[str, Optional[UserSchema]], keyed by email
+        """
+        snapshot = await tenant_directory.get_or_build_snapshot(token, tenant)
+        if snapshot is None:
+            return await UserController.get_users_by_email(token, tenant, user_emails, "")
+        return {user_email: snapshot.get_user(user_email) for user_email in user_emails}
+
+    @staticmethod
+    def _get_user_by_email_endpoint(user_email: str, select: str) -> MsEndpoint:
         endpoint = MsEndpointsHelper.get_endpoint("user:list", endpoints_ms)
         endpoint.optional_query_params.top = 5
         endpoint.optional_query_params.select = select
         # endpoint.optional_query_params.filter = f"mail eq '{user_email}'"
         endpoint.optional_query_params.filter = f"mail in ('{user_email}') or proxyAddresses/any(x:x eq 'smtp:{user_email}')"
-        url = MsEndpointHelper.form_url(endpoint)
-        response, data = await ApiClient('get', url, headers=ApiClient.get_headers(token)).retryable_call()
+        return endpoint
+
+    @staticmethod
+    def _is_user_list(data: Any) -> bool:
+        return isinstance(data, dict) and isinstance(data.get("value"), list)
+
+    @staticmethod
+    def _to_first_user(user_email: str, data: Any) -> Optional[UserSchema]:
         if data is None or "value" not in data or len(data["value"]) == 0:
             logger.bind(user_email=user_email, data=data).debug("Empty response for user list from msgraph")
             return None
@@ -57,15 +188,19 @@ class UserController:
     @staticmethod
     async def get_users_to_track(
             token: Any,
+            tenant: str,
             db_sales97: Session,
     ) -> List[UserSchema]:
         # get list of trackable users
         users_to_track: List[EmailTrackerGetEmailIDSchema] = \
             await StoredProcedures.dhruv_EmailTrackerGetEmailID(db_sales97)
         # get user ids for those email ids
+        users_by_email: Dict[str, Optional[UserSchema]] = await UserController.resolve_users_by_email(
+            token, tenant, [user_to_track.EMailId for user_to_track in users_to_track]
+        )
         users: List[UserSchema] = []
         for user_to_track in users_to_track:
-            user = await UserController.get_user_by_email(token, user_to_track.EMailId, "")
+            user = users_by_email.get(user_to_track.EMailId)
             if user is None:
                 logger.bind(user_to_track=user_to_track).error("Cannot find in Azure")
             else:
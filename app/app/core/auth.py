@@ -1,7 +1,17 @@
 #  MS Identity Platform
+import asyncio
 import json
+import os
 import sys
-from typing import Any, Union, Tuple, Dict, Optional
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Union, Tuple, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
 
 import msal
 from loguru import logger
@@ -46,22 +56,140 @@ from app.core.settings import settings
 # ms_auth_configs = load_ms_auth_configs(f"{settings.CONFIGURATION_PATH}configuration/ms_auth_configs.json")
 
 
+class FileTokenCache(msal.SerializableTokenCache):
+    """
+    msal token cache kept in a file shared by all processes (uvicorn workers, schedulers, ..) of a host,
+    so a token fetched by one process is used by the others until it expires.
+    The file is re-read before every lookup if another process changed it, and every change is written
+    back under an exclusive lock (fcntl.flock on path + ".lock"), merged into what is on disk at that moment.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._lock_path = f"{path}.lock"
+        self._mtime: Optional[float] = None
+        # msal calls modify from inside add, only the outermost call takes the file lock
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        with self._thread_lock:
+            if self._depth > 0 or fcntl is None:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+            with open(self._lock_path, "a") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _reload(self) -> None:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.path, "r") as cache_file:
+            state = cache_file.read()
+        if state:
+            self.deserialize(state)
+        self._mtime = mtime
+
+    def _save(self) -> None:
+        if not self.has_state_changed:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as cache_file:
+            cache_file.write(self.serialize())
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.path)
+        self._mtime = os.path.getmtime(self.path)
+        self.has_state_changed = False
+
+    def find(self, *args, **kwargs):
+        with self._file_lock(exclusive=False):
+            self._reload()
+            return super().find(*args, **kwargs)
+
+    def search(self, *args, **kwargs):
+        # newer msal looks tokens up with search, find is kept for older versions
+        with self._file_lock(exclusive=False):
+            self._reload()
+            return list(super().search(*args, **kwargs))
+
+    def add(self, event, **kwargs):
+        with self._file_lock(exclusive=True):
+            self._reload()
+            super().add(event, **kwargs)
+            self._save()
+
+    def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+        with self._file_lock(exclusive=True):
+            self._reload()
+            super().modify(credential_type, old_entry, new_key_value_pairs)
+            self._save()
+
+
+_file_token_cache: Optional[FileTokenCache] = None
+
+
+def get_token_cache() -> Optional[msal.TokenCache]:
+    """The token cache shared by the client applications of all tenants, None keeps msal's in memory default"""
+    global _file_token_cache
+    if not settings.MSAL_TOKEN_CACHE_PATH:
+        return None
+    if _file_token_cache is None:
+        _file_token_cache = FileTokenCache(settings.MSAL_TOKEN_CACHE_PATH)
+    return _file_token_cache
+
+
 def get_confidential_client_application(config: AzureAuth) -> ConfidentialClientApplication:
-    # TODO: make ConfidentialClientApplication long-lived (should be 1 for each tenant)
+    # long-lived, one for each tenant in msal_client_registry
     app: ConfidentialClientApplication = msal.ConfidentialClientApplication(
         config.client_id,
         authority=config.authority,
         client_credential=config.secret,
-        # token_cache=cache
-        # token_cache=...  # Default cache is in memory only.
-        # You can learn how to use SerializableTokenCache from
-        # https://msal-python.rtfd.io/en/latest/#msal.SerializableTokenCache
+        token_cache=get_token_cache()
     )
     return app
 
 
-def get_access_token(config: AzureAuth, app: ConfidentialClientApplication):
-    logger.bind().info("Getting access token")
+def remove_cached_access_token(config: AzureAuth, app: ConfidentialClientApplication, access_token: str) -> None:
+    cache = app.token_cache
+    search = getattr(cache, "search", cache.find)
+    cached_access_tokens = list(search(
+        msal.TokenCache.CredentialType.ACCESS_TOKEN, target=config.scope, query={"client_id": config.client_id}
+    ))
+    for cached_access_token in cached_access_tokens:
+        if cached_access_token.get("secret") == access_token:
+            cache.remove_at(cached_access_token)
+
+
+def get_access_token(
+        config: AzureAuth, app: ConfidentialClientApplication, rejected_access_token: Optional[str] = None
+):
+    """
+    Cache first, so the processes sharing the token cache share the token, msal refreshes it near expiry.
+
+    :param config: AzureAuth
+    :param app: ConfidentialClientApplication
+    :param rejected_access_token: Optional[str], token msgraph answered 401 to, never returned again
+    :return: msal result
+    """
+    logger.bind(rejected=rejected_access_token is not None).info("Getting access token")
     # The pattern to acquire a token looks like this.
     result = None
 
@@ -72,22 +200,138 @@ def get_access_token(config: AzureAuth, app: ConfidentialClientApplication):
 
     if not result:
         logger.info("No suitable token exists in cache. Let's get a new one from AAD.")
+        # msal >= 1.23 looks up its cache here as well
+        result = app.acquire_token_for_client(scopes=config.scope)
+
+    if rejected_access_token is not None and result and result.get("access_token") == rejected_access_token:
+        # nothing newer in the cache, e.g. from another process
+        remove_cached_access_token(config, app, rejected_access_token)
         result = app.acquire_token_for_client(scopes=config.scope)
 
     return result
 
 
-client_app:  ConfidentialClientApplication = None
+class MsalClientRegistry:
+    """
+    One ConfidentialClientApplication per tenant and the last token of each.
+    Tokens are warmed up at start and refreshed in the background before they expire, so getting a token
+    is a dict lookup. When AAD has to be called anyway (no token yet, or it expired) the msal call runs
+    in a thread, never on the event loop.
+    """
+
+    def __init__(self):
+        self._apps: Dict[str, ConfidentialClientApplication] = {}
+        self._tokens: Dict[str, Dict[str, Any]] = {}
+        self._expires_at: Dict[str, float] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def get_client_application(self, tenant: str, create: bool = True) -> Optional[ConfidentialClientApplication]:
+        """
+        Creating the application calls AAD (authority discovery), from async code it is created by get_token
+
+        :param tenant: str
+        :param create: bool, False only returns an application created before
+        :return: Optional[ConfidentialClientApplication]
+        """
+        app = self._apps.get(tenant)
+        if app is None and create:
+            config = configuration.get_ms_auth_config(tenant)
+            if config is None:
+                return None
+            app = get_confidential_client_application(config)
+            self._apps[tenant] = app
+        return app
+
+    def _get_valid_token(self, tenant: str, min_validity_sec: float) -> Optional[Dict[str, Any]]:
+        token = self._tokens.get(tenant)
+        if token is None or self._expires_at.get(tenant, 0) - time.monotonic() <= min_validity_sec:
+            return None
+        return token
+
+    async def get_token(self, tenant: str, force_refresh: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Token of tenant, as returned by msal: the error result if AAD refused, None if tenant is not configured.
+
+        :param tenant: str
+        :param force_refresh: bool, the current token was rejected (401), get another one even if still valid
+        :return: Optional[Dict[str, Any]]
+        """
+        rejected_access_token: Optional[str] = None
+        if force_refresh:
+            rejected_access_token = (self._tokens.get(tenant) or {}).get("access_token")
+        return await self._acquire(tenant, settings.MSAL_TOKEN_MIN_VALIDITY_SEC, rejected_access_token)
+
+    async def _acquire(
+            self, tenant: str, min_validity_sec: float, rejected_access_token: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        def get_reusable_token() -> Optional[Dict[str, Any]]:
+            token = self._get_valid_token(tenant, min_validity_sec)
+            if token is None or (rejected_access_token is not None and token["access_token"] == rejected_access_token):
+                return None
+            return token
+
+        token = get_reusable_token()
+        if token is not None:
+            return token
+        config = configuration.get_ms_auth_config(tenant)
+        if config is None:
+            return None
+        lock = self._locks.setdefault(tenant, asyncio.Lock())
+        async with lock:
+            # refreshed by whoever held the lock before us
+            token = get_reusable_token()
+            if token is not None:
+                return token
+            loop = asyncio.get_event_loop()
+            app = self.get_client_application(tenant, create=False)
+            if app is None:
+                app = await loop.run_in_executor(None, self.get_client_application, tenant)
+            requested_at = time.monotonic()
+            token = await loop.run_in_executor(None, get_access_token, config, app, rejected_access_token)
+            if token is not None and "access_token" in token:
+                self._tokens[tenant] = token
+                self._expires_at[tenant] = requested_at + float(token.get("expires_in", 0))
+            else:
+                logger.bind(
+                    tenant=tenant, error=token.get("error") if token else None,
+                    error_description=token.get("error_description") if token else None
+                ).error("Could not get access token")
+            return token
+
+    def start(self, tenants: List[str]) -> None:
+        """Warms up the tokens of tenants and keeps them fresh, without waiting for AAD"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._refresh_loop(tenants))
+
+    async def _refresh_loop(self, tenants: List[str]) -> None:
+        while True:
+            for tenant in set(tenants) | set(self._tokens.keys()):
+                if self._get_valid_token(tenant, settings.MSAL_TOKEN_REFRESH_BEFORE_EXPIRY_SEC) is not None:
+                    continue
+                try:
+                    # cache first, another process may have refreshed it already
+                    await self._acquire(tenant, settings.MSAL_TOKEN_REFRESH_BEFORE_EXPIRY_SEC)
+                except Exception as e:
+                    logger.bind(tenant=tenant, error=e).error(f"Could not refresh access token: {e}")
+            await asyncio.sleep(settings.MSAL_TOKEN_REFRESH_CHECK_SEC)
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+
+msal_client_registry = MsalClientRegistry()
 
 
-def get_auth_config_and_confidential_client_application_and_access_token(
+async def get_auth_config_and_confidential_client_application_and_access_token(
         tenant
 ) -> Union[Tuple[AzureAuth, ConfidentialClientApplication, Any], Tuple[None, None, None]]:
-    global client_app
     config = configuration.get_ms_auth_config(tenant)
     if config is not None:
-        if client_app is None:
-            client_app = get_confidential_client_application(config)
-        token = get_access_token(config, client_app)
-        return config, client_app, token
+        token = await msal_client_registry.get_token(tenant)
+        return config, msal_client_registry.get_client_application(tenant, create=False), token
     return config, None, None
@@ -0,0 +1,74 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """
+    Size bounded LRU cache whose entries expire ttl_sec after they are set.
+    None is a value like any other, so misses can be cached too (negative caching), usually with a shorter ttl.
+    """
+
+    def __init__(self, max_size: int, ttl_sec: float, negative_ttl_sec: Optional[float] = None):
+        self.max_size = max(1, max_size)
+        self.ttl_sec = ttl_sec
+        self.negative_ttl_sec = ttl_sec if negative_ttl_sec is None else negative_ttl_sec
+        self._entries: "OrderedDict[Hashable, Tuple[float, Optional[V]]]" = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Tuple[bool, Optional[V]]:
+        """:return: Tuple[bool, Optional[V]], (found, value)"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        if value is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return True, value
+
+    def set(self, key: Hashable, value: Optional[V]) -> None:
+        ttl_sec = self.ttl_sec if value is not None else self.negative_ttl_sec
+        if ttl_sec <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl_sec, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def remove(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups > 0 else 0.0,
+        }
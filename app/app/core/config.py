@@ -85,6 +85,20 @@ class Disk(BaseModel):
     disk_base_path: str
 
 
+class RateLimit(BaseModel):
+    # msgraph throttles per app per tenant and per app per mailbox
+    # https://docs.microsoft.com/en-us/graph/throttling#outlook-service-limits
+    tenant_requests_per_sec: float = 50.0
+    tenant_burst: int = 100
+    mailbox_requests_per_sec: float = 8.0
+    mailbox_burst: int = 20
+    # on 429 the rate is multiplied by decrease_factor (not below min_requests_per_sec),
+    # then grows back by increase_per_success for every successful call
+    min_requests_per_sec: float = 0.5
+    decrease_factor: float = 0.5
+    increase_per_success: float = 0.05
+
+
 class JobType(Enum):
     EmailIntegrate = 'EmailIntegrate'
 
@@ -99,9 +113,23 @@ class MailIntegrateJobDependency(Enum):
     EmailLink = 'EmailLink'
 
 
+DEFAULT_DELTA_FOLDERS = ["inbox", "sentitems"]
+
+
 class MailIntegrateJob(Job):
     job_type: JobType = JobType.EmailIntegrate
     dependencies: List[MailIntegrateJobDependency]
+    # mail folders tracked with msgraph delta queries (well-known names or folder ids)
+    delta_folders: List[str] = DEFAULT_DELTA_FOLDERS
+    # scheduling, see app.scheduler
+    enabled: bool = True
+    interval_sec: int = 3600
+    jitter_sec: int = 60  # random delay added to every run, so tenants do not all start at the same moment
+    catch_up: bool = True  # run once right away after missed runs, instead of waiting for the next slot
+    lookback_sec: int = 3600  # how far back the first run after a (re)start looks for messages
+    top: int = 500
+    delta: bool = False
+    two_phase: bool = False
 
 
 class TenantConfiguration(Tenant):
@@ -110,6 +138,7 @@ class TenantConfiguration(Tenant):
     aws: Optional[AWS]
     disk: Disk
     mail_integrate_job: Optional[MailIntegrateJob]
+    rate_limit: RateLimit = RateLimit()
 
 
 class Configuration(BaseModel):
@@ -0,0 +1,27 @@
+import base64
+import json
+from typing import Optional
+
+
+class InvalidCursorException(ValueError):
+    pass
+
+
+def encode_seq_no_cursor(seq_no: Optional[int]) -> Optional[str]:
+    """Opaque cursor for keyset pagination on SeqNo, None when there is no next page"""
+    if seq_no is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps({"SeqNo": seq_no}).encode()).decode().rstrip("=")
+
+
+def decode_seq_no_cursor(cursor: Optional[str]) -> Optional[int]:
+    """
+    raise: InvalidCursorException
+    """
+    if not cursor:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return int(data["SeqNo"])
+    except Exception as e:
+        raise InvalidCursorException(f"Invalid cursor: {cursor}") from e
@@ -0,0 +1,96 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+# end of stream marker passed down the queues
+_DONE = object()
+
+
+class PipelineStage:
+    """
+    A step of a pipeline. handler is awaited for every item, by up to workers items at a time.
+    The item object itself carries the results to the next stages.
+    """
+
+    def __init__(self, name: str, handler: Callable[[Any], Awaitable[None]], workers: int = 1):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+
+
+async def run_pipeline(
+        source: AsyncIterator[Any],
+        stages: List[PipelineStage],
+        *,
+        queue_size: int,
+        on_item_done: Optional[Callable[[int, Any], Awaitable[None]]] = None
+) -> int:
+    """
+    Runs the items of source through stages connected by bounded queues.
+    A full queue blocks the stage before it, so a slow stage slows down the ones feeding it (and source)
+    instead of items piling up in memory.
+    on_item_done is called in source order, whatever order the items finish in.
+    The first exception of any stage cancels the whole pipeline and is raised.
+
+    :param source: AsyncIterator[Any]
+    :param stages: List[PipelineStage]
+    :param queue_size: int, items waiting in front of each stage
+    :param on_item_done: Optional[Callable[[int, Any], Awaitable[None]]], called with (index, item)
+    :return: int, number of items
+    """
+    queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=max(1, queue_size)) for _ in range(len(stages) + 1)]
+    running_workers: List[int] = [stage.workers for stage in stages]
+    produced = 0
+
+    async def produce() -> None:
+        nonlocal produced
+        try:
+            async for item in source:
+                await queues[0].put((produced, item))
+                produced += 1
+        finally:
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        for _ in range(stages[0].workers):
+            await queues[0].put(_DONE)
+
+    async def work(stage_index: int) -> None:
+        stage = stages[stage_index]
+        while True:
+            entry = await queues[stage_index].get()
+            if entry is _DONE:
+                break
+            await stage.handler(entry[1])
+            await queues[stage_index + 1].put(entry)
+        running_workers[stage_index] -= 1
+        # the last worker of a stage closes the queue of the next one
+        if running_workers[stage_index] == 0:
+            next_workers = stages[stage_index + 1].workers if stage_index + 1 < len(stages) else 1
+            for _ in range(next_workers):
+                await queues[stage_index + 1].put(_DONE)
+
+    async def sink() -> None:
+        finished: Dict[int, Any] = {}
+        next_index = 0
+        while True:
+            entry = await queues[-1].get()
+            if entry is _DONE:
+                break
+            finished[entry[0]] = entry[1]
+            while next_index in finished:
+                item = finished.pop(next_index)
+                if on_item_done is not None:
+                    await on_item_done(next_index, item)
+                next_index += 1
+
+    tasks = [asyncio.ensure_future(produce()), asyncio.ensure_future(sink())]
+    for stage_index, stage in enumerate(stages):
+        tasks.extend(asyncio.ensure_future(work(stage_index)) for _ in range(stage.workers))
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return produced
@@ -21,6 +21,62 @@ class Settings(BaseSettings):
     # Configuration
     CONFIGURATION_PATH = ""
     CONFIGURATION_LOC = "../configuration"
+    ## MSAL tokens (one client application per tenant)
+    MSAL_TOKEN_MIN_VALIDITY_SEC = 60  # tokens expiring sooner are not handed out
+    MSAL_TOKEN_REFRESH_BEFORE_EXPIRY_SEC = 600  # background refresh starts this long before expiry
+    MSAL_TOKEN_REFRESH_CHECK_SEC = 60
+    MSAL_TOKEN_CACHE_PATH = ""  # file shared by the processes of a host, e.g. /var/cache/dhruv/msal_token_cache.json
+    ## Db connection pools, one per tenant and db
+    DB_POOL_SIZE = 5
+    DB_POOL_MAX_OVERFLOW = 10  # connections opened above DB_POOL_SIZE at peaks, closed when returned
+    DB_POOL_TIMEOUT_SEC = 30  # wait for a free connection before failing
+    DB_POOL_RECYCLE_SEC = 1800  # reconnect connections older than this, before the server drops them
+    DB_POOL_PRE_PING = True  # test connections when taken from the pool
+    DB_EXECUTOR_MAX_WORKERS = 32  # threads running blocking db calls for async code
+    DB_TENANT_CONCURRENCY = 8  # db calls of a tenant running at once, keep below DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW
+    DB_BULK_CHUNK_SIZE = 500  # rows per executemany and values per IN query (mssql takes at most 2100 parameters)
+    STORED_PROCEDURE_BATCH_SIZE = 50  # stored procedure execs per round-trip, keep execs * params below 2100
+    ## Http client (aiohttp)
+    HTTP_POOL_LIMIT = 100  # total connections per session, 0 is unlimited
+    HTTP_POOL_LIMIT_PER_HOST = 20  # connections per host per session, 0 is unlimited
+    HTTP_KEEPALIVE_TIMEOUT = 30  # seconds an idle connection is kept in the pool
+    HTTP_DNS_CACHE_TTL = 300
+    HTTP_SESSION_PER_TENANT = False  # one connection pool for each tenant instead of one per process
+    HTTP_RETRY_MAX_ATTEMPTS = 5
+    HTTP_RETRY_BASE_DELAY_SEC = 1.0
+    HTTP_RETRY_MAX_DELAY_SEC = 60.0
+    HTTP_RETRY_MAX_TOTAL_SEC = 300.0  # no retry starts once a call has taken this long, attempts included
+    ## Bloom filter of the stored MailUniqueIds of every tenant, skips "is it stored" queries for new messages
+    MAIL_ID_BLOOM_ENABLED = True
+    MAIL_ID_BLOOM_CAPACITY = 1000000  # ids per tenant, grown to twice the stored ids at warm up
+    MAIL_ID_BLOOM_ERROR_RATE = 0.01
+    ## Email -> azure user resolution cache, per tenant
+    USER_CACHE_MAX_SIZE = 10000  # addresses per tenant, least recently used are evicted
+    USER_CACHE_TTL_SEC = 3600
+    USER_CACHE_NEGATIVE_TTL_SEC = 3600  # addresses not found in azure (external senders), 0 disables
+    ## Directory snapshot of every tenant (users by address), resolves users without msgraph calls
+    DIRECTORY_SNAPSHOT_ENABLED = True
+    DIRECTORY_REFRESH_SEC = 900
+    DIRECTORY_MAX_AGE_SEC = 3600  # older snapshots are not used, lookups go to msgraph
+    ## Mail sync
+    MAIL_SYNC_MAILBOX_CONCURRENCY = 8  # mailboxes of a tenant synced at the same time
+    ## Mail sync pipeline of a mailbox: list -> classify -> save -> attachments
+    MAIL_PIPELINE_QUEUE_SIZE = 2  # pages waiting in front of each stage
+    MAIL_PIPELINE_CLASSIFY_WORKERS = 1
+    MAIL_PIPELINE_SAVE_WORKERS = 1  # stages share the db sessions of the mailbox, more workers only interleave
+    MAIL_PIPELINE_ATTACHMENT_WORKERS = 2
+    ## Sharding of mailboxes between sync workers (processes or hosts) sharing a mailstore db
+    SHARDING_ENABLED = False
+    WORKER_ID = ""  # defaults to hostname-pid
+    WORKER_HEARTBEAT_SEC = 30
+    WORKER_TTL_SEC = 90  # a worker without heartbeat for this long is dead, its mailboxes move to the others
+    MAILBOX_LEASE_TTL_SEC = 300  # renewed on every heartbeat while the mailbox is synced
+    ## Sync jobs (submit / poll api)
+    SYNC_JOB_MAX_RUNNING = 2  # more submitted jobs wait in the queue
+    SYNC_JOB_HISTORY_SIZE = 100  # finished jobs kept for polling
+    ## Scheduler
+    SCHEDULER_IN_PROCESS = False  # run the mail integrate jobs inside the api process
+    SCHEDULER_HISTORY_SIZE = 50  # runs kept per job
 
 
 settings = Settings()
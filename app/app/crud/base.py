@@ -27,8 +27,19 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
     def get(self, db: Session, seq_no: Any) -> Optional[ModelType]:
         return db.query(self.model).filter(self.model.SeqNo == seq_no).first()
 
-    def get_multi(self, db: Session, *, skip: int = 0, limit: int = 100) -> List[ModelType]:
-        return db.query(self.model).order_by(self.model.SeqNo).offset(skip).limit(limit).all()
+    def get_multi(
+            self, db: Session, *, skip: int = 0, limit: int = 100, after_seq_no: Optional[int] = None
+    ) -> List[ModelType]:
+        """
+        Rows by SeqNo. Pass the SeqNo of the last row of a page as after_seq_no to get the next one (keyset
+        pagination), it costs the same at any depth unlike skip, which the db has to scan through.
+        """
+        query = db.query(self.model).order_by(self.model.SeqNo)
+        if after_seq_no is not None:
+            query = query.filter(self.model.SeqNo > after_seq_no)
+        else:
+            query = query.offset(skip)
+        return query.limit(limit).all()
 
     def exists(self, db: Session, *, SeqNo: Any) -> bool:
         return db.query(SeqNo).filter(self.model.id == SeqNo).first() is not None
@@ -51,6 +62,50 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
                 logger.bind(obj_in=obj_in).error("Cannot create")
         return db_objs
 
+    def get_by_keys(self, db: Session, *, key: str, values: List[Any], chunk_size: int = 500) -> List[ModelType]:
+        """Rows whose key column is in values, one IN query per chunk_size values"""
+        column = getattr(self.model, key)
+        db_objs: List[ModelType] = []
+        for i in range(0, len(values), chunk_size):
+            db_objs.extend(db.query(self.model).filter(column.in_(values[i:i + chunk_size])).all())
+        return db_objs
+
+    def bulk_get_or_create(
+            self, db: Session, *, obj_ins: List[CreateSchemaType], key: str, chunk_size: int = 500
+    ) -> List[ModelType]:
+        """
+        Rows for obj_ins (matched on the key column), inserting the missing ones.
+        Existence is checked with IN queries, the missing rows are inserted with executemany and committed
+        in a single transaction, then read back to get their generated columns.
+
+        :param db: Session
+        :param obj_ins: List[CreateSchemaType]
+        :param key: str, unique column of the model, e.g. "MailUniqueId"
+        :param chunk_size: int, values per IN query / rows per executemany
+        :return: List[ModelType], in obj_ins order (one per key)
+        """
+        obj_ins_by_key: Dict[Any, CreateSchemaType] = {}
+        for obj_in in obj_ins:
+            obj_ins_by_key.setdefault(getattr(obj_in, key), obj_in)
+        keys = list(obj_ins_by_key.keys())
+        db_objs_by_key: Dict[Any, ModelType] = {
+            getattr(db_obj, key): db_obj for db_obj in self.get_by_keys(db, key=key, values=keys, chunk_size=chunk_size)
+        }
+        missing_keys = [k for k in keys if k not in db_objs_by_key]
+        if len(missing_keys) > 0:
+            try:
+                for i in range(0, len(missing_keys), chunk_size):
+                    db.bulk_insert_mappings(
+                        self.model, [obj_ins_by_key[k].dict() for k in missing_keys[i:i + chunk_size]]
+                    )
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                raise e
+            for db_obj in self.get_by_keys(db, key=key, values=missing_keys, chunk_size=chunk_size):
+                db_objs_by_key[getattr(db_obj, key)] = db_obj
+        return [db_objs_by_key[k] for k in keys if k in db_objs_by_key]
+
     def update(self, db: Session, *, db_obj: ModelType, obj_in: Union[UpdateSchemaType, Dict[str, Any]]) -> ModelType:
         obj_data = jsonable_encoder(db_obj)
         if isinstance(obj_in, dict):
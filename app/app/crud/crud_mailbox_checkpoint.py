@@ -0,0 +1,41 @@
+from datetime import datetime
+from typing import Optional
+
+from loguru import logger
+from sqlalchemy.orm import Session
+
+from app.crud.base import CRUDBase
+from app.models.mailbox_checkpoint import MailboxCheckpoint
+from app.schemas.schema_db import MailboxCheckpointCreate, MailboxCheckpointUpdate
+
+
+class CRUDMailboxCheckpoint(CRUDBase[MailboxCheckpoint, MailboxCheckpointCreate, MailboxCheckpointUpdate]):
+
+    def get_by_mailbox(self, db: Session, *, mailbox: str) -> Optional[MailboxCheckpoint]:
+        return db.query(self.model).filter(self.model.Mailbox == mailbox).first()
+
+    def upsert_checkpoint(
+            self,
+            db: Session,
+            *,
+            mailbox: str,
+            received_date_time: Optional[datetime],
+            filter: str,
+            next_link: Optional[str]
+    ) -> MailboxCheckpoint:
+        curr_date_time = datetime.utcnow()
+        db_obj = self.get_by_mailbox(db, mailbox=mailbox)
+        if db_obj is None:
+            logger.bind(mailbox=mailbox).info("Creating row in MailboxCheckpoint")
+            obj_in = MailboxCheckpointCreate(
+                Mailbox=mailbox, ReceivedDateTime=received_date_time, Filter=filter, NextLink=next_link,
+                UpdDate=curr_date_time
+            )
+            db_obj = self.model(**obj_in.dict())
+            db.add(db_obj)
+            db.commit()
+            db.refresh(db_obj)
+            return db_obj
+        return self.update(db, db_obj=db_obj, obj_in=MailboxCheckpointUpdate(
+            ReceivedDateTime=received_date_time, Filter=filter, NextLink=next_link, UpdDate=curr_date_time
+        ))
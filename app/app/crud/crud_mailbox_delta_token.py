@@ -0,0 +1,49 @@
+from datetime import datetime
+from typing import Optional
+
+from loguru import logger
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.crud.base import CRUDBase
+from app.models.mailbox_delta_token import MailboxDeltaToken
+from app.schemas.schema_db import MailboxDeltaTokenCreate, MailboxDeltaTokenUpdate
+
+
+class CRUDMailboxDeltaToken(CRUDBase[MailboxDeltaToken, MailboxDeltaTokenCreate, MailboxDeltaTokenUpdate]):
+
+    def get_by_mailbox_and_folder(self, db: Session, *, mailbox: str, folder_id: str) -> Optional[MailboxDeltaToken]:
+        return db.query(self.model)\
+            .filter(self.model.Mailbox == mailbox)\
+            .filter(self.model.FolderId == folder_id)\
+            .first()
+
+    def upsert_delta_link(self, db: Session, *, mailbox: str, folder_id: str, delta_link: str) -> MailboxDeltaToken:
+        curr_date_time = datetime.utcnow()
+        db_obj = self.get_by_mailbox_and_folder(db, mailbox=mailbox, folder_id=folder_id)
+        if db_obj is None:
+            logger.bind(mailbox=mailbox, folder_id=folder_id).info("Creating row in MailboxDeltaToken")
+            obj_in = MailboxDeltaTokenCreate(
+                Mailbox=mailbox, FolderId=folder_id, DeltaLink=delta_link, UpdDate=curr_date_time
+            )
+            db_obj = self.model(**obj_in.dict())
+            try:
+                db.add(db_obj)
+                db.commit()
+                db.refresh(db_obj)
+                return db_obj
+            except IntegrityError:
+                # another sync of the mailbox inserted it first, update its row instead
+                db.rollback()
+                logger.bind(mailbox=mailbox, folder_id=folder_id).debug("Lost race for new MailboxDeltaToken")
+                db_obj = self.get_by_mailbox_and_folder(db, mailbox=mailbox, folder_id=folder_id)
+        return self.update(db, db_obj=db_obj, obj_in=MailboxDeltaTokenUpdate(
+            DeltaLink=delta_link, UpdDate=curr_date_time
+        ))
+
+    def remove_by_mailbox_and_folder(self, db: Session, *, mailbox: str, folder_id: str) -> None:
+        db.query(self.model)\
+            .filter(self.model.Mailbox == mailbox)\
+            .filter(self.model.FolderId == folder_id)\
+            .delete(synchronize_session=False)
+        db.commit()
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+from typing import List
+
+from loguru import logger
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.crud.base import CRUDBase
+from app.models.mailbox_lease import MailboxLease
+from app.schemas.schema_db import MailboxLeaseCreate, MailboxLeaseUpdate
+
+
+class CRUDMailboxLease(CRUDBase[MailboxLease, MailboxLeaseCreate, MailboxLeaseUpdate]):
+
+    def try_acquire(self, db: Session, *, mailbox: str, worker_id: str, ttl_sec: int) -> bool:
+        """Takes the lease if it is free, expired or already ours. Safe against other workers doing the same."""
+        now = datetime.utcnow()
+        updated = db.query(self.model)\
+            .filter(self.model.Mailbox == mailbox)\
+            .filter(or_(self.model.WorkerId == worker_id, self.model.LeaseUntil < now))\
+            .update({
+                self.model.WorkerId: worker_id,
+                self.model.LeaseUntil: now + timedelta(seconds=ttl_sec),
+                self.model.UpdDate: now
+            }, synchronize_session=False)
+        db.commit()
+        if updated > 0:
+            return True
+        if db.query(self.model).filter(self.model.Mailbox == mailbox).first() is not None:
+            return False
+        obj_in = MailboxLeaseCreate(
+            Mailbox=mailbox, WorkerId=worker_id, LeaseUntil=now + timedelta(seconds=ttl_sec), UpdDate=now
+        )
+        try:
+            db.add(self.model(**obj_in.dict()))
+            db.commit()
+            return True
+        except IntegrityError:
+            # another worker inserted it first
+            db.rollback()
+            logger.bind(mailbox=mailbox, worker_id=worker_id).debug("Lost race for new MailboxLease")
+            return False
+
+    def renew(self, db: Session, *, mailboxes: List[str], worker_id: str, ttl_sec: int) -> int:
+        if len(mailboxes) == 0:
+            return 0
+        now = datetime.utcnow()
+        updated = db.query(self.model)\
+            .filter(self.model.Mailbox.in_(mailboxes))\
+            .filter(self.model.WorkerId == worker_id)\
+            .update({
+                self.model.LeaseUntil: now + timedelta(seconds=ttl_sec),
+                self.model.UpdDate: now
+            }, synchronize_session=False)
+        db.commit()
+        return updated
+
+    def release(self, db: Session, *, mailbox: str, worker_id: str) -> None:
+        now = datetime.utcnow()
+        db.query(self.model)\
+            .filter(self.model.Mailbox == mailbox)\
+            .filter(self.model.WorkerId == worker_id)\
+            .update({self.model.LeaseUntil: now, self.model.UpdDate: now}, synchronize_session=False)
+        db.commit()
@@ -1,9 +1,10 @@
-from typing import Optional, List
+from typing import Optional, List, Dict, Iterator
 
 from fastapi.encoders import jsonable_encoder
 from loguru import logger
 from sqlalchemy.orm import Session
 
+from app.core.settings import settings
 from app.crud.base import CRUDBase
 from app.models.se_correspondence import SECorrespondence
 from app.schemas.schema_db import SECorrespondenceCreate, SECorrespondenceUpdate
@@ -26,8 +27,37 @@ class CRUDSECorrespondence(CRUDBase[SECorrespondence, SECorrespondenceCreate, SE
     def get_by_mail_unique_id(self, db: Session, *, mail_unique_id: str) -> Optional[SECorrespondence]:
         return db.query(self.model).filter(self.model.MailUniqueId == mail_unique_id).first()
 
-    def get_where_conversation_id_44_is_empty(self, db: Session, *, skip: int = 0, limit: int = 100) -> List[SECorrespondence]:
-        results = db.query(self.model)\
+    def get_seq_nos_by_mail_unique_ids(
+            self, db: Session, *, mail_unique_ids: List[str], chunk_size: int = 500
+    ) -> Dict[str, int]:
+        """SeqNo of the mail_unique_ids that are in db, one IN query per chunk_size ids"""
+        unique_ids = list(dict.fromkeys(mail_unique_ids))
+        seq_nos: Dict[str, int] = {}
+        for i in range(0, len(unique_ids), chunk_size):
+            results = db.query(self.model)\
+                .with_entities(self.model.MailUniqueId, self.model.SeqNo)\
+                .filter(self.model.MailUniqueId.in_(unique_ids[i:i + chunk_size]))\
+                .all()
+            for mail_unique_id, seq_no in results:
+                seq_nos.setdefault(mail_unique_id, seq_no)
+        return seq_nos
+
+    def count(self, db: Session) -> int:
+        return db.query(self.model).count()
+
+    def iter_mail_unique_ids(self, db: Session, *, batch_size: int = 10000) -> Iterator[str]:
+        for (mail_unique_id,) in db.query(self.model.MailUniqueId).yield_per(batch_size):
+            if mail_unique_id:
+                yield mail_unique_id
+
+    def get_where_conversation_id_44_is_empty(
+            self, db: Session, *, skip: int = 0, limit: int = 100, before_seq_no: Optional[int] = None
+    ) -> List[SECorrespondence]:
+        """
+        Newest first. Pass the SeqNo of the last row of a page as before_seq_no to get the next one
+        (keyset pagination, used instead of skip)
+        """
+        query = db.query(self.model)\
             .with_entities(self.model.SeqNo,
                            self.model.MailUniqueId,
                            self.model.MailFrom,
@@ -39,10 +69,12 @@ class CRUDSECorrespondence(CRUDBase[SECorrespondence, SECorrespondenceCreate, SE
             .where(self.model.MailUniqueId != "")\
             .where(self.model.MailUniqueId.startswith('<'))\
             .filter(self.model.ConversationId44 == None)\
-            .order_by(self.model.SeqNo.desc())\
-            .offset(skip)\
-            .limit(limit)\
-            .all()
+            .order_by(self.model.SeqNo.desc())
+        if before_seq_no is not None:
+            query = query.filter(self.model.SeqNo < before_seq_no)
+        else:
+            query = query.offset(skip)
+        results = query.limit(limit).all()
         se_correspondences: List[SECorrespondence] = []
         for result in results:
             se_correspondences.append(SECorrespondence(**result))
@@ -55,6 +87,17 @@ class CRUDSECorrespondence(CRUDBase[SECorrespondence, SECorrespondenceCreate, SE
         return db_obj
 
     def get_by_mail_unique_id_or_create_get_if_not_exist_multi(self, db: Session, *, obj_ins: List[SECorrespondenceCreate]) -> List[SECorrespondence]:
+        if len(obj_ins) == 0:
+            return []
+        try:
+            db_objs = self.bulk_get_or_create(
+                db, obj_ins=obj_ins, key="MailUniqueId", chunk_size=settings.DB_BULK_CHUNK_SIZE
+            )
+            logger.bind(rows=len(obj_ins), returned=len(db_objs)).info("Bulk saved rows in SECorrespondence")
+            return db_objs
+        except Exception as e:
+            # e.g. a row the database rejects, saved one by one the others still get in
+            logger.bind(error=e).error(f"Bulk save in SECorrespondence failed, saving row by row: {e}")
         db_objs: List[SECorrespondence] = []
         for obj_in in obj_ins:
             db_obj = self.get_by_mail_unique_id_or_create_get_if_not_exist(db, obj_in=obj_in)
@@ -92,3 +135,13 @@ class CRUDSECorrespondence(CRUDBase[SECorrespondence, SECorrespondenceCreate, SE
         db.commit()
 
         return se_correspondence_update
+
+    def update_conversation_ids(
+            self, db: Session, *, se_correspondence_updates: List[SECorrespondenceUpdate]
+    ) -> List[SECorrespondenceUpdate]:
+        """One executemany UPDATE and one commit for all se_correspondence_updates"""
+        db.bulk_update_mappings(self.model, [
+            se_correspondence_update.dict() for se_correspondence_update in se_correspondence_updates
+        ])
+        db.commit()
+        return se_correspondence_updates
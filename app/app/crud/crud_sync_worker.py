@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+from typing import List
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.crud.base import CRUDBase
+from app.models.sync_worker import SyncWorker
+from app.schemas.schema_db import SyncWorkerCreate, SyncWorkerUpdate
+
+
+class CRUDSyncWorker(CRUDBase[SyncWorker, SyncWorkerCreate, SyncWorkerUpdate]):
+
+    def heartbeat(self, db: Session, *, worker_id: str) -> None:
+        now = datetime.utcnow()
+        updated = db.query(self.model)\
+            .filter(self.model.WorkerId == worker_id)\
+            .update({self.model.Heartbeat: now}, synchronize_session=False)
+        db.commit()
+        if updated > 0:
+            return
+        try:
+            db.add(self.model(**SyncWorkerCreate(WorkerId=worker_id, Heartbeat=now, CrDate=now).dict()))
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+
+    def get_live_worker_ids(self, db: Session, *, ttl_sec: int) -> List[str]:
+        since = datetime.utcnow() - timedelta(seconds=ttl_sec)
+        rows = db.query(self.model.WorkerId).filter(self.model.Heartbeat >= since).all()
+        return [row.WorkerId for row in rows]
+
+    def remove_by_worker_id(self, db: Session, *, worker_id: str) -> None:
+        db.query(self.model).filter(self.model.WorkerId == worker_id).delete(synchronize_session=False)
+        db.commit()
@@ -1,7 +1,13 @@
-from typing import List, Any
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from loguru import logger
+from sqlalchemy import text
 from sqlalchemy.orm import Session
+
+from app.core.settings import settings
+from app.db.db_executor import db_executor
 from app.schemas.schema_sp import EmailTrackerGetEmailIDSchema, EmailTrackerGetEmailLinkInfo, \
     EmailTrackerGetEmailLinkInfoParams
 
@@ -10,8 +16,9 @@ class StoredProcedures:
 
     @staticmethod
     async def dhruv_EmailTrackerGetEmailID(db_sales97: Session) -> List[EmailTrackerGetEmailIDSchema]:
-        res: List[EmailTrackerGetEmailIDSchema] = run_stored_procedure(
-            db_sales97, "sales97.dbo.dhruv_EmailTrackerGetEmailID", AnyBaseModelSchema=EmailTrackerGetEmailIDSchema
+        res: List[EmailTrackerGetEmailIDSchema] = await db_executor.run(
+            db_sales97, run_stored_procedure, "sales97.dbo.dhruv_EmailTrackerGetEmailID",
+            AnyBaseModelSchema=EmailTrackerGetEmailIDSchema
         )
         return res
 
@@ -19,17 +26,65 @@ class StoredProcedures:
     async def dhruv_EmailTrackerGetEmailLinkInfo(
             db_fit: Session, param_obj: EmailTrackerGetEmailLinkInfoParams
     ) -> List[EmailTrackerGetEmailLinkInfo]:
-        # ordered params list
-        params = [param_obj.email, param_obj.subject, param_obj.date, param_obj.conversation_id]
-        res: List[Any] = run_stored_procedure(
+        res: List[Any] = await db_executor.run(
+            db_fit,
+            run_stored_procedure,
+            "fit.dbo.dhruv_EmailTrackerGetEmailLinkInfo",
+            get_email_link_info_ordered_params(param_obj),
+            AnyBaseModelSchema=EmailTrackerGetEmailLinkInfo
+        )
+        return res
+
+    @staticmethod
+    async def dhruv_EmailTrackerGetEmailLinkInfo_multi(
+            db_fit: Session, param_objs: List[EmailTrackerGetEmailLinkInfoParams]
+    ) -> List[List[EmailTrackerGetEmailLinkInfo]]:
+        """
+        dhruv_EmailTrackerGetEmailLinkInfo for every param_obj, settings.STORED_PROCEDURE_BATCH_SIZE calls
+        per round-trip
+
+        :param db_fit: Session
+        :param param_objs: List[EmailTrackerGetEmailLinkInfoParams]
+        :return: List[List[EmailTrackerGetEmailLinkInfo]], the result of each param_obj, in order
+        """
+        res: List[List[Any]] = await db_executor.run(
             db_fit,
+            run_stored_procedure_batch,
             "fit.dbo.dhruv_EmailTrackerGetEmailLinkInfo",
-            params,
+            [get_email_link_info_ordered_params(param_obj) for param_obj in param_objs],
             AnyBaseModelSchema=EmailTrackerGetEmailLinkInfo
         )
         return res
 
 
+def get_email_link_info_ordered_params(param_obj: EmailTrackerGetEmailLinkInfoParams) -> List[str]:
+    # ordered params list
+    return [param_obj.email, param_obj.subject, param_obj.date, param_obj.conversation_id]
+
+
+class StoredProcedureStats:
+    """Per stored procedure call counters and timings"""
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+    def record(self, stored_procedure_name: str, calls: int, elapsed_ms: float) -> None:
+        stats = self._stats[stored_procedure_name]
+        stats["calls"] += calls
+        stats["round_trips"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_round_trip_ms"] = max(stats["max_round_trip_ms"], elapsed_ms)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def reset(self) -> None:
+        self._stats.clear()
+
+
+stored_procedure_stats = StoredProcedureStats()
+
+
 def run_stored_procedure(
         db: Session,
         stored_procedure_name: str,
@@ -37,26 +92,95 @@ def run_stored_procedure(
         *,
         AnyBaseModelSchema: type = dict,
 ) -> List[Any]:
-    stored_procedure_name_plus_params = get_stored_procedure_name_plus_params(
-        stored_procedure_name, ordered_params
-    )
-    cursor = db.execute(f"exec {stored_procedure_name_plus_params}")
+    # values are bound, not quoted into the statement, so the server can reuse its plan
+    statement, params = get_stored_procedure_statement(stored_procedure_name, [ordered_params])
+    start = time.perf_counter()
+    cursor = db.execute(text(statement), params)
     result: List[AnyBaseModelSchema] = []
     for row in cursor:
         result.append(AnyBaseModelSchema(**row)) if AnyBaseModelSchema != dict else result.append(row)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    stored_procedure_stats.record(stored_procedure_name, 1, elapsed_ms)
     logger.bind(
-        stored_procedure_name_plus_params=stored_procedure_name_plus_params,
-        result=result[len(result)-1]
+        stored_procedure_name=stored_procedure_name, rows=len(result), elapsed_ms=round(elapsed_ms, 1)
     ).debug("Ran Stored procedure")
     return result
 
 
-def get_stored_procedure_name_plus_params(stored_procedure_name: str, ordered_params: List[str]) -> str:
-    stored_procedure_name_plus_params = stored_procedure_name
-    if ordered_params is not None:
-        params: List[str] = []
-        for param in ordered_params:
-            params.append(f"'{param}'")
-        params_str = ", ".join(params)
-        stored_procedure_name_plus_params = f"{stored_procedure_name_plus_params} {params_str}"
-    return stored_procedure_name_plus_params
+def run_stored_procedure_batch(
+        db: Session,
+        stored_procedure_name: str,
+        ordered_params_list: List[List[str]],
+        *,
+        AnyBaseModelSchema: type = dict,
+        batch_size: Optional[int] = None
+) -> List[List[Any]]:
+    """
+    Runs stored_procedure_name once for each of ordered_params_list, batch_size execs per round-trip.
+    The procedure must return exactly one result set.
+
+    :param db: Session
+    :param stored_procedure_name: str
+    :param ordered_params_list: List[List[str]]
+    :param AnyBaseModelSchema: type, of the rows
+    :param batch_size: Optional[int], defaults to settings.STORED_PROCEDURE_BATCH_SIZE
+    :return: List[List[Any]], the rows of each call, in order
+    """
+    batch_size = max(1, batch_size or settings.STORED_PROCEDURE_BATCH_SIZE)
+    results: List[List[Any]] = []
+    for i in range(0, len(ordered_params_list), batch_size):
+        chunk = ordered_params_list[i:i + batch_size]
+        start = time.perf_counter()
+        result_sets = _execute_multi_result_sets(db, *get_stored_procedure_statement(stored_procedure_name, chunk))
+        if len(result_sets) != len(chunk):
+            raise RuntimeError(
+                f"{stored_procedure_name} returned {len(result_sets)} result sets for {len(chunk)} calls"
+            )
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        stored_procedure_stats.record(stored_procedure_name, len(chunk), elapsed_ms)
+        logger.bind(
+            stored_procedure_name=stored_procedure_name, calls=len(chunk), elapsed_ms=round(elapsed_ms, 1)
+        ).debug("Ran Stored procedure batch")
+        for rows in result_sets:
+            results.append([AnyBaseModelSchema(**row) for row in rows] if AnyBaseModelSchema != dict else rows)
+    return results
+
+
+def _execute_multi_result_sets(db: Session, statement: str, params: Dict[str, Any]) -> List[List[Dict[str, Any]]]:
+    """Runs statement on the DBAPI cursor, sqlalchemy results only read the first result set"""
+    connection = db.connection()
+    if connection.dialect.name == "mssql":
+        # row counts of statements inside the procedures would come back as extra result sets
+        statement = f"SET NOCOUNT ON; {statement}"
+    compiled = text(statement).compile(dialect=connection.dialect)
+    bound_params: Union[Dict[str, Any], Tuple[Any, ...]] = compiled.construct_params(params)
+    if compiled.positional:
+        bound_params = tuple(bound_params[name] for name in compiled.positiontup)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(str(compiled), bound_params)
+        result_sets: List[List[Dict[str, Any]]] = []
+        while True:
+            if cursor.description is not None:
+                columns = [column[0] for column in cursor.description]
+                result_sets.append([dict(zip(columns, row)) for row in cursor.fetchall()])
+            if not cursor.nextset():
+                break
+        return result_sets
+    finally:
+        cursor.close()
+
+
+def get_stored_procedure_statement(
+        stored_procedure_name: str, ordered_params_list: List[Optional[List[str]]]
+) -> Tuple[str, Dict[str, Any]]:
+    """One exec of stored_procedure_name per ordered_params, with bound parameters p<exec>_<param>"""
+    execs: List[str] = []
+    params: Dict[str, Any] = {}
+    for i, ordered_params in enumerate(ordered_params_list):
+        names: List[str] = []
+        for j, param in enumerate(ordered_params or []):
+            params[f"p{i}_{j}"] = param
+            names.append(f":p{i}_{j}")
+        execs.append(f"exec {stored_procedure_name} {', '.join(names)}".rstrip())
+    return "; ".join(execs), params
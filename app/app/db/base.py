@@ -4,4 +4,8 @@
 
 # NOTE: This file will import base_class from this app.db package, and rest of the models from app.models package
 from app.db.base_class import Base  # noqa
-from app.models.se_correspondence import SECorrespondence  # noqa
\ No newline at end of file
+from app.models.se_correspondence import SECorrespondence  # noqa
+from app.models.mailbox_delta_token import MailboxDeltaToken  # noqa
+from app.models.mailbox_lease import MailboxLease  # noqa
+from app.models.mailbox_checkpoint import MailboxCheckpoint  # noqa
+from app.models.sync_worker import SyncWorker  # noqa
@@ -0,0 +1,88 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
+from weakref import WeakKeyDictionary
+
+from sqlalchemy.orm import Session
+
+from app.core.settings import settings
+
+T = TypeVar("T")
+
+
+class DbExecutor:
+    """
+    Runs blocking db calls (sqlalchemy / pymssql) on a bounded thread pool, so a slow query or stored procedure
+    only holds its own coroutine instead of the event loop and every other request of the process.
+
+    At most settings.DB_TENANT_CONCURRENCY calls of a tenant run at once (the tenant is taken from session.info,
+    set by app.db.db_session), and the calls on one session run one at a time, as sessions are not thread safe.
+    A call waits for its session before taking a tenant slot, so calls queued on a busy session hold neither
+    a slot nor a thread.
+    """
+
+    def __init__(self):
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._waiting: Dict[str, int] = {}
+        self._running: Dict[str, int] = {}
+        self._session_locks: "WeakKeyDictionary[Session, asyncio.Lock]" = WeakKeyDictionary()
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=settings.DB_EXECUTOR_MAX_WORKERS, thread_name_prefix="db")
+        return self._executor
+
+    def get_semaphore(self, tenant: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(tenant)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(settings.DB_TENANT_CONCURRENCY)
+            self._semaphores[tenant] = semaphore
+        return semaphore
+
+    def _get_session_lock(self, db: Session) -> asyncio.Lock:
+        session_lock = self._session_locks.get(db)
+        if session_lock is None:
+            session_lock = asyncio.Lock()
+            self._session_locks[db] = session_lock
+        return session_lock
+
+    async def run(self, db: Session, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Awaits func(db, *args, **kwargs) run in a db thread
+
+        :param db: Session
+        :param func: Callable[..., T], blocking function taking the session as first argument
+        :return: T
+        """
+        tenant = db.info.get("tenant", "")
+        self._waiting[tenant] = self._waiting.get(tenant, 0) + 1
+        is_waiting = True
+        try:
+            async with self._get_session_lock(db), self.get_semaphore(tenant):
+                self._waiting[tenant] -= 1
+                is_waiting = False
+                self._running[tenant] = self._running.get(tenant, 0) + 1
+                try:
+                    return await asyncio.get_event_loop().run_in_executor(
+                        self.get_executor(), lambda: func(db, *args, **kwargs)
+                    )
+                finally:
+                    self._running[tenant] -= 1
+        finally:
+            if is_waiting:
+                self._waiting[tenant] -= 1
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {
+            tenant: {"running": self._running.get(tenant, 0), "waiting": self._waiting.get(tenant, 0)}
+            for tenant in self._semaphores
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+db_executor = DbExecutor()
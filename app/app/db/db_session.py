@@ -1,10 +1,15 @@
+import threading
 import urllib.parse
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
 
+from loguru import logger
 from sqlalchemy import create_engine
-from sqlalchemy.engine import Engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import sessionmaker, Session
 
 from app.core.config import configuration
+from app.core.settings import settings
 
 
 def get_tenant_sqlalchemy_url(tenant: str, db_name: str) -> str:
@@ -15,14 +20,100 @@ def get_tenant_sqlalchemy_url(tenant: str, db_name: str) -> str:
     return url_with_utf8
 
 
+class TenantEngineRegistry:
+    """
+    One engine (and connection pool) per (tenant, db_name) for the life of the process,
+    instead of a new engine and fresh connections for every request or task
+    """
+
+    def __init__(self):
+        self._engines: Dict[Tuple[str, str], Engine] = {}
+        self._session_makers: Dict[Engine, sessionmaker] = {}
+        self._tenants_by_engine: Dict[Engine, str] = {}
+        # engines are also created from db worker threads
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create_engine(url: str) -> Engine:
+        if make_url(url).get_backend_name() == "sqlite":
+            # sqlite has its own pool classes, without size or overflow.
+            # sessions move between the event loop and the db executor threads, one call at a time
+            return create_engine(
+                url=url, pool_pre_ping=settings.DB_POOL_PRE_PING, connect_args={"check_same_thread": False}
+            )
+        return create_engine(
+            url=url,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_POOL_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT_SEC,
+            pool_recycle=settings.DB_POOL_RECYCLE_SEC,
+            pool_pre_ping=settings.DB_POOL_PRE_PING
+        )
+
+    def get_engine(self, tenant: str, db_name: str) -> Engine:
+        eng = self._engines.get((tenant, db_name))
+        if eng is not None:
+            return eng
+        with self._lock:
+            eng = self._engines.get((tenant, db_name))
+            if eng is None:
+                eng = TenantEngineRegistry.create_engine(get_tenant_sqlalchemy_url(tenant, db_name))
+                self._engines[(tenant, db_name)] = eng
+                self._tenants_by_engine[eng] = tenant
+                logger.bind(tenant=tenant, db_name=db_name).info("Created db engine")
+        return eng
+
+    def get_session_maker(self, eng: Engine) -> sessionmaker:
+        session_local = self._session_makers.get(eng)
+        if session_local is not None:
+            return session_local
+        with self._lock:
+            session_local = self._session_makers.get(eng)
+            if session_local is None:
+                # the tenant of a session is used by the db executor for its per-tenant limits.
+                # rows committed in a db thread are read on the event loop, where a reload after expiry
+                # would run a query outside of the executor
+                session_local = sessionmaker(
+                    bind=eng, info={"tenant": self._tenants_by_engine.get(eng, "")}, expire_on_commit=False
+                )
+                self._session_makers[eng] = session_local
+        return session_local
+
+    def dispose_all(self) -> None:
+        with self._lock:
+            engines = list(self._engines.items())
+            self._engines.clear()
+            self._session_makers.clear()
+            self._tenants_by_engine.clear()
+        for (tenant, db_name), eng in engines:
+            try:
+                eng.dispose()
+            except Exception as e:
+                logger.bind(tenant=tenant, db_name=db_name, error=e).error(f"Could not dispose db engine: {e}")
+
+    def snapshot(self) -> Dict[str, str]:
+        return {f"{tenant}/{db_name}": eng.pool.status() for (tenant, db_name), eng in self._engines.items()}
+
+
+tenant_engine_registry = TenantEngineRegistry()
+
+
 def get_tenant_db_engine(tenant: str, db_name: str) -> Engine:
-    eng = create_engine(url=get_tenant_sqlalchemy_url(tenant, db_name), pool_pre_ping=True)
-    return eng
+    return tenant_engine_registry.get_engine(tenant, db_name)
 
 
 def get_db_session(eng: Engine):
-    session_local = sessionmaker(bind=eng)
-    return session_local
+    return tenant_engine_registry.get_session_maker(eng)
+
+
+@contextmanager
+def tenant_db_session(tenant: str, db_name: str) -> Iterator[Session]:
+    """Session for code running outside of a request, e.g. one per concurrent task"""
+    db = get_db_session(get_tenant_db_engine(tenant, db_name))()
+    try:
+        yield db
+    finally:
+        db.close()
 
 
 # create an engine
@@ -2,12 +2,21 @@ import uvicorn
 from fastapi import FastAPI
 from loguru import logger
 
-from app.core.config import Config
+from app.apiclients.http_session import http_session_manager
+from app.core.auth import msal_client_registry
+from app.core.config import Config, configuration
 from app.core.description import description
 from app.core.log import setup_logger
 from app.core.settings import settings
+from app.db.db_executor import db_executor
+from app.db.db_session import tenant_engine_registry
 from app.api.api_v1 import api
+from app.controllers.directory import tenant_directory
+from app.controllers.mail_index import mail_unique_id_index
+from app.controllers.shard import mailbox_shard_coordinator
+from app.controllers.sync_job import sync_job_manager
 from app.middlewares import middleware_tracer
+from app.scheduler import job_scheduler
 
 
 def create_app():
@@ -39,6 +48,11 @@ async def startup_event():
     # setup logger before everything
     setup_logger()
     logger.bind().info("Startup event")
+    await http_session_manager.startup()
+    msal_client_registry.start(list(configuration.tenant_configurations.keys()))
+    mail_unique_id_index.start(list(configuration.tenant_configurations.keys()))
+    if settings.SCHEDULER_IN_PROCESS:
+        await job_scheduler.start()
     # TODO: configuration = Config.validate_and_load(settings.CONFIGURATION_LOC)
     # TODO: setup ConfidentialClientApplication
     # TODO: setup boto3 (s3) session
@@ -49,6 +63,14 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.bind().info("Shutdown event")
+    await job_scheduler.stop()
+    await sync_job_manager.stop()
+    await mailbox_shard_coordinator.stop()
+    await tenant_directory.stop()
+    await msal_client_registry.stop()
+    await http_session_manager.close_all()
+    db_executor.shutdown()
+    tenant_engine_registry.dispose_all()
 
 if __name__ == "__main__":
     uvicorn.run(
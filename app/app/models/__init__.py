@@ -1 +1,5 @@
 from .se_correspondence import SECorrespondence
+from .mailbox_delta_token import MailboxDeltaToken
+from .mailbox_lease import MailboxLease
+from .mailbox_checkpoint import MailboxCheckpoint
+from .sync_worker import SyncWorker
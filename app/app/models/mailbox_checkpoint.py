@@ -0,0 +1,13 @@
+from sqlalchemy import Column, Integer, DateTime, String, Text
+
+from app.db.base_class import Base
+
+
+class MailboxCheckpoint(Base):
+    __tablename__ = 'MailboxCheckpoint'
+    SeqNo = Column(Integer, primary_key=True)
+    Mailbox = Column(String(80), unique=True)  # msgraph user id
+    ReceivedDateTime = Column(DateTime)  # high-water mark, messages up to it are saved
+    Filter = Column(Text)  # filter of the listing NextLink belongs to
+    NextLink = Column(Text)  # page after the last saved one, None once the listing completed
+    UpdDate = Column(DateTime)
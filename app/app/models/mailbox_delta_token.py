@@ -0,0 +1,14 @@
+from sqlalchemy import Column, Integer, DateTime, String, Text, UniqueConstraint
+
+from app.db.base_class import Base
+
+
+class MailboxDeltaToken(Base):
+    __tablename__ = 'MailboxDeltaToken'
+    # one delta link per folder, concurrent syncs of a mailbox race to insert it
+    __table_args__ = (UniqueConstraint('Mailbox', 'FolderId', name='UQ_MailboxDeltaToken_Mailbox_FolderId'),)
+    SeqNo = Column(Integer, primary_key=True)
+    Mailbox = Column(String(80), index=True)  # msgraph user id
+    FolderId = Column(String(80))  # well-known folder name (inbox, sentitems..) or folder id
+    DeltaLink = Column(Text)
+    UpdDate = Column(DateTime)
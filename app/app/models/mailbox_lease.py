@@ -0,0 +1,12 @@
+from sqlalchemy import Column, Integer, DateTime, String
+
+from app.db.base_class import Base
+
+
+class MailboxLease(Base):
+    __tablename__ = 'MailboxLease'
+    SeqNo = Column(Integer, primary_key=True)
+    Mailbox = Column(String(80), unique=True)  # msgraph user id
+    WorkerId = Column(String(120))
+    LeaseUntil = Column(DateTime)
+    UpdDate = Column(DateTime)
@@ -0,0 +1,11 @@
+from sqlalchemy import Column, Integer, DateTime, String
+
+from app.db.base_class import Base
+
+
+class SyncWorker(Base):
+    __tablename__ = 'SyncWorker'
+    SeqNo = Column(Integer, primary_key=True)
+    WorkerId = Column(String(120), unique=True)
+    Heartbeat = Column(DateTime)
+    CrDate = Column(DateTime)
@@ -1,30 +1,233 @@
 import asyncio
-import time
+import random
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, List, Optional, Set
 
-from app.apiclients.api_client import ApiClient
+from loguru import logger
 
+from app.apiclients.http_session import http_session_manager
+from app.controllers.directory import tenant_directory
+from app.controllers.mail import MailController
+from app.controllers.mail_index import mail_unique_id_index
+from app.controllers.shard import mailbox_shard_coordinator
+from app.core.auth import get_auth_config_and_confidential_client_application_and_access_token, \
+    msal_client_registry
+from app.core.config import configuration, MailIntegrateJob
+from app.core.log import setup_logger
+from app.core.settings import settings
+from app.db.db_executor import db_executor
+from app.db.db_session import tenant_db_session, tenant_engine_registry
+from app.schemas.schema_sync import JobRun, JobRunStatus, ScheduledJobInfo
 
-async def call_save_message_and_attachment():
-    print("Start call_save_message_and_attachment")
-    api = ApiClient(
-        method='get',
-        url="http://localhost:8050/v1/messagesAndAttachments/save?tenant=rbrgroup&top=500&filter=receivedDateTime%20gt%202022-04-11T01%3A00%3A00Z",
-        timeout_sec=3600,
-    )
+# the loop checks for due jobs this often
+TICK_SEC = 1.0
+# the filter of a run starts this long before the previous successful run started,
+# so messages delivered late into the mailbox are not missed
+FILTER_OVERLAP_SEC = 300
 
-    await api.retryable_call()
-    print("End call_save_message_and_attachment")
 
+class ScheduledJob:
+    """A tenant MailIntegrateJob with its schedule and run history"""
 
-async def scheduler(repeat_secs):
-    while True:
-        await call_save_message_and_attachment()
-        time.sleep(repeat_secs)
+    def __init__(self, tenant: str, job: MailIntegrateJob, now: datetime):
+        self.tenant = tenant
+        self.job = job
+        # slots are now, now + interval, now + 2 * interval, .. every run starts at its slot plus jitter
+        self.slot_at: datetime = now
+        self.next_run_at: datetime = now + self._jitter()
+        self.next_trigger = "schedule"
+        self.is_running = False
+        self.missed_runs = 0
+        self.last_success_started_at: Optional[datetime] = None
+        self.history: Deque[JobRun] = deque(maxlen=settings.SCHEDULER_HISTORY_SIZE)
 
+    def _jitter(self) -> timedelta:
+        return timedelta(seconds=random.uniform(0, self.job.jitter_sec)) if self.job.jitter_sec > 0 else timedelta()
 
-async def main(repeat_secs):
-    await scheduler(repeat_secs)
+    def schedule_next(self, now: datetime) -> None:
+        """Moves to the next slot. Slots that passed while the job was running are missed."""
+        interval = timedelta(seconds=self.job.interval_sec)
+        self.slot_at += interval
+        if self.slot_at > now:
+            self.next_run_at = self.slot_at + self._jitter()
+            self.next_trigger = "schedule"
+            return
+        missed = 1
+        while self.slot_at + interval <= now:
+            self.slot_at += interval
+            missed += 1
+        self.missed_runs += missed
+        logger.bind(tenant=self.tenant, job=self.job.name, missed=missed).warning("Missed scheduled runs")
+        if self.job.catch_up:
+            # one run right away for all missed slots, its filter covers them, later slots follow from it
+            self.slot_at = now
+            self.next_run_at = now
+            self.next_trigger = "catch_up"
+        else:
+            self.slot_at += interval
+            self.next_run_at = self.slot_at + self._jitter()
+            self.next_trigger = "schedule"
+
+    def get_filter(self, started_at: datetime) -> str:
+        if self.last_success_started_at is not None:
+            since = self.last_success_started_at - timedelta(seconds=FILTER_OVERLAP_SEC)
+        else:
+            since = started_at - timedelta(seconds=self.job.lookback_sec)
+        return f"receivedDateTime gt {since.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+
+    def get_info(self) -> ScheduledJobInfo:
+        return ScheduledJobInfo(
+            tenant=self.tenant,
+            job_name=self.job.name,
+            interval_sec=self.job.interval_sec,
+            next_run_at=self.next_run_at,
+            is_running=self.is_running,
+            missed_runs=self.missed_runs,
+            last_run=self.history[-1] if len(self.history) > 0 else None
+        )
+
+
+class JobScheduler:
+    """
+    Runs the MailIntegrateJob of every tenant on its interval, calling MailController directly.
+    A job never runs twice at the same time, a run that is due while the previous one is still going
+    is caught up (or skipped) when it ends.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[str, ScheduledJob] = {}
+        self._loop_task: Optional[asyncio.Task] = None
+        self._run_tasks: Set[asyncio.Task] = set()
+
+    def load_jobs(self) -> None:
+        now = datetime.utcnow()
+        for tenant, tenant_configuration in configuration.tenant_configurations.items():
+            job = tenant_configuration.mail_integrate_job
+            if job is None or not job.enabled or tenant in self._jobs:
+                continue
+            self._jobs[tenant] = ScheduledJob(tenant, job, now)
+            logger.bind(tenant=tenant, job=job.name, interval_sec=job.interval_sec).info("Loaded scheduled job")
+
+    def get_job(self, tenant: str) -> Optional[ScheduledJob]:
+        self.load_jobs()
+        return self._jobs.get(tenant)
+
+    def get_jobs_info(self) -> List[ScheduledJobInfo]:
+        self.load_jobs()
+        return [scheduled_job.get_info() for scheduled_job in self._jobs.values()]
+
+    async def start(self) -> None:
+        self.load_jobs()
+        if settings.SHARDING_ENABLED:
+            await mailbox_shard_coordinator.start(list(self._jobs.keys()))
+        tenant_directory.start(list(self._jobs.keys()))
+        mail_unique_id_index.start(list(self._jobs.keys()))
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.ensure_future(self._loop())
+            logger.bind(jobs=len(self._jobs)).info("Scheduler started")
+
+    async def wait(self) -> None:
+        if self._loop_task is not None:
+            await self._loop_task
+
+    async def stop(self) -> None:
+        tasks = list(self._run_tasks)
+        if self._loop_task is not None:
+            tasks.append(self._loop_task)
+            self._loop_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.bind().info("Scheduler stopped")
+
+    def trigger(self, tenant: str) -> Optional[JobRun]:
+        """Starts a run of the tenant job now, outside of its schedule. None if the job is already running."""
+        scheduled_job = self.get_job(tenant)
+        if scheduled_job is None or scheduled_job.is_running:
+            return None
+        return self._start_run(scheduled_job, "manual", datetime.utcnow())
+
+    async def _loop(self) -> None:
+        while True:
+            now = datetime.utcnow()
+            for scheduled_job in self._jobs.values():
+                if not scheduled_job.is_running and scheduled_job.next_run_at <= now:
+                    self._start_run(scheduled_job, scheduled_job.next_trigger, scheduled_job.next_run_at)
+            await asyncio.sleep(TICK_SEC)
+
+    def _start_run(self, scheduled_job: ScheduledJob, trigger: str, scheduled_at: datetime) -> JobRun:
+        started_at = datetime.utcnow()
+        job_run = JobRun(
+            tenant=scheduled_job.tenant,
+            job_name=scheduled_job.job.name,
+            trigger=trigger,
+            scheduled_at=scheduled_at,
+            started_at=started_at,
+            filter=scheduled_job.get_filter(started_at)
+        )
+        scheduled_job.is_running = True
+        scheduled_job.history.append(job_run)
+        task = asyncio.ensure_future(self._run(scheduled_job, job_run))
+        self._run_tasks.add(task)
+        task.add_done_callback(self._run_tasks.discard)
+        return job_run
+
+    @staticmethod
+    async def _run(scheduled_job: ScheduledJob, job_run: JobRun) -> None:
+        tenant = scheduled_job.tenant
+        job = scheduled_job.job
+        logger.bind(tenant=tenant, job=job.name, trigger=job_run.trigger, filter=job_run.filter).info("Job run started")
+        try:
+            config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token(tenant)
+            if token is None or "access_token" not in token:
+                raise RuntimeError(f"Unauthorized: {token.get('error_description') if token else None}")
+            db_sales97_name = configuration.tenant_configurations.get(tenant).db.db_sales97_name
+            with tenant_db_session(tenant, db_sales97_name) as db_sales97:
+                users, all_rows, all_links, results = await MailController.save_tenant_messages_and_attachments(
+                    token, tenant, db_sales97, job.top, job_run.filter, job.delta, job.two_phase
+                )
+            job_run.users = len(results)
+            job_run.failed_users = len([result for result in results if not result.success])
+            job_run.status = JobRunStatus.succeeded
+            scheduled_job.last_success_started_at = job_run.started_at
+        except asyncio.CancelledError:
+            job_run.status = JobRunStatus.failed
+            job_run.error = "cancelled"
+            raise
+        except Exception as e:
+            job_run.status = JobRunStatus.failed
+            job_run.error = str(e)
+            logger.bind(tenant=tenant, job=job.name, error=e).error(f"Job run failed: {e}")
+        finally:
+            job_run.finished_at = datetime.utcnow()
+            scheduled_job.is_running = False
+            if job_run.trigger != "manual":
+                scheduled_job.schedule_next(job_run.finished_at)
+            logger.bind(
+                tenant=tenant, job=job.name, status=job_run.status, users=job_run.users,
+                failed_users=job_run.failed_users, next_run_at=scheduled_job.next_run_at
+            ).info("Job run finished")
+
+
+job_scheduler = JobScheduler()
+
+
+async def main():
+    setup_logger()
+    try:
+        msal_client_registry.start(list(configuration.tenant_configurations.keys()))
+        await job_scheduler.start()
+        await job_scheduler.wait()
+    finally:
+        await job_scheduler.stop()
+        await mailbox_shard_coordinator.stop()
+        await tenant_directory.stop()
+        await msal_client_registry.stop()
+        await http_session_manager.close_all()
+        db_executor.shutdown()
+        tenant_engine_registry.dispose_all()
 
 
 if __name__ == "__main__":
-    asyncio.run(main(repeat_secs=3600))
+    asyncio.run(main())
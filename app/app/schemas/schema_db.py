@@ -1,4 +1,5 @@
 import datetime
+from typing import Optional
 
 from pydantic import BaseModel
 
@@ -37,6 +38,72 @@ class SECorrespondenceUpdate(BaseModel):
     ConversationId44: str
 
 
+class MailboxDeltaToken(BaseModel):
+    Mailbox: str
+    FolderId: str
+    DeltaLink: str
+    UpdDate: datetime.datetime
+
+
+class MailboxDeltaTokenCreate(MailboxDeltaToken):
+    pass
+
+
+class MailboxDeltaTokenUpdate(BaseModel):
+    DeltaLink: str
+    UpdDate: datetime.datetime
+
+
+class MailboxCheckpoint(BaseModel):
+    Mailbox: str
+    ReceivedDateTime: Optional[datetime.datetime]
+    Filter: str
+    NextLink: Optional[str]
+    UpdDate: datetime.datetime
+
+
+class MailboxCheckpointCreate(MailboxCheckpoint):
+    pass
+
+
+class MailboxCheckpointUpdate(BaseModel):
+    ReceivedDateTime: Optional[datetime.datetime]
+    Filter: str
+    NextLink: Optional[str]
+    UpdDate: datetime.datetime
+
+
+class MailboxLease(BaseModel):
+    Mailbox: str
+    WorkerId: str
+    LeaseUntil: datetime.datetime
+    UpdDate: datetime.datetime
+
+
+class MailboxLeaseCreate(MailboxLease):
+    pass
+
+
+class MailboxLeaseUpdate(BaseModel):
+    WorkerId: str
+    LeaseUntil: datetime.datetime
+    UpdDate: datetime.datetime
+
+
+class SyncWorker(BaseModel):
+    WorkerId: str
+    Heartbeat: datetime.datetime
+    CrDate: datetime.datetime
+
+
+class SyncWorkerCreate(SyncWorker):
+    pass
+
+
+class SyncWorkerUpdate(BaseModel):
+    Heartbeat: datetime.datetime
+
+
 class CorrespondenceId(BaseModel):
     message_id: str
 
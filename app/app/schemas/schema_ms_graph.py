@@ -1,4 +1,5 @@
-from typing import List, Optional, Any, Union
+from enum import Enum
+from typing import List, Optional, Any, Union, Dict, Type
 
 from pydantic import BaseModel, Field
 
@@ -23,6 +24,7 @@ class UserSchema(BaseModel):
     surname: Optional[str]
     userPrincipalName: Optional[str]
     id: Optional[str]
+    proxyAddresses: Optional[List[str]] = None
 
 
 class UserResponseSchema(UserSchema, ODataContextSchema):
@@ -31,6 +33,7 @@ class UserResponseSchema(UserSchema, ODataContextSchema):
 
 class UsersSchema(BaseModel):
     odata_context: str = Field(None, alias="@odata.context")
+    odata_nextLink: Optional[str] = Field(None, alias="@odata.nextLink")
     value: Optional[List[UserSchema]]
 
 
@@ -52,23 +55,42 @@ class MessageFlagSchema(BaseModel):
     flagStatus: str
 
 
-class MessageSchema(BaseModel):
+class MessageProjection(str, Enum):
+    """Named $select profiles for listing messages, each one is a subset of the next"""
+    classify = "classify"  # headers and bodyPreview, enough for MailProcessor to decide
+    persist = "persist"  # classify + body, enough to save to SECorrespondence
+    full = "full"  # no $select, every field msgraph returns by default
+
+
+class MessageHeaderSchema(BaseModel):
     odata_type: Optional[str] = Field(None, alias="@odata.type")
     odata_etag: str = Field(None, alias="@odata.etag")
     id: str
-    createdDateTime: str
-    lastModifiedDateTime: str
-    changeKey: str
-    categories: List
     receivedDateTime: str
     sentDateTime: Optional[str]
     hasAttachments: bool
     internetMessageId: str
     subject: Optional[str]
     bodyPreview: str
-    importance: str
     parentFolderId: str
     conversationId: str
+    sender: Optional[EmailAddressWrapperSchema]  # Optional, isDraft= True
+    from_email: Optional[EmailAddressWrapperSchema] = Field(None, alias="from")  # Optional, isDraft= True
+    toRecipients: Optional[List[EmailAddressWrapperSchema]]
+    ccRecipients: List[EmailAddressWrapperSchema]
+    bccRecipients: List[EmailAddressWrapperSchema]
+
+
+class MessagePersistSchema(MessageHeaderSchema):
+    body: Optional[MessageBodySchema]
+
+
+class MessageSchema(MessagePersistSchema):
+    createdDateTime: str
+    lastModifiedDateTime: str
+    changeKey: str
+    categories: List
+    importance: str
     conversationIndex: str
     isDeliveryReceiptRequested: Optional[str]
     isReadReceiptRequested: bool
@@ -76,12 +98,6 @@ class MessageSchema(BaseModel):
     isDraft: bool
     webLink: str
     inferenceClassification: str
-    body: Optional[MessageBodySchema]
-    sender: Optional[EmailAddressWrapperSchema]  # Optional, isDraft= True
-    from_email: Optional[EmailAddressWrapperSchema] = Field(None, alias="from")  # Optional, isDraft= True
-    toRecipients: Optional[List[EmailAddressWrapperSchema]]
-    ccRecipients: List[EmailAddressWrapperSchema]
-    bccRecipients: List[EmailAddressWrapperSchema]
     replyTo: List[EmailAddressWrapperSchema]
     flag: MessageFlagSchema
     # Optional, odata_type = '#microsoft.graph.eventMessageResponse'
@@ -107,6 +123,32 @@ class MessagesSchema(BaseModel):
     odata_nextLink: Optional[str] = Field(None, alias="@odata.nextLink")
 
 
+class MessagesDeltaSchema(MessagesSchema):
+    # present on the last page of a delta round only
+    odata_deltaLink: Optional[str] = Field(None, alias="@odata.deltaLink")
+
+
+class MessageHeadersDeltaSchema(MessagesDeltaSchema):
+    value: Optional[List[MessageHeaderSchema]]
+
+
+class MessagesPersistDeltaSchema(MessagesDeltaSchema):
+    value: Optional[List[MessagePersistSchema]]
+
+
+MESSAGE_PROJECTION_SCHEMAS: Dict[MessageProjection, Type[MessageHeaderSchema]] = {
+    MessageProjection.classify: MessageHeaderSchema,
+    MessageProjection.persist: MessagePersistSchema,
+    MessageProjection.full: MessageSchema,
+}
+
+MESSAGE_PROJECTION_PAGE_SCHEMAS: Dict[MessageProjection, Type[MessagesDeltaSchema]] = {
+    MessageProjection.classify: MessageHeadersDeltaSchema,
+    MessageProjection.persist: MessagesPersistDeltaSchema,
+    MessageProjection.full: MessagesDeltaSchema,
+}
+
+
 class AttachmentSchema(BaseModel):
     odata_type: Optional[str] = Field(None, alias="@odata.type")
     odata_mediaContentType: Optional[str] = Field(None, alias="@odata.mediaContentType")
@@ -147,3 +189,26 @@ class CreateMessageSchema(BaseModel):
 class SendMessageRequestSchema(BaseModel):
     message: CreateMessageSchema
     saveToSentItems: bool = True
+
+
+class BatchRequestSchema(BaseModel):
+    id: str
+    method: str
+    url: str  # relative to base_url, e.g. /users/{id}/messages
+    headers: Optional[Dict[str, str]]
+    body: Optional[Any]
+
+
+class BatchRequestsSchema(BaseModel):
+    requests: List[BatchRequestSchema]
+
+
+class BatchResponseSchema(BaseModel):
+    id: str
+    status: int
+    headers: Optional[Dict[str, str]]
+    body: Optional[Any]
+
+
+class BatchResponsesSchema(BaseModel):
+    responses: List[BatchResponseSchema]
@@ -0,0 +1,84 @@
+from datetime import datetime
+from enum import Enum
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+
+class UserSyncResult(BaseModel):
+    user_id: str
+    success: bool
+    rows: int = 0
+    links: int = 0
+    duration_sec: float = 0.0
+    error: Optional[str]
+
+
+class JobRunStatus(str, Enum):
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+class JobRun(BaseModel):
+    tenant: str
+    job_name: str
+    trigger: str  # schedule, catch_up or manual
+    scheduled_at: datetime
+    started_at: datetime
+    finished_at: Optional[datetime]
+    status: JobRunStatus = JobRunStatus.running
+    filter: str = ""
+    users: int = 0
+    failed_users: int = 0
+    error: Optional[str]
+
+
+class ScheduledJobInfo(BaseModel):
+    tenant: str
+    job_name: str
+    interval_sec: int
+    next_run_at: Optional[datetime]
+    is_running: bool
+    missed_runs: int
+    last_run: Optional[JobRun]
+
+
+class SyncJobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+class SyncJobParams(BaseModel):
+    top: int = 5
+    filter: str = ""
+    delta: bool = False
+    two_phase: bool = False
+    concurrency: Optional[int]
+    use_checkpoint: bool = False
+
+
+class SyncProgress(BaseModel):
+    mailboxes_total: int = 0
+    mailboxes_done: int = 0
+    mailboxes_failed: int = 0
+    messages_listed: int = 0
+    messages_processed: int = 0
+    messages_discarded: int = 0
+    messages_with_attachments_saved: int = 0
+
+
+class SyncJob(BaseModel):
+    id: str
+    tenant: str
+    user_id: Optional[str]  # set for a single mailbox sync
+    params: SyncJobParams
+    status: SyncJobStatus = SyncJobStatus.queued
+    submitted_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+    progress: SyncProgress = Field(default_factory=SyncProgress)
+    results: List[UserSyncResult] = []
+    error: Optional[str]
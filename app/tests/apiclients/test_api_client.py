@@ -1,6 +1,8 @@
 import pytest
+from aiohttp import web
 
 from app.apiclients.api_client import ApiClient
+from app.apiclients.retry_policy import RetryPolicy
 
 # This is the same as using the @pytest.mark.anyio on all test functions in the module
 pytestmark = pytest.mark.anyio
@@ -19,3 +21,58 @@ async def test_api_client():
         assert response.status == 200
         # assert body == ""
 
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_retryable_call_retries_idempotent_only_and_returns_last_response():
+    calls = []
+
+    async def unavailable(request):
+        calls.append(request.method)
+        return web.json_response({"error": {"code": "ServiceUnavailable"}}, status=503)
+
+    app = web.Application()
+    app.router.add_route("*", "/", unavailable)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}/"
+    retry_policy = RetryPolicy(max_attempts=3, base_delay_sec=0.001)
+    try:
+        response, data = await ApiClient('get', url, retry_policy=retry_policy).retryable_call()
+        assert response.status == 503
+        assert data["error"]["code"] == "ServiceUnavailable"
+        assert calls == ["GET", "GET", "GET"]
+        calls.clear()
+        # e.g. sendMail, the server may have sent the mail before failing
+        response, data = await ApiClient('post', url, retry_policy=retry_policy).retryable_call()
+        assert response.status == 503
+        assert calls == ["POST"]
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_retryable_call_stops_retrying_after_max_total_sec():
+    calls = []
+
+    async def throttled(request):
+        calls.append(request.method)
+        return web.json_response({"error": {"code": "TooManyRequests"}}, status=429, headers={"Retry-After": "1"})
+
+    app = web.Application()
+    app.router.add_route("*", "/", throttled)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}/"
+    # a second Retry-After wait would take the call past max_total_sec
+    retry_policy = RetryPolicy(max_attempts=5, base_delay_sec=0.001, max_total_sec=1.5)
+    try:
+        response, data = await ApiClient('get', url, retry_policy=retry_policy).retryable_call()
+        assert response.status == 429
+        assert calls == ["GET", "GET"]
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,71 @@
+import pytest
+
+from app.apiclients.batch_ms import MAX_BATCH_SIZE, MsBatchHelper
+from app.apiclients.endpoint_ms import MsEndpointHelper
+from app.apiclients.retry_policy import RetryPolicy
+from app.schemas.schema_endpoint_ms import MsEndpoint, OptionalQueryParams
+from app.schemas.schema_ms_graph import BatchRequestSchema, BatchResponseSchema
+
+# This is the same as using the @pytest.mark.anyio on all test functions in the module
+pytestmark = pytest.mark.anyio
+
+
+def get_requests(count: int):
+    return [BatchRequestSchema(id=str(i), method="GET", url=f"/users/u/messages/id{i}") for i in range(count)]
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_call_chunks_and_maps_responses_by_id(monkeypatch):
+    chunks = []
+
+    async def call_chunk(token, chunk, tenant, mailbox):
+        chunks.append([request.id for request in chunk])
+        # msgraph answers in any order
+        return [BatchResponseSchema(id=request.id, status=200, body={"url": request.url}) for request in reversed(chunk)]
+
+    monkeypatch.setattr(MsBatchHelper, "_call_chunk", staticmethod(call_chunk))
+    results = await MsBatchHelper.call({"access_token": "t"}, get_requests(45))
+
+    assert [len(chunk) for chunk in chunks] == [MAX_BATCH_SIZE, MAX_BATCH_SIZE, 5]
+    assert len(results) == 45
+    assert all(results[str(i)].body == {"url": f"/users/u/messages/id{i}"} for i in range(45))
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_call_retries_failed_sub_requests_only(monkeypatch):
+    calls = []
+
+    async def call_chunk(token, chunk, tenant, mailbox):
+        calls.append([request.id for request in chunk])
+        responses = []
+        for request in chunk:
+            if request.id == "1" and len(calls) == 1:
+                responses.append(BatchResponseSchema(id=request.id, status=429, headers={"Retry-After": "0"}))
+            elif request.id == "2":
+                responses.append(BatchResponseSchema(id=request.id, status=404, body={"error": {"code": "NotFound"}}))
+            else:
+                responses.append(BatchResponseSchema(id=request.id, status=200, body={}))
+        return responses
+
+    monkeypatch.setattr(MsBatchHelper, "_call_chunk", staticmethod(call_chunk))
+    results = await MsBatchHelper.call(
+        {"access_token": "t"}, get_requests(3), retry_policy=RetryPolicy(max_attempts=3, base_delay_sec=0.001)
+    )
+
+    # the throttled sub-request is sent again on its own, the failed one is returned as is
+    assert calls == [["0", "1", "2"], ["1"]]
+    assert {request_id: response.status for request_id, response in results.items()} == {"0": 200, "1": 200, "2": 404}
+
+
+def test_form_relative_url_quotes_query_values():
+    endpoint = MsEndpoint(
+        application_permissions=[],
+        request_method="get",
+        request_path_template="/users/{id}/messages",
+        request_params={"id": "u"},
+        optional_query_params=OptionalQueryParams(**{"$filter": "internetMessageId eq '<a+b&c#d@x.com>'"})
+    )
+
+    url = MsEndpointHelper.form_relative_url(endpoint)
+
+    assert url == "/users/u/messages?$filter=internetMessageId%20eq%20'%3Ca%2Bb%26c%23d@x.com%3E'"
@@ -0,0 +1,19 @@
+import asyncio
+
+from app.apiclients.http_session import HttpSessionManager
+
+
+def test_get_session_closes_session_of_old_loop():
+    http_session_manager = HttpSessionManager()
+    first = asyncio.run(http_session_manager.get_session())
+
+    async def get_second():
+        second = await http_session_manager.get_session()
+        assert second is await http_session_manager.get_session()
+        await http_session_manager.close_all()
+        return second
+
+    second = asyncio.run(get_second())
+    assert second is not first
+    assert first.closed
+    assert second.closed
@@ -0,0 +1,33 @@
+import time
+
+import pytest
+
+from app.apiclients.rate_limiter import TokenBucket
+
+# This is the same as using the @pytest.mark.anyio on all test functions in the module
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_token_bucket_acquire():
+    bucket = TokenBucket(20, 2, min_rate=1)
+    start = time.monotonic()
+    # burst of 2 is immediate, the next 2 wait for refill at 20/sec
+    for _ in range(4):
+        await bucket.acquire()
+    elapsed = time.monotonic() - start
+    assert 0.08 <= elapsed < 0.5
+
+
+def test_token_bucket_on_throttle_and_on_success():
+    bucket = TokenBucket(8, 10, min_rate=1, decrease_factor=0.5, increase_per_success=1)
+    bucket.on_throttle(retry_after=2)
+    assert bucket.rate == 4
+    assert bucket.tokens == 0
+    assert bucket.blocked_until > time.monotonic() + 1
+    for _ in range(3):
+        bucket.on_throttle()
+    assert bucket.rate == 1  # never below min_rate
+    for _ in range(20):
+        bucket.on_success()
+    assert bucket.rate == 8  # never above configured rate
@@ -0,0 +1,44 @@
+from app.apiclients.retry_policy import RetryPolicy, RetryStats
+
+
+def test_is_retryable_status():
+    policy = RetryPolicy()
+    assert policy.is_retryable_status(429)
+    assert policy.is_retryable_status(503)
+    assert policy.is_retryable_status(504)
+    assert not policy.is_retryable_status(200)
+    assert not policy.is_retryable_status(404)
+    # non idempotent calls only retry throttling
+    assert policy.is_retryable_status(429, idempotent=False)
+    assert not policy.is_retryable_status(503, idempotent=False)
+
+
+def test_get_delay():
+    policy = RetryPolicy(base_delay_sec=1, max_delay_sec=10)
+    # Retry-After wins, capped by max delay
+    assert policy.get_delay(1, retry_after=7) == 7
+    assert policy.get_delay(1, retry_after=120) == 10
+    # jittered exponential backoff
+    for attempt in range(1, 8):
+        delay = policy.get_delay(attempt)
+        assert 0 <= delay <= min(10, 2 ** (attempt - 1))
+
+
+def test_parse_retry_after():
+    assert RetryPolicy.parse_retry_after("5") == 5
+    assert RetryPolicy.parse_retry_after(None) is None
+    assert RetryPolicy.parse_retry_after("not a date") is None
+    assert RetryPolicy.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+
+
+def test_retry_stats():
+    stats = RetryStats()
+    stats.record_call("message:list")
+    stats.record_retry("message:list", "429")
+    stats.record_retry("message:list", "429")
+    stats.record_exhausted("message:list")
+    snapshot = stats.snapshot()
+    assert snapshot["message:list"]["calls"] == 1
+    assert snapshot["message:list"]["retries"] == 2
+    assert snapshot["message:list"]["retries_429"] == 2
+    assert snapshot["message:list"]["exhausted"] == 1
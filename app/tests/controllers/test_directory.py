@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.apiclients.api_client import ApiClient
+from app.apiclients.endpoint_ms import MsEndpointHelper, endpoints_ms
+from app.controllers.directory import DirectorySnapshot, TenantDirectory
+from app.controllers.user import UserController
+from app.schemas.schema_ms_graph import UserSchema
+
+
+def test_directory_snapshot_indexes_smtp_proxy_addresses():
+    user = UserSchema(
+        id="u1", mail="Jane.Doe@acme.com",
+        proxyAddresses=["SMTP:Jane.Doe@acme.com", "smtp:jane@acme.onmicrosoft.com", "x500:/o=acme/cn=jane"]
+    )
+    snapshot = DirectorySnapshot([user, UserSchema(id="u2", mail=None)])
+    assert snapshot.get_user("jane.doe@ACME.com").id == "u1"
+    assert snapshot.get_user(" jane@acme.onmicrosoft.com").id == "u1"
+    assert snapshot.get_user("/o=acme/cn=jane") is None
+    assert snapshot.get_user("client@example.com") is None
+    assert snapshot.get_info()["users"] == 2
+    assert snapshot.get_info()["addresses"] == 2
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_get_all_users_url_after_user_lookup(monkeypatch):
+    urls = []
+
+    async def retryable_call(self):
+        urls.append(self.url)
+        return SimpleNamespace(status=200), {"value": [{"id": "u1", "mail": "jane@acme.com"}]}
+
+    monkeypatch.setattr(ApiClient, "retryable_call", retryable_call)
+    loaded_filter = endpoints_ms.endpoints.get("user:list").optional_query_params.filter
+    lookup_url = MsEndpointHelper.form_url(UserController._get_user_by_email_endpoint("jane@acme.com", "id"))
+    users = await TenantDirectory.get_all_users({"access_token": "t"}, "acme")
+
+    assert "$filter=" in lookup_url
+    assert [user.id for user in users] == ["u1"]
+    assert "$filter" not in urls[0] and "$orderby" not in urls[0]
+    assert endpoints_ms.endpoints.get("user:list").optional_query_params.filter == loaded_filter
@@ -1,6 +1,29 @@
-from sqlalchemy.orm import Session
+import asyncio
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+from typing import List, Tuple, Union
 
-from app.controllers.mail import get_attachments_path_from_id
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.apiclients.api_client import ApiClient
+from app.controllers import mail
+from app.controllers.directory import tenant_directory
+from app.controllers.mail_index import mail_unique_id_index
+from app.controllers.mail import get_attachments_path_from_id, add_received_date_time_filter, \
+    is_delta_token_expired, MailController, MailProcessor, MessagesPageException
+from app.controllers.user import UserController
+from app.crud.crud_mailbox_checkpoint import CRUDMailboxCheckpoint
+from app.crud.crud_se_correspondence import CRUDSECorrespondence
+from app.core.auth import msal_client_registry
+from app.core.settings import settings
+from app.models.se_correspondence import SECorrespondence
+from app.schemas.schema_ms_graph import MessageHeaderSchema, MessageHeadersDeltaSchema, UserResponseSchema, UserSchema
+from app.schemas.schema_sync import SyncProgress
+from tests.crud.test_crud_se_correspondence import get_se_correspondence_create
 
 
 def test_get_s3_path_from_correspondence_id():
@@ -9,3 +32,387 @@ def test_get_s3_path_from_correspondence_id():
 
     path = get_attachments_path_from_id(id=93245233)
     assert path == "9/3/2/4/5/2/3/3/93245233"
+
+
+def test_add_received_date_time_filter():
+    since = datetime(2022, 4, 11, 1, 0, 0)
+    assert add_received_date_time_filter("", since) == "receivedDateTime ge 2022-04-11T01:00:00Z"
+    assert add_received_date_time_filter("subject eq 'x'", since) == \
+        "receivedDateTime ge 2022-04-11T01:00:00Z and subject eq 'x'"
+    assert add_received_date_time_filter("", None) == "receivedDateTime ge 1900-01-01T00:00:00Z"
+
+
+def test_is_delta_token_expired():
+    assert is_delta_token_expired(410, None)
+    assert is_delta_token_expired(400, {"error": {"code": "SyncStateNotFound"}})
+    assert is_delta_token_expired(400, {"error": {"code": "resyncRequired"}})
+    assert not is_delta_token_expired(400, {"error": {"code": "BadRequest"}})
+    assert not is_delta_token_expired(400, "Bad Request")
+    assert not is_delta_token_expired(200, {"value": []})
+
+
+def get_message(i: int) -> MessageHeaderSchema:
+    return MessageHeaderSchema(**{
+        "id": f"id{i}", "receivedDateTime": f"2022-01-01T00:00:0{i}Z", "sentDateTime": "2022-01-01T00:00:00Z",
+        "hasAttachments": False, "internetMessageId": f"<{i}>", "subject": f"s{i}", "bodyPreview": "",
+        "parentFolderId": "", "conversationId": "c", "from": {"emailAddress": {"address": "x@client.com"}},
+        "toRecipients": [{"emailAddress": {"address": "me@acme.com"}}], "ccRecipients": [], "bccRecipients": []
+    })
+
+
+def stub_sync(
+        monkeypatch,
+        pages: List[Union[MessageHeadersDeltaSchema, Tuple[str, MessageHeadersDeltaSchema]]],
+        *,
+        missing_bodies: Tuple[str, ...] = (),
+        stored: Tuple[str, ...] = ()
+) -> dict:
+    """Stubs msgraph and db calls of MailController.save_user_messages_and_attachments, returns what it saved"""
+    saved = {"delta_links": [], "checkpoints": [], "fetched": []}
+
+    async def get_user(token, tenant, id):
+        return UserResponseSchema(id=id, mail="me@acme.com")
+
+    async def get_or_build_snapshot(token, tenant):
+        return None
+
+    async def process_messages(tenant, user, messages, db_fit, db_mailstore, process_ind):
+        return [SimpleNamespace(MailUniqueId=message.internetMessageId) for message in messages]
+
+    async def fetch_message_bodies(token, tenant, user_id, messages, obj_ins):
+        saved["fetched"].extend(obj_in.MailUniqueId for obj_in in obj_ins)
+        obj_ins_with_body = [obj_in for obj_in in obj_ins if obj_in.MailUniqueId not in missing_bodies]
+        return obj_ins_with_body, len(obj_ins_with_body) == len(obj_ins)
+
+    async def save_attachments(token, tenant, user_id, messages, db_mailstore):
+        return []
+
+    async def iter_messages_delta_all_folders(token, tenant, user_id, db_mailstore, top, filter, projection):
+        for page in pages:
+            # (folder_id, page) or a page of the inbox
+            yield page if isinstance(page, tuple) else ("inbox", page)
+
+    async def iter_messages_pages(token, tenant, user_id, top, filter, projection, orderby, next_link):
+        for page in pages:
+            yield page
+
+    monkeypatch.setattr(UserController, "get_user", staticmethod(get_user))
+    monkeypatch.setattr(tenant_directory, "get_or_build_snapshot", get_or_build_snapshot)
+    monkeypatch.setattr(MailProcessor, "process_messages", staticmethod(process_messages))
+    monkeypatch.setattr(MailController, "fetch_message_bodies", staticmethod(fetch_message_bodies))
+    monkeypatch.setattr(
+        mail_unique_id_index, "get_seq_nos",
+        lambda tenant, db, mail_unique_ids: {i: 1 for i in mail_unique_ids if i in stored}
+    )
+    monkeypatch.setattr(
+        CRUDSECorrespondence, "get_by_mail_unique_id_or_create_get_if_not_exist_multi", lambda self, db, obj_ins: obj_ins
+    )
+    monkeypatch.setattr(MailController, "process_and_save_user_messages_attachments_to_disk", staticmethod(save_attachments))
+    monkeypatch.setattr(MailController, "iter_messages_delta_all_folders", staticmethod(iter_messages_delta_all_folders))
+    monkeypatch.setattr(MailController, "iter_messages_pages", staticmethod(iter_messages_pages))
+    monkeypatch.setattr(
+        MailController, "save_delta_links",
+        staticmethod(lambda db, user_id, delta_links: saved["delta_links"].append(dict(delta_links)))
+    )
+    monkeypatch.setattr(
+        MailController, "save_checkpoint",
+        staticmethod(lambda db, user_id, filter, next_link, messages: saved["checkpoints"].append(next_link))
+    )
+    return saved
+
+
+def get_delta_pages() -> List[MessageHeadersDeltaSchema]:
+    return [
+        MessageHeadersDeltaSchema(**{"value": [get_message(0), get_message(1)], "@odata.nextLink": "p=1"}),
+        MessageHeadersDeltaSchema(**{"value": [get_message(2)], "@odata.deltaLink": "delta=2"}),
+    ]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_delta_links_saved_once_all_pages_are_saved(monkeypatch):
+    saved = stub_sync(monkeypatch, get_delta_pages())
+    db = Session(info={"tenant": "acme"})
+    rows, links = await MailController.save_user_messages_and_attachments(
+        {"access_token": "t"}, "acme", "u", db, db, delta=True, two_phase=True
+    )
+    assert [row.MailUniqueId for row in rows] == ["<0>", "<1>", "<2>"]
+    assert saved["delta_links"] == [{"inbox": "delta=2"}]
+    assert saved["checkpoints"] == []
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_delta_links_kept_when_a_body_is_missing(monkeypatch):
+    saved = stub_sync(monkeypatch, get_delta_pages(), missing_bodies=("<1>",))
+    db = Session(info={"tenant": "acme"})
+    rows, links = await MailController.save_user_messages_and_attachments(
+        {"access_token": "t"}, "acme", "u", db, db, delta=True, two_phase=True
+    )
+    # the next round has to see <1> again
+    assert [row.MailUniqueId for row in rows] == ["<0>", "<2>"]
+    assert saved["delta_links"] == []
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_delta_link_of_folder_saved_once_its_pages_are_saved(monkeypatch):
+    saved = stub_sync(monkeypatch, [
+        ("inbox", MessageHeadersDeltaSchema(**{"value": [get_message(0)], "@odata.deltaLink": "inbox=1"})),
+        ("sentitems", MessageHeadersDeltaSchema(**{"value": [get_message(1)], "@odata.nextLink": "p=1"})),
+        ("sentitems", MessageHeadersDeltaSchema(**{"value": [get_message(2)], "@odata.deltaLink": "sentitems=1"})),
+    ], missing_bodies=("<1>",))
+    db = Session(info={"tenant": "acme"})
+    await MailController.save_user_messages_and_attachments(
+        {"access_token": "t"}, "acme", "u", db, db, delta=True, two_phase=True
+    )
+    # the delta link of sentitems was listed before the inbox was saved, but a page before it is incomplete
+    assert saved["delta_links"] == [{"inbox": "inbox=1"}]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+@pytest.mark.parametrize('status, data', [
+    (400, {"error": {"code": "BadRequest", "message": "Invalid filter clause"}}),
+    (403, {"error": {"code": "ErrorAccessDenied"}}),
+    (503, "Service Unavailable"),
+    (200, {"error": "no value"}),
+])
+async def test_get_messages_page_raises_on_error(monkeypatch, status, data):
+    async def retryable_call(self):
+        return SimpleNamespace(status=status), data
+
+    monkeypatch.setattr(ApiClient, "retryable_call", retryable_call)
+    with pytest.raises(MessagesPageException):
+        await MailController._get_messages_page(
+            {"access_token": "t"}, "acme", "u", "http://graph/users/u/messages", endpoint_name="message:list"
+        )
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_failed_page_keeps_checkpoint_of_last_saved_page(monkeypatch):
+    saved = stub_sync(monkeypatch, [])
+
+    async def iter_messages_pages(token, tenant, user_id, top, filter, projection, orderby, next_link):
+        yield MessageHeadersDeltaSchema(**{"value": [get_message(0)], "@odata.nextLink": "p=1"})
+        # downloading the next page takes a while
+        await asyncio.sleep(0.1)
+        raise MessagesPageException(403, {"error": {"code": "ErrorAccessDenied"}})
+
+    monkeypatch.setattr(MailController, "iter_messages_pages", staticmethod(iter_messages_pages))
+    monkeypatch.setattr(CRUDMailboxCheckpoint, "get_by_mailbox", lambda self, db, mailbox: None)
+    db = Session(info={"tenant": "acme"})
+    with pytest.raises(MessagesPageException):
+        await MailController.save_user_messages_and_attachments(
+            {"access_token": "t"}, "acme", "u", db, db, use_checkpoint=True
+        )
+    # the next run resumes from the page that failed
+    assert saved["checkpoints"] == ["p=1"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+@pytest.mark.parametrize("filter, list_filter, orderby", [
+    ("", "receivedDateTime ge 2022-05-01T00:00:00Z", "receivedDateTime asc"),
+    ("subject eq 'x'", "receivedDateTime ge 2022-05-01T00:00:00Z and subject eq 'x'", "receivedDateTime asc"),
+    # a scheduled run's filter starts before the checkpoint, it is not narrowed
+    ("receivedDateTime gt 2022-04-30T23:55:00Z", "receivedDateTime gt 2022-04-30T23:55:00Z", "receivedDateTime asc"),
+    # msgraph rejects the orderby when receivedDateTime is not first in the filter
+    ("subject eq 'x' and receivedDateTime gt 2022-04-30T23:55:00Z",
+     "subject eq 'x' and receivedDateTime gt 2022-04-30T23:55:00Z", ""),
+])
+async def test_checkpoint_does_not_narrow_explicit_time_filter(monkeypatch, filter, list_filter, orderby):
+    stub_sync(monkeypatch, [])
+    listed = []
+
+    async def iter_messages_pages(token, tenant, user_id, top, filter, projection, orderby, next_link):
+        listed.append((filter, orderby))
+        yield MessageHeadersDeltaSchema(**{"value": []})
+
+    monkeypatch.setattr(MailController, "iter_messages_pages", staticmethod(iter_messages_pages))
+    monkeypatch.setattr(
+        CRUDMailboxCheckpoint, "get_by_mailbox",
+        lambda self, db, mailbox: SimpleNamespace(ReceivedDateTime=datetime(2022, 5, 1), NextLink=None, Filter="")
+    )
+    db = Session(info={"tenant": "acme"})
+    await MailController.save_user_messages_and_attachments(
+        {"access_token": "t"}, "acme", "u", db, db, filter=filter, use_checkpoint=True
+    )
+    assert listed == [(list_filter, orderby)]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_rejected_checkpoint_next_link_is_removed(monkeypatch):
+    saved = stub_sync(monkeypatch, [])
+    listed = []
+    removed = []
+
+    async def iter_messages_pages(token, tenant, user_id, top, filter, projection, orderby, next_link):
+        listed.append(next_link)
+        if next_link == "p=expired":
+            raise MessagesPageException(400, {"error": {"code": "ErrorInvalidSkipToken"}})
+        yield MessageHeadersDeltaSchema(**{"value": [get_message(0)]})
+
+    monkeypatch.setattr(MailController, "iter_messages_pages", staticmethod(iter_messages_pages))
+    monkeypatch.setattr(
+        CRUDMailboxCheckpoint, "get_by_mailbox",
+        lambda self, db, mailbox: SimpleNamespace(
+            ReceivedDateTime=datetime(2022, 5, 1), NextLink="p=expired", Filter="subject eq 'x'"
+        )
+    )
+    monkeypatch.setattr(
+        MailController, "remove_checkpoint_next_link", staticmethod(lambda db, user_id: removed.append(user_id))
+    )
+    db = Session(info={"tenant": "acme"})
+    rows, links = await MailController.save_user_messages_and_attachments(
+        {"access_token": "t"}, "acme", "u", db, db, filter="subject eq 'x'", use_checkpoint=True
+    )
+    # listed again from the high water mark
+    assert listed == ["p=expired", None]
+    assert removed == ["u"]
+    assert [row.MailUniqueId for row in rows] == ["<0>"]
+    assert saved["checkpoints"] == [None]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_checkpoint_is_not_used_by_default(monkeypatch):
+    stub_sync(monkeypatch, [])
+    listed = []
+
+    async def iter_messages_pages(token, tenant, user_id, top, filter, projection, orderby, next_link):
+        listed.append((filter, orderby, next_link))
+        yield MessageHeadersDeltaSchema(**{"value": []})
+
+    def get_by_mailbox(self, db, mailbox):
+        raise AssertionError("checkpoint read")
+
+    monkeypatch.setattr(MailController, "iter_messages_pages", staticmethod(iter_messages_pages))
+    monkeypatch.setattr(CRUDMailboxCheckpoint, "get_by_mailbox", get_by_mailbox)
+    db = Session(info={"tenant": "acme"})
+    await MailController.save_user_messages_and_attachments(
+        {"access_token": "t"}, "acme", "u", db, db, filter="subject eq 'x'"
+    )
+    assert listed == [("subject eq 'x'", "", None)]
+
+def get_pages() -> List[MessageHeadersDeltaSchema]:
+    return [
+        MessageHeadersDeltaSchema(**{"value": [get_message(0), get_message(1)], "@odata.nextLink": "p=1"}),
+        MessageHeadersDeltaSchema(**{"value": [get_message(2)], "@odata.nextLink": "p=2"}),
+        MessageHeadersDeltaSchema(**{"value": [get_message(3)]}),
+    ]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_two_phase_fetches_bodies_of_new_messages_only(monkeypatch):
+    saved = stub_sync(monkeypatch, get_pages(), stored=("<1>",))
+    monkeypatch.setattr(CRUDMailboxCheckpoint, "get_by_mailbox", lambda self, db, mailbox: None)
+    db = Session(info={"tenant": "acme"})
+    rows, links = await MailController.save_user_messages_and_attachments(
+        {"access_token": "t"}, "acme", "u", db, db, two_phase=True, use_checkpoint=True
+    )
+    assert saved["fetched"] == ["<0>", "<2>", "<3>"]
+    assert [row.MailUniqueId for row in rows] == ["<0>", "<1>", "<2>", "<3>"]
+    assert saved["checkpoints"] == ["p=1", "p=2", None]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_checkpoint_stops_at_page_with_missing_body(monkeypatch):
+    saved = stub_sync(monkeypatch, get_pages(), missing_bodies=("<2>",))
+    monkeypatch.setattr(CRUDMailboxCheckpoint, "get_by_mailbox", lambda self, db, mailbox: None)
+    db = Session(info={"tenant": "acme"})
+    rows, links = await MailController.save_user_messages_and_attachments(
+        {"access_token": "t"}, "acme", "u", db, db, two_phase=True, use_checkpoint=True
+    )
+    # later pages are saved, but the next run lists again from the page of <2>
+    assert [row.MailUniqueId for row in rows] == ["<0>", "<1>", "<3>"]
+    assert saved["checkpoints"] == ["p=1"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_save_tenant_messages_limits_concurrency_and_isolates_failures(monkeypatch):
+    running = 0
+    max_running = 0
+
+    async def get_users_to_track(token, tenant, db_sales97):
+        return [UserSchema(id=f"u{i}", mail=f"u{i}@acme.com") for i in range(6)]
+
+    async def save_user_messages_and_attachments(token, tenant, id, db_fit, db_mailstore, *args):
+        nonlocal running, max_running
+        assert token["access_token"] == "current"
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+        if id == "u2":
+            raise RuntimeError("mailbox not found")
+        return [SimpleNamespace(MailUniqueId=f"<{id}>")], []
+
+    @contextmanager
+    def tenant_db_session(tenant, db_name):
+        yield Session(info={"tenant": tenant})
+
+    async def get_token(tenant, force_refresh=False):
+        return {"access_token": "current"}
+
+    monkeypatch.setattr(UserController, "get_users_to_track", staticmethod(get_users_to_track))
+    monkeypatch.setattr(
+        MailController, "save_user_messages_and_attachments", staticmethod(save_user_messages_and_attachments)
+    )
+    monkeypatch.setattr(mail, "tenant_db_session", tenant_db_session)
+    # the token of the tenant sync may have expired by the time a mailbox starts
+    monkeypatch.setattr(msal_client_registry, "get_token", get_token)
+    monkeypatch.setattr(mail, "configuration", SimpleNamespace(tenant_configurations={
+        "acme": SimpleNamespace(db=SimpleNamespace(db_fit_name="fit", db_mailstore_name="mailstore"))
+    }))
+    monkeypatch.setattr(settings, "SHARDING_ENABLED", False)
+    progress = SyncProgress()
+    users, rows, links, results = await MailController.save_tenant_messages_and_attachments(
+        {"access_token": "expired"}, "acme", Session(), concurrency=2, progress=progress
+    )
+
+    assert max_running == 2
+    assert [result.success for result in results] == [True, True, False, True, True, True]
+    assert results[2].error == "mailbox not found"
+    assert len(rows) == 5
+    assert (progress.mailboxes_total, progress.mailboxes_done, progress.mailboxes_failed) == (6, 5, 1)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_message_shared_by_two_mailboxes_is_saved_once(monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'mailstore.db'}", connect_args={"check_same_thread": False})
+    SECorrespondence.__table__.create(engine)
+    session_local = sessionmaker(bind=engine, info={"tenant": "acme"}, expire_on_commit=False)
+    get_or_create = CRUDSECorrespondence.get_by_mail_unique_id_or_create_get_if_not_exist_multi
+    get_by_keys = CRUDSECorrespondence.get_by_keys
+    stub_sync(monkeypatch, [MessageHeadersDeltaSchema(**{"value": [get_message(0)]})])
+
+    async def process_messages(tenant, user, messages, db_fit, db_mailstore, process_ind):
+        return [get_se_correspondence_create(message.internetMessageId) for message in messages]
+
+    def slow_get_by_keys(self, db, *, key, values, chunk_size=500):
+        # the other mailbox gets to check for the row in the meantime
+        db_objs = get_by_keys(self, db, key=key, values=values, chunk_size=chunk_size)
+        time.sleep(0.05)
+        return db_objs
+
+    monkeypatch.setattr(MailProcessor, "process_messages", staticmethod(process_messages))
+    monkeypatch.setattr(CRUDSECorrespondence, "get_by_mail_unique_id_or_create_get_if_not_exist_multi", get_or_create)
+    monkeypatch.setattr(CRUDSECorrespondence, "get_by_keys", slow_get_by_keys)
+    monkeypatch.setattr(mail_unique_id_index, "add", lambda tenant, mail_unique_ids: None)
+    sessions = [session_local() for _ in range(4)]
+    results = await asyncio.gather(
+        MailController.save_user_messages_and_attachments({"access_token": "t"}, "acme", "sender", *sessions[:2]),
+        MailController.save_user_messages_and_attachments({"access_token": "t"}, "acme", "recipient", *sessions[2:]),
+    )
+
+    assert [rows[0].SeqNo for rows, links in results] == [1, 1]
+    assert sessions[0].query(SECorrespondence).count() == 1
+    for db in sessions:
+        db.close()
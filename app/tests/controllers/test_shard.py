@@ -0,0 +1,70 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.controllers.shard import MailboxShardCoordinator, rendezvous_owner
+from app.models.mailbox_lease import MailboxLease
+from app.models.sync_worker import SyncWorker
+from app.schemas.schema_ms_graph import UserSchema
+
+
+def test_rendezvous_owner():
+    mailboxes = [f"mailbox{i}" for i in range(200)]
+    owners = {mailbox: rendezvous_owner(mailbox, ["a", "b", "c"]) for mailbox in mailboxes}
+    assert set(owners.values()) == {"a", "b", "c"}
+    # only the mailboxes of the worker that left move
+    owners_without_c = {mailbox: rendezvous_owner(mailbox, ["b", "a"]) for mailbox in mailboxes}
+    for mailbox in mailboxes:
+        if owners[mailbox] != "c":
+            assert owners_without_c[mailbox] == owners[mailbox]
+    assert rendezvous_owner("mailbox", []) is None
+
+
+def get_session_maker(path: str):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    SyncWorker.__table__.create(engine)
+    MailboxLease.__table__.create(engine)
+    return sessionmaker(bind=engine, expire_on_commit=False)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_claim_and_release_run_db_work_off_the_event_loop(monkeypatch, tmp_path):
+    session_local = get_session_maker(str(tmp_path / "mailstore.db"))
+    db_threads = []
+
+    @contextmanager
+    def mailstore_session(tenant):
+        db_threads.append(threading.current_thread())
+        db = session_local()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    monkeypatch.setattr(MailboxShardCoordinator, "_mailstore_session", staticmethod(mailstore_session))
+    coordinator = MailboxShardCoordinator()
+    users = [UserSchema(id=f"u{i}") for i in range(20)]
+    # the only live worker owns every mailbox
+    claimed = await coordinator.claim_users("acme", users)
+    assert [user.id for user in claimed] == [user.id for user in users]
+    assert len(coordinator.get_held_mailboxes("acme")) == 20
+
+    # heartbeats renew the held leases while mailboxes are released
+    heartbeats = [
+        asyncio.get_event_loop().run_in_executor(None, coordinator.heartbeat, "acme") for _ in range(20)
+    ]
+    await asyncio.gather(*[coordinator.release("acme", user.id) for user in users], *heartbeats)
+    await coordinator.stop()
+
+    assert coordinator.get_held_mailboxes("acme") == []
+    assert threading.current_thread() not in db_threads
+    db = session_local()
+    assert db.query(MailboxLease).count() == 20
+    # stop leaves right away
+    assert db.query(SyncWorker).count() == 0
+    db.close()
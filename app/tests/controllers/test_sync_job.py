@@ -0,0 +1,95 @@
+import asyncio
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.orm import Session
+
+from app.controllers import sync_job
+from app.controllers.sync_job import SyncJobManager
+from app.controllers.user import UserController
+from app.core.settings import settings
+from app.schemas.schema_sync import SyncJobParams, SyncJobStatus
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_sync_job_manager_queues_jobs_over_max_running(monkeypatch):
+    release = asyncio.Event()
+    running = 0
+    max_running = 0
+
+    async def sync(job):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await release.wait()
+        running -= 1
+        if job.user_id == "u1":
+            raise RuntimeError("mailbox not found")
+
+    monkeypatch.setattr(SyncJobManager, "_sync", staticmethod(sync))
+    monkeypatch.setattr(settings, "SYNC_JOB_MAX_RUNNING", 2)
+    manager = SyncJobManager()
+    jobs = [manager.submit("acme", SyncJobParams(), f"u{i}") for i in range(4)]
+    await asyncio.sleep(0.01)
+
+    assert [job.status for job in jobs] == [
+        SyncJobStatus.running, SyncJobStatus.running, SyncJobStatus.queued, SyncJobStatus.queued
+    ]
+    release.set()
+    await asyncio.sleep(0.01)
+
+    assert max_running == 2
+    assert [job.status for job in jobs] == [
+        SyncJobStatus.succeeded, SyncJobStatus.failed, SyncJobStatus.succeeded, SyncJobStatus.succeeded
+    ]
+    assert jobs[1].error == "mailbox not found"
+    assert manager.get_multi("acme") == list(reversed(jobs))
+    await manager.stop()
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_sync_job_manager_trims_finished_jobs(monkeypatch):
+    async def sync(job):
+        pass
+
+    monkeypatch.setattr(SyncJobManager, "_sync", staticmethod(sync))
+    monkeypatch.setattr(settings, "SYNC_JOB_HISTORY_SIZE", 2)
+    manager = SyncJobManager()
+    finished = [manager.submit("acme", SyncJobParams()) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    queued = manager.submit("acme", SyncJobParams())
+
+    # the oldest finished job is removed, the not yet run one is kept
+    assert manager.get(finished[0].id) is None
+    assert [job.id for job in manager.get_multi()] == [queued.id, finished[2].id, finished[1].id]
+    await manager.stop()
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_sync_job_of_unknown_user_fails(monkeypatch):
+    async def get_auth(tenant):
+        return None, None, {"access_token": "t"}
+
+    async def get_user(token, tenant, id):
+        return None
+
+    @contextmanager
+    def tenant_db_session(tenant, db_name):
+        yield Session(info={"tenant": tenant})
+
+    monkeypatch.setattr(sync_job, "get_auth_config_and_confidential_client_application_and_access_token", get_auth)
+    monkeypatch.setattr(sync_job, "tenant_db_session", tenant_db_session)
+    monkeypatch.setattr(sync_job, "configuration", SimpleNamespace(tenant_configurations={
+        "acme": SimpleNamespace(db=SimpleNamespace(db_fit_name="fit", db_mailstore_name="mailstore"))
+    }))
+    monkeypatch.setattr(UserController, "get_user", staticmethod(get_user))
+    manager = SyncJobManager()
+    job = manager.submit("acme", SyncJobParams(), "nobody")
+    await asyncio.sleep(0.01)
+
+    assert job.status == SyncJobStatus.failed
+    assert job.error == "User nobody not found"
+    await manager.stop()
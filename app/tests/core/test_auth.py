@@ -0,0 +1,127 @@
+import asyncio
+from typing import Tuple
+
+import msal
+import pytest
+
+from app.core import auth
+from app.core.auth import FileTokenCache, MsalClientRegistry, \
+    get_auth_config_and_confidential_client_application_and_access_token
+from app.core.config import AzureAuth, Configuration
+from app.core.settings import settings
+
+
+def get_token_event(access_token: str) -> dict:
+    return dict(
+        client_id="client_id",
+        scope=["https://graph.microsoft.com/.default"],
+        token_endpoint="https://login.microsoftonline.com/tenant/oauth2/v2.0/token",
+        response={"access_token": access_token, "expires_in": 3600, "token_type": "Bearer"},
+        environment="login.microsoftonline.com"
+    )
+
+
+def test_file_token_cache_is_shared(tmp_path):
+    path = str(tmp_path / "msal" / "token_cache.json")
+    # two processes are two instances on the same file
+    cache_1 = FileTokenCache(path)
+    cache_2 = FileTokenCache(path)
+    cache_1.add(get_token_event("token-1"))
+    access_tokens = list(cache_2.search(FileTokenCache.CredentialType.ACCESS_TOKEN))
+    assert [access_token["secret"] for access_token in access_tokens] == ["token-1"]
+
+
+class FakeClientApplication:
+    """Answers acquire_token_for_client from its token cache first, as msal >= 1.23 does"""
+
+    def __init__(self, expires_in: int):
+        self.token_cache = msal.TokenCache()
+        self.expires_in = expires_in
+        self.calls = 0
+
+    def acquire_token_silent(self, scopes, account):
+        return None
+
+    def acquire_token_for_client(self, scopes):
+        cached = list(self.token_cache.search(msal.TokenCache.CredentialType.ACCESS_TOKEN, target=scopes))
+        if len(cached) > 0:
+            return {"access_token": cached[0]["secret"], "expires_in": self.expires_in}
+        self.calls += 1
+        self.token_cache.add(get_token_event(f"token-{self.calls}"))
+        return {"access_token": f"token-{self.calls}", "expires_in": self.expires_in}
+
+
+def stub_registry(monkeypatch, expires_in: int) -> Tuple[MsalClientRegistry, FakeClientApplication]:
+    config = AzureAuth(
+        authority="https://login.microsoftonline.com/tenant", client_id="client_id",
+        scope=["https://graph.microsoft.com/.default"], secret="secret", internal_domains=[]
+    )
+    app = FakeClientApplication(expires_in)
+    monkeypatch.setattr(Configuration, "get_ms_auth_config", lambda self, tenant: config if tenant == "acme" else None)
+    monkeypatch.setattr(auth, "get_confidential_client_application", lambda config: app)
+    registry = MsalClientRegistry()
+    monkeypatch.setattr(auth, "msal_client_registry", registry)
+    return registry, app
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_msal_client_registry_reuses_token(monkeypatch):
+    registry, app = stub_registry(monkeypatch, expires_in=3600)
+    assert registry.get_client_application("acme", create=False) is None
+
+    tokens = await asyncio.gather(*[registry.get_token("acme") for _ in range(5)])
+    config, client_app, token = await get_auth_config_and_confidential_client_application_and_access_token("acme")
+
+    assert [token["access_token"] for token in tokens] == ["token-1"] * 5
+    assert token["access_token"] == "token-1"
+    assert client_app is app
+    assert app.calls == 1
+    assert await registry.get_token("globex") is None
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_msal_client_registry_refresh_is_cache_first(monkeypatch):
+    # valid for less than settings.MSAL_TOKEN_REFRESH_BEFORE_EXPIRY_SEC, due for the background refresh
+    registry, app = stub_registry(monkeypatch, expires_in=settings.MSAL_TOKEN_REFRESH_BEFORE_EXPIRY_SEC - 60)
+    # a second process sharing the token cache
+    other_registry = MsalClientRegistry()
+    registry.start(["acme"])
+    other_registry.start(["acme"])
+    await asyncio.sleep(0.1)
+    await registry.stop()
+    await other_registry.stop()
+
+    assert (await registry.get_token("acme"))["access_token"] == "token-1"
+    assert (await other_registry.get_token("acme"))["access_token"] == "token-1"
+    assert app.calls == 1
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_msal_client_registry_force_refresh_replaces_rejected_token(monkeypatch):
+    registry, app = stub_registry(monkeypatch, expires_in=3600)
+    assert (await registry.get_token("acme"))["access_token"] == "token-1"
+
+    token = await registry.get_token("acme", force_refresh=True)
+
+    assert token["access_token"] == "token-2"
+    assert (await registry.get_token("acme"))["access_token"] == "token-2"
+    assert app.calls == 2
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_msal_client_registry_force_refresh_takes_newer_cached_token(monkeypatch):
+    registry, app = stub_registry(monkeypatch, expires_in=3600)
+    assert (await registry.get_token("acme"))["access_token"] == "token-1"
+    # another process sharing the token cache replaced the token already
+    for access_token in list(app.token_cache.search(msal.TokenCache.CredentialType.ACCESS_TOKEN)):
+        app.token_cache.remove_at(access_token)
+    app.token_cache.add(get_token_event("token-other"))
+
+    token = await registry.get_token("acme", force_refresh=True)
+
+    assert token["access_token"] == "token-other"
+    assert app.calls == 1
@@ -0,0 +1,11 @@
+from app.core.bloom import BloomFilter
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom_filter = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom_filter.add(f"<{i}@mail.example.com>")
+    assert all(f"<{i}@mail.example.com>" in bloom_filter for i in range(1000))
+    false_positives = sum(f"<{i}@other.example.com>" in bloom_filter for i in range(10000))
+    assert false_positives < 300  # about 1%
+    assert bloom_filter.count == 1000
@@ -0,0 +1,27 @@
+import time
+
+from app.core.cache import TTLCache
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(2, 60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == (True, 1)
+    cache.set("c", 3)  # "b" is the least recently used
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
+    assert cache.get("c") == (True, 3)
+    assert cache.evictions == 1
+
+
+def test_ttl_cache_negative_caching_and_expiry():
+    cache = TTLCache(10, 60, negative_ttl_sec=0.05)
+    cache.set("external@example.com", None)
+    assert cache.get("external@example.com") == (True, None)
+    time.sleep(0.06)
+    assert cache.get("external@example.com") == (False, None)
+    snapshot = cache.snapshot()
+    assert snapshot["negative_hits"] == 1
+    assert snapshot["misses"] == 1
+    assert snapshot["expirations"] == 1
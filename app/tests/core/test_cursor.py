@@ -0,0 +1,11 @@
+import pytest
+
+from app.core.cursor import InvalidCursorException, decode_seq_no_cursor, encode_seq_no_cursor
+
+
+def test_seq_no_cursor():
+    assert decode_seq_no_cursor(encode_seq_no_cursor(1234567)) == 1234567
+    assert encode_seq_no_cursor(None) is None
+    assert decode_seq_no_cursor("") is None
+    with pytest.raises(InvalidCursorException):
+        decode_seq_no_cursor("not-a-cursor")
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from app.core.pipeline import PipelineStage, run_pipeline
+
+# This is the same as using the @pytest.mark.anyio on all test functions in the module
+pytestmark = pytest.mark.anyio
+
+
+async def iter_items(count: int, produced: list):
+    for i in range(count):
+        produced.append(i)
+        yield {"i": i}
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_run_pipeline_in_order_and_bounded():
+    produced = []
+    done = []
+    max_ahead = 0
+
+    async def double(item):
+        await asyncio.sleep(0.001 * (item["i"] % 3))
+        item["double"] = item["i"] * 2
+
+    async def slow(item):
+        nonlocal max_ahead
+        max_ahead = max(max_ahead, len(produced) - len(done))
+        await asyncio.sleep(0.01)
+
+    async def on_item_done(index, item):
+        done.append((index, item["double"]))
+
+    stages = [PipelineStage("double", double, workers=3), PipelineStage("slow", slow)]
+    queue_size = 1
+    count = await run_pipeline(iter_items(20, produced), stages, queue_size=queue_size, on_item_done=on_item_done)
+    assert count == 20
+    assert done == [(i, i * 2) for i in range(20)]
+    # a slow last stage holds back the source instead of letting items pile up: at most one item waiting in
+    # the source, a full queue in front of every stage and of on_item_done, one item per worker, and the items
+    # that overtook a slower one in a parallel stage, waiting to be done in order
+    bound = 1 + queue_size * (len(stages) + 1) + sum(stage.workers for stage in stages) \
+        + sum(stage.workers - 1 for stage in stages)
+    assert max_ahead <= bound
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_run_pipeline_raises_first_error():
+    async def fail(item):
+        if item["i"] == 3:
+            raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        await run_pipeline(iter_items(100, []), [PipelineStage("fail", fail, workers=2)], queue_size=2)
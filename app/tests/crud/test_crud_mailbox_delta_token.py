@@ -0,0 +1,49 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from app.crud.crud_mailbox_delta_token import CRUDMailboxDeltaToken
+from app.models.mailbox_delta_token import MailboxDeltaToken
+
+
+def get_db():
+    engine = create_engine("sqlite://")
+    MailboxDeltaToken.__table__.create(engine)
+    return sessionmaker(bind=engine)()
+
+
+def test_upsert_delta_link():
+    db = get_db()
+    crud = CRUDMailboxDeltaToken(MailboxDeltaToken)
+    crud.upsert_delta_link(db, mailbox="u", folder_id="inbox", delta_link="d1")
+    crud.upsert_delta_link(db, mailbox="u", folder_id="inbox", delta_link="d2")
+    crud.upsert_delta_link(db, mailbox="u", folder_id="sentitems", delta_link="s1")
+
+    assert db.query(MailboxDeltaToken).count() == 2
+    assert crud.get_by_mailbox_and_folder(db, mailbox="u", folder_id="inbox").DeltaLink == "d2"
+
+    db.add(MailboxDeltaToken(Mailbox="u", FolderId="inbox", DeltaLink="d3"))
+    with pytest.raises(IntegrityError):
+        db.commit()
+
+
+def test_upsert_delta_link_lost_race(monkeypatch):
+    db = get_db()
+    crud = CRUDMailboxDeltaToken(MailboxDeltaToken)
+    crud.upsert_delta_link(db, mailbox="u", folder_id="inbox", delta_link="d1")
+    get_by_mailbox_and_folder = crud.get_by_mailbox_and_folder
+    reads = []
+
+    def get_by_mailbox_and_folder_after_other_insert(db, *, mailbox, folder_id):
+        # the first read does not see the row another sync is inserting
+        reads.append(folder_id)
+        if len(reads) == 1:
+            return None
+        return get_by_mailbox_and_folder(db, mailbox=mailbox, folder_id=folder_id)
+
+    monkeypatch.setattr(crud, "get_by_mailbox_and_folder", get_by_mailbox_and_folder_after_other_insert)
+    db_obj = crud.upsert_delta_link(db, mailbox="u", folder_id="inbox", delta_link="d2")
+
+    assert db_obj.DeltaLink == "d2"
+    assert db.query(MailboxDeltaToken).count() == 1
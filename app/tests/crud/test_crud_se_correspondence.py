@@ -0,0 +1,36 @@
+import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.crud.crud_se_correspondence import CRUDSECorrespondence
+from app.models.se_correspondence import SECorrespondence
+from app.schemas.schema_db import SECorrespondenceCreate
+
+
+def get_se_correspondence_create(mail_unique_id: str) -> SECorrespondenceCreate:
+    now = datetime.datetime(2022, 1, 1)
+    return SECorrespondenceCreate(
+        DocSentDate=now, MailUniqueId=mail_unique_id, MailSubject="subject", MailBody1="body", MailTo="to",
+        MailCC="", MailFrom="from", MailBCC="", DocSendOn=now, QuoteNo=0, BkgNo=0, AccountCode="A1",
+        IsAttachmentProcessed=False, HasAttachment=False, ConversationId="", ConversationId44="",
+        CrDate=now, CrTime=now, UpdDate=now, UpdTime=now, UpdPlace=""
+    )
+
+
+def test_get_by_mail_unique_id_or_create_get_if_not_exist_multi():
+    engine = create_engine("sqlite://")
+    SECorrespondence.__table__.create(engine)
+    db = sessionmaker(bind=engine)()
+    crud = CRUDSECorrespondence(SECorrespondence)
+    existing = crud.get_by_mail_unique_id_or_create_get_if_not_exist_multi(
+        db, obj_ins=[get_se_correspondence_create("<1>")]
+    )
+    obj_ins = [get_se_correspondence_create(f"<{i}>") for i in [3, 1, 2, 3]]
+    db_objs = crud.get_by_mail_unique_id_or_create_get_if_not_exist_multi(db, obj_ins=obj_ins)
+    # one row per MailUniqueId, in the order given, existing rows are not inserted again
+    assert [db_obj.MailUniqueId for db_obj in db_objs] == ["<3>", "<1>", "<2>"]
+    assert db_objs[1].SeqNo == existing[0].SeqNo
+    assert all(db_obj.SeqNo is not None for db_obj in db_objs)
+    assert db.query(SECorrespondence).count() == 3
+    assert db_objs[0].DocType == "ML"  # column defaults apply
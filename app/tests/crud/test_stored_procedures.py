@@ -0,0 +1,31 @@
+from app.crud import stored_procedures
+from app.crud.stored_procedures import get_stored_procedure_statement, run_stored_procedure_batch, \
+    stored_procedure_stats
+from app.schemas.schema_sp import EmailTrackerGetEmailLinkInfo
+
+
+def test_get_stored_procedure_statement_binds_params():
+    statement, params = get_stored_procedure_statement("fit.dbo.sp", [["a@b.com", "it's"], None])
+    assert statement == "exec fit.dbo.sp :p0_0, :p0_1; exec fit.dbo.sp"
+    assert params == {"p0_0": "a@b.com", "p0_1": "it's"}
+
+
+def test_run_stored_procedure_batch_in_chunks(monkeypatch):
+    statements = []
+
+    def execute_multi_result_sets(db, statement, params):
+        statements.append(statement)
+        return [[{"AccountCode": params[f"p{i}_0"], "QuoteNo": i, "BkgNo": 0}] for i in range(statement.count("exec"))]
+
+    monkeypatch.setattr(stored_procedures, "_execute_multi_result_sets", execute_multi_result_sets)
+    stored_procedure_stats.reset()
+    res = run_stored_procedure_batch(
+        None, "fit.dbo.sp", [[str(i), "s", "d", ""] for i in range(5)],
+        AnyBaseModelSchema=EmailTrackerGetEmailLinkInfo, batch_size=2
+    )
+
+    assert len(statements) == 3
+    assert [rows[0].AccountCode for rows in res] == ["0", "1", "2", "3", "4"]
+    stats = stored_procedure_stats.snapshot()["fit.dbo.sp"]
+    assert stats["calls"] == 5
+    assert stats["round_trips"] == 3
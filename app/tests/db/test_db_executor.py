@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from sqlalchemy.orm import Session
+
+from app.core.settings import settings
+from app.db.db_executor import DbExecutor
+
+# This is the same as using the @pytest.mark.anyio on all test functions in the module
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_run_limits_tenant_and_keeps_loop_free(monkeypatch):
+    monkeypatch.setattr(settings, "DB_TENANT_CONCURRENCY", 2)
+    db_executor = DbExecutor()
+    sessions = [Session(info={"tenant": "acme"}) for _ in range(6)]
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def query(db: Session, value: int) -> int:
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+        return value * 2
+
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker = asyncio.ensure_future(tick())
+    results = await asyncio.gather(*[db_executor.run(db, query, i) for i, db in enumerate(sessions)])
+    ticker.cancel()
+    db_executor.shutdown()
+
+    assert results == [0, 2, 4, 6, 8, 10]
+    assert max_running == 2
+    # the loop kept running while the queries blocked their threads
+    assert ticks >= 5
+    assert db_executor.snapshot() == {"acme": {"running": 0, "waiting": 0}}
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_calls_waiting_for_their_session_hold_no_tenant_slot(monkeypatch):
+    monkeypatch.setattr(settings, "DB_TENANT_CONCURRENCY", 2)
+    db_executor = DbExecutor()
+    busy_db = Session(info={"tenant": "acme"})
+    other_db = Session(info={"tenant": "acme"})
+    finished = []
+
+    def query(db: Session, name: str) -> None:
+        time.sleep(0.05)
+        finished.append(name)
+
+    # the calls of one mailbox pipeline share a session
+    await asyncio.gather(
+        *[db_executor.run(busy_db, query, f"busy{i}") for i in range(4)],
+        db_executor.run(other_db, query, "other")
+    )
+    db_executor.shutdown()
+
+    assert finished[:2] in (["busy0", "other"], ["other", "busy0"])
+    assert [name for name in finished if name != "other"] == ["busy0", "busy1", "busy2", "busy3"]
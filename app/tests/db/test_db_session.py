@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from app.db import db_session
+from app.db.db_session import TenantEngineRegistry
+
+
+def test_engine_is_reused_per_tenant_and_db_name(monkeypatch):
+    monkeypatch.setattr(db_session, "get_tenant_sqlalchemy_url", lambda tenant, db_name: "sqlite://")
+    registry = TenantEngineRegistry()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        engines = list(executor.map(lambda _: registry.get_engine("acme", "mailstore"), range(16)))
+
+    assert all(eng is engines[0] for eng in engines)
+    assert registry.get_engine("acme", "fit") is not engines[0]
+    assert registry.get_engine("globex", "mailstore") is not engines[0]
+    assert len(registry.snapshot()) == 3
+
+
+def test_session_maker_is_reused_per_engine_and_knows_tenant(monkeypatch):
+    monkeypatch.setattr(db_session, "get_tenant_sqlalchemy_url", lambda tenant, db_name: "sqlite://")
+    registry = TenantEngineRegistry()
+    eng = registry.get_engine("acme", "mailstore")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        session_makers = list(executor.map(lambda _: registry.get_session_maker(eng), range(16)))
+
+    assert all(session_local is session_makers[0] for session_local in session_makers)
+    db = session_makers[0]()
+    assert db.info["tenant"] == "acme"
+    # rows committed in a db thread are read on the event loop without reloading
+    assert db.expire_on_commit is False
+    db.close()
+    registry.dispose_all()
+    assert registry.snapshot() == {}
@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+
+from app.core.config import MailIntegrateJob
+from app.scheduler import ScheduledJob
+
+
+def get_scheduled_job(catch_up: bool) -> ScheduledJob:
+    job = MailIntegrateJob(name="job", dependencies=[], interval_sec=60, jitter_sec=0, catch_up=catch_up)
+    return ScheduledJob("tenant", job, datetime(2022, 1, 1, 0, 0, 0))
+
+
+def test_schedule_next_on_time():
+    scheduled_job = get_scheduled_job(catch_up=True)
+    scheduled_job.schedule_next(datetime(2022, 1, 1, 0, 0, 30))
+    assert scheduled_job.next_run_at == datetime(2022, 1, 1, 0, 1, 0)
+    assert scheduled_job.missed_runs == 0
+
+
+def test_schedule_next_catch_up():
+    scheduled_job = get_scheduled_job(catch_up=True)
+    now = datetime(2022, 1, 1, 0, 2, 30)
+    scheduled_job.schedule_next(now)
+    # slots 00:01 and 00:02 were missed, one catch up run now, then back on the 00:03 slot
+    assert scheduled_job.missed_runs == 2
+    assert scheduled_job.next_run_at == now
+    assert scheduled_job.next_trigger == "catch_up"
+    scheduled_job.schedule_next(now + timedelta(seconds=10))
+    assert scheduled_job.next_run_at == datetime(2022, 1, 1, 0, 3, 30)
+
+
+def test_schedule_next_without_catch_up():
+    scheduled_job = get_scheduled_job(catch_up=False)
+    scheduled_job.schedule_next(datetime(2022, 1, 1, 0, 2, 30))
+    assert scheduled_job.missed_runs == 2
+    assert scheduled_job.next_run_at == datetime(2022, 1, 1, 0, 3, 0)
+    assert scheduled_job.next_trigger == "schedule"